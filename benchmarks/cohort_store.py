@@ -0,0 +1,98 @@
+"""Benchmark: random slice and patch access, .nii.gz vs. chunked cohort store.
+
+Writes a synthetic cohort as .nii.gz files, exports it into a chunked store
+and compares the time of random axial slice and patch reads (nibabel array
+proxy slicing vs. CohortStore) and the storage size.
+
+Example:
+    $ python benchmarks/cohort_store.py --images 8 --shape 128,256,256 --patch 32
+"""
+import argparse
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+from pathlib import Path
+from scipy import ndimage
+from midastools.misc.cohort_store import export_cohort, CohortStore
+
+
+def synthetic_volume(shape, seed=0):
+    """Smooth int16 volume (compressible like MR/CT data)."""
+    rng = np.random.RandomState(seed)
+    field = ndimage.gaussian_filter(rng.randn(*shape).astype(np.float32), 3)
+    return (1000 * field / field.std() + 0.2 * rng.randn(*shape) * 50).astype(np.int16)
+
+
+def directory_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+def timed_reads(read, requests):
+    t = time.time()
+    for request in requests:
+        read(*request)
+    return (time.time() - t) / len(requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='.nii.gz vs. chunked cohort store access benchmark')
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--shape', default='128,256,256', help='image shape (z, y, x)')
+    parser.add_argument('--patch', type=int, default=32, help='patch size')
+    parser.add_argument('--chunk', default='16,64,64', help='chunk shape (z, y, x)')
+    parser.add_argument('--level', type=int, default=1, help='zlib level')
+    parser.add_argument('--reads', type=int, default=20, help='number of random reads')
+    parser.add_argument('--cores', type=int, default=4)
+    args = parser.parse_args()
+
+    shape = tuple(int(s) for s in args.shape.split(','))
+    chunk_shape = tuple(int(c) for c in args.chunk.split(','))
+    rng = np.random.RandomState(1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        nii_files = []
+        for i in range(args.images):
+            img = sitk.GetImageFromArray(synthetic_volume(shape, seed=i))
+            nii_files.append(tmp_dir.joinpath(f'img{i:03d}.nii.gz'))
+            sitk.WriteImage(img, str(nii_files[-1]))
+
+        t = time.time()
+        export_cohort(nii_files, tmp_dir.joinpath('store'), chunk_shape=chunk_shape,
+                      level=args.level, num_cores=args.cores)
+        print(f'shape {shape}, {args.images} images, export time {time.time() - t:.2f}s')
+        print(f'size .nii.gz {directory_size(tmp_dir) - directory_size(tmp_dir.joinpath("store")):>12d} bytes')
+        print(f'size store   {directory_size(tmp_dir.joinpath("store")):>12d} bytes')
+
+        store = CohortStore(tmp_dir.joinpath('store'))
+        p = args.patch
+        slices = [(rng.randint(args.images), rng.randint(shape[0])) for _ in range(args.reads)]
+        patches = [(rng.randint(args.images),) + tuple(rng.randint(n - p + 1) for n in shape)
+                   for _ in range(args.reads)]
+
+        # nibabel (x, y, z) order, sitk arrays (z, y, x)
+        def nii_slice(i, z):
+            return np.asarray(nib.load(str(nii_files[i])).dataobj[:, :, z])
+
+        def nii_patch(i, z, y, x):
+            return np.asarray(nib.load(str(nii_files[i])).dataobj[x:x+p, y:y+p, z:z+p])
+
+        def store_slice(i, z):
+            return store[f'img{i:03d}'][z]
+
+        def store_patch(i, z, y, x):
+            return store[f'img{i:03d}'][z:z+p, y:y+p, x:x+p]
+
+        assert np.array_equal(nii_patch(*patches[0]).T, store_patch(*patches[0]))
+        for name, nii_read, store_read, requests in [('slice', nii_slice, store_slice, slices),
+                                                     (f'patch {p}^3', nii_patch, store_patch, patches)]:
+            t_nii = timed_reads(nii_read, requests)
+            t_store = timed_reads(store_read, requests)
+            print(f'{name:12s} .nii.gz {1000 * t_nii:8.2f}ms   store {1000 * t_store:8.2f}ms   '
+                  f'speedup {t_nii / t_store:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""Streaming intensity statistics of image cohorts.
+
+Images (and optional label masks) are read slab by slab, the intensities are
+accumulated in mergeable statistics (moments, fixed-bin histogram and a
+relative-error quantile sketch) per image, per mask label and merged per
+cohort. Peak memory is one slab per process.
+
+Example:
+    Example usage::
+        $ python -m midastools.misc.cohort_stats jobs.csv -o stats.csv --range 0,4000 --cores 8
+"""
+import argparse
+import csv
+import time
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from joblib import Parallel, delayed
+
+QUANTILES = (0.005, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.995)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative accuracy (DDSketch).
+
+    Values are counted in logarithmic buckets (gamma = (1+a)/(1-a)), every
+    quantile estimate has a relative error <= a. The number of buckets only
+    depends on the dynamic range of the values, not on their number.
+
+    Args:
+        relative_accuracy (float): relative accuracy a
+        min_value (float): absolute values below are counted as zero
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy)/(1 - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+        self.zero_count = 0
+        # dense bucket stores: (counts, key of the first bucket)
+        self._stores = {1: (np.zeros(0, np.int64), 0), -1: (np.zeros(0, np.int64), 0)}
+
+    @property
+    def count(self):
+        return self.zero_count + sum(int(c.sum()) for c, _ in self._stores.values())
+
+    def _add_counts(self, sign, counts, offset):
+        store, store_offset = self._stores[sign]
+        if not len(store):
+            self._stores[sign] = (counts.astype(np.int64), offset)
+            return
+        start = min(store_offset, offset)
+        stop = max(store_offset + len(store), offset + len(counts))
+        merged = np.zeros(stop - start, np.int64)
+        merged[store_offset - start:store_offset - start + len(store)] += store
+        merged[offset - start:offset - start + len(counts)] += counts
+        self._stores[sign] = (merged, start)
+
+    def add(self, values):
+        """Adds an array of values."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        magnitude = np.abs(values)
+        small = magnitude < self.min_value
+        self.zero_count += int(small.sum())
+        for sign in (1, -1):
+            selected = magnitude[~small & ((values > 0) if sign > 0 else (values < 0))]
+            if selected.size:
+                keys = np.ceil(np.log(selected)/self._log_gamma).astype(np.int64)
+                offset = int(keys.min())
+                self._add_counts(sign, np.bincount(keys - offset), offset)
+
+    def merge(self, other):
+        """Merges another sketch (same relative accuracy) in-place."""
+        if other.gamma != self.gamma:
+            raise ValueError('sketches with different relative accuracy can not be merged.')
+        self.zero_count += other.zero_count
+        for sign, (counts, offset) in other._stores.items():
+            if len(counts):
+                self._add_counts(sign, counts, offset)
+        return self
+
+    def quantile(self, q):
+        """Estimates the q-quantile(s), q in [0, 1]."""
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        neg, neg_offset = self._stores[-1]
+        pos, pos_offset = self._stores[1]
+        # all buckets in ascending value order
+        values = np.concatenate([-self._bucket_values(neg_offset, len(neg))[::-1], [0.0],
+                                 self._bucket_values(pos_offset, len(pos))])
+        counts = np.concatenate([neg[::-1], [self.zero_count], pos])
+        total = counts.sum()
+        if total == 0:
+            return np.full(q.shape, np.nan)
+        ranks = q*(total - 1)
+        return values[np.searchsorted(np.cumsum(counts), ranks, side='right')]
+
+    def _bucket_values(self, offset, n):
+        keys = np.arange(offset, offset + n)
+        return 2*self.gamma**keys/(self.gamma + 1)
+
+
+class Histogram:
+    """
+    Mergeable fixed-bin histogram with under- and overflow counts.
+
+    Args:
+        value_range (tuple): (min, max) of the bins
+        num_bins (int): number of bins
+    """
+
+    def __init__(self, value_range, num_bins=256):
+        self.edges = np.linspace(value_range[0], value_range[1], num_bins + 1)
+        self.counts = np.zeros(num_bins, np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def add(self, values):
+        values = np.asarray(values).ravel()
+        self.counts += np.histogram(values, self.edges)[0]
+        self.underflow += int((values < self.edges[0]).sum())
+        self.overflow += int((values > self.edges[-1]).sum())
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('histograms with different bins can not be merged.')
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+
+class IntensityStats:
+    """
+    Mergeable intensity statistics: moments, min/max, quantile sketch
+    and (optional) histogram.
+
+    Args:
+        relative_accuracy (float): quantile sketch accuracy
+        value_range (tuple): histogram range, None = no histogram
+        num_bins (int): number of histogram bins
+    """
+
+    def __init__(self, relative_accuracy=0.01, value_range=None, num_bins=256):
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.histogram = Histogram(value_range, num_bins) if value_range is not None else None
+
+    def add(self, values):
+        values = np.asarray(values).ravel()
+        if not values.size:
+            return
+        self.count += values.size
+        self.sum += float(values.sum(dtype=np.float64))
+        self.sum_sq += float(np.square(values, dtype=np.float64).sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sketch.add(values)
+        if self.histogram is not None:
+            self.histogram.add(values)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        if self.histogram is not None and other.histogram is not None:
+            self.histogram.merge(other.histogram)
+        return self
+
+    def summary(self, quantiles=QUANTILES):
+        """Count, mean, std, min, max and quantiles (dict)."""
+        mean = self.sum/self.count if self.count else np.nan
+        var = self.sum_sq/self.count - mean**2 if self.count else np.nan
+        result = {'count': self.count, 'mean': mean, 'std': np.sqrt(max(var, 0.0)),
+                  'min': self.min if self.count else np.nan, 'max': self.max if self.count else np.nan}
+        # the sketch estimates are clipped to the exact range
+        for q, value in zip(quantiles, self.sketch.quantile(quantiles)):
+            result[f'p{100*q:g}'] = float(np.clip(value, result['min'], result['max']))
+        return result
+
+
+def iter_slabs(nii_file, mask_file=None, slab_size=16):
+    """Yields (image slab, mask slab) along the last axis (sequential read, also for .nii.gz).
+
+    Args:
+        nii_file (str/Path): image file
+        mask_file (str/Path): mask file (same shape), None = no mask
+        slab_size (int): number of slices per slab
+
+    Yields:
+        (np.array, np.array or None)
+    """
+    img = nib.load(str(nii_file), keep_file_open=True)
+    mask = nib.load(str(mask_file), keep_file_open=True) if mask_file else None
+    if mask is not None and mask.shape[:3] != img.shape[:3]:
+        raise ValueError(f'{mask_file}: mask shape {mask.shape} does not match image shape {img.shape}.')
+    for z in range(0, img.shape[2], slab_size):
+        slab = np.asanyarray(img.dataobj[:, :, z:z+slab_size])
+        mask_slab = np.asanyarray(mask.dataobj[:, :, z:z+slab_size]) if mask is not None else None
+        yield slab, mask_slab
+
+
+def image_stats(nii_file, mask_file=None, labels=None, slab_size=16, **stats_kwargs):
+    """Streaming statistics of a single image, per mask label.
+
+    Args:
+        nii_file (str/Path): image file
+        mask_file (str/Path): label mask, None = whole image
+        labels (list): labels to evaluate, None = all labels > 0 of the mask
+        slab_size (int): number of slices per slab
+        **stats_kwargs: IntensityStats parameters
+
+    Returns:
+        dict: label -> IntensityStats ('all' without mask)
+    """
+    stats = {}
+    for slab, mask_slab in iter_slabs(nii_file, mask_file, slab_size):
+        if mask_slab is None:
+            stats.setdefault('all', IntensityStats(**stats_kwargs)).add(slab)
+            continue
+        mask_slab = np.asarray(mask_slab).astype(np.int64).ravel()
+        slab = slab.ravel()
+        # group the voxels of all labels at once
+        order = np.argsort(mask_slab, kind='stable')
+        values, starts = np.unique(mask_slab[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+        for label, start, stop in zip(values, starts, stops):
+            if (labels is None and label > 0) or (labels is not None and label in labels):
+                stats.setdefault(int(label), IntensityStats(**stats_kwargs)).add(slab[order[start:stop]])
+    return stats
+
+
+def empty_like(stats):
+    """Empty IntensityStats with the parameters (accuracy, histogram bins) of stats."""
+    if stats.histogram is None:
+        return IntensityStats(stats.sketch.relative_accuracy)
+    edges = stats.histogram.edges
+    return IntensityStats(stats.sketch.relative_accuracy, (edges[0], edges[-1]), len(edges) - 1)
+
+
+def merge_stats(stats_list):
+    """Merges per-image statistics dicts (label -> IntensityStats) to cohort statistics."""
+    cohort = {}
+    for stats in stats_list:
+        for label, s in stats.items():
+            if label not in cohort:
+                cohort[label] = empty_like(s)
+            cohort[label].merge(s)
+    return cohort
+
+
+def cohort_stats(jobs, num_cores=4, quantiles=QUANTILES, verbose=False, **kwargs):
+    """Streaming statistics of a cohort using a process pool.
+
+    Args:
+        jobs (list): (image file, mask file or None) tuples
+        num_cores (int): number of processes
+        quantiles (tuple): quantiles of the summary table
+        verbose (bool): print progress
+        **kwargs: image_stats parameters
+
+    Returns:
+        (pd.DataFrame, dict): summary table (per image / label and cohort rows),
+        cohort statistics (label -> IntensityStats)
+    """
+    t = time.time()
+    results = Parallel(n_jobs=num_cores)(
+        delayed(image_stats)(nii_file, mask_file, **kwargs) for nii_file, mask_file in jobs)
+
+    rows = []
+    for (nii_file, _), stats in zip(jobs, results):
+        for label, s in stats.items():
+            rows.append(dict(image=str(nii_file), label=label, **s.summary(quantiles)))
+    cohort = merge_stats(results)
+    for label, s in cohort.items():
+        rows.append(dict(image='cohort', label=label, **s.summary(quantiles)))
+
+    if verbose:
+        elapsed_time = time.time() - t
+        print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+    return pd.DataFrame(rows), cohort
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming intensity statistics (per image, label and cohort).')
+    parser.add_argument('jobs', help='.csv file with columns image[,mask]')
+    parser.add_argument('-o', '--output', help='output table .csv', required=True)
+    parser.add_argument('--histogram', help='cohort histograms .npz (requires --range)')
+    parser.add_argument('--range', help='histogram range min,max')
+    parser.add_argument('--bins', type=int, default=256, help='number of histogram bins')
+    parser.add_argument('--accuracy', type=float, default=0.01, help='relative quantile accuracy')
+    parser.add_argument('--slab', type=int, default=16, help='slices per slab')
+    parser.add_argument('--cores', type=int, default=4, help='number of processes')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    if args.histogram and not args.range:
+        parser.error('--histogram requires --range')
+
+    with open(args.jobs, newline='') as f:
+        jobs = [(row['image'], row.get('mask') or None) for row in csv.DictReader(f)]
+    value_range = tuple(float(v) for v in args.range.split(',')) if args.range else None
+
+    print(f'Cohort statistics of {len(jobs)} images using {args.cores} CPU cores')
+    table, cohort = cohort_stats(jobs, args.cores, verbose=args.verbose, slab_size=args.slab,
+                                 relative_accuracy=args.accuracy, value_range=value_range,
+                                 num_bins=args.bins)
+    table.to_csv(args.output, index=False)
+    if args.histogram:
+        np.savez(args.histogram, edges=next(iter(cohort.values())).histogram.edges,
+                 **{f'label_{label}': s.histogram.counts for label, s in cohort.items()})
+
+
+if __name__ == '__main__':
+    main()
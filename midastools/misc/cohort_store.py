@@ -0,0 +1,248 @@
+"""Chunked on-disk cohort store for fast random slice and patch access.
+
+A cohort of nifti files is exported into a store directory::
+
+    store/
+        index.json     names, shapes, dtypes, geometry, chunk shape, compression
+        chunks.npy     (num_chunks, 2) int64 table of byte offsets and lengths (memory mapped)
+        data/000000.bin  concatenated (compressed) chunks of the first image
+        ...
+
+Each image is split into chunks (array order z, y, x) which are compressed
+independently (zlib), so that a reader only decodes the chunks touched by a
+requested slice or patch.
+
+Example:
+    Example usage::
+        $ python -m midastools.misc.cohort_store /data/cohort /data/cohort_store -p '**/*.nii.gz' --cores 8
+"""
+import argparse
+import itertools
+import json
+import time
+import zlib
+import numpy as np
+import SimpleITK as sitk
+from pathlib import Path
+from joblib import Parallel, delayed
+
+
+def chunk_grid(shape, chunk_shape):
+    """Number of chunks along each axis."""
+    return tuple(-(-s // c) for s, c in zip(shape, chunk_shape))
+
+
+def export_image(nii_file, data_file, chunk_shape, level=1):
+    """Writes the chunks of a single image (C-order chunk grid).
+
+    Args:
+        nii_file (str/Path): input image
+        data_file (str/Path): output data file
+        chunk_shape (tuple): chunk shape (z, y, x)
+        level (int): zlib compression level, 0 = uncompressed
+
+    Returns:
+        dict: image entry of the index (with chunk lengths)
+    """
+    img = sitk.ReadImage(str(nii_file))
+    volume = sitk.GetArrayViewFromImage(img)
+    lengths = []
+    with open(str(data_file), 'wb') as f:
+        for idx in itertools.product(*[range(n) for n in chunk_grid(volume.shape, chunk_shape)]):
+            box = tuple(slice(i*c, (i+1)*c) for i, c in zip(idx, chunk_shape))
+            chunk = np.ascontiguousarray(volume[box]).tobytes()
+            if level:
+                chunk = zlib.compress(chunk, level)
+            f.write(chunk)
+            lengths.append(len(chunk))
+    return {'shape': list(volume.shape),
+            'dtype': volume.dtype.str,
+            'origin': list(img.GetOrigin()),
+            'spacing': list(img.GetSpacing()),
+            'direction': list(img.GetDirection()),
+            'lengths': lengths}
+
+
+def export_cohort(nii_files, store_dir, names=None, chunk_shape=(16, 64, 64), level=1, num_cores=4):
+    """Exports a cohort of nifti files into a chunked store.
+
+    Args:
+        nii_files (list): input images
+        store_dir (str/Path): output store directory
+        names (list): image names (default: file names without suffix)
+        chunk_shape (tuple): chunk shape (z, y, x)
+        level (int): zlib compression level, 0 = uncompressed
+        num_cores (int): number of processes
+    """
+    store_dir = Path(store_dir)
+    store_dir.joinpath('data').mkdir(parents=True, exist_ok=True)
+    if names is None:
+        names = [Path(f).name.replace('.gz', '').replace('.nii', '') for f in nii_files]
+    if len(set(names)) != len(names):
+        raise ValueError('image names are not unique.')
+    data_files = [f'data/{i:06d}.bin' for i in range(len(nii_files))]
+
+    entries = Parallel(n_jobs=num_cores)(
+        delayed(export_image)(f, store_dir.joinpath(data_file), chunk_shape, level)
+        for f, data_file in zip(nii_files, data_files))
+
+    # global chunk table: byte offset (within the data file) and length
+    chunks, images, first = [], {}, 0
+    for name, data_file, entry in zip(names, data_files, entries):
+        lengths = np.array(entry.pop('lengths'), dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        chunks.append(np.stack([offsets, lengths], axis=1))
+        images[name] = dict(entry, data_file=data_file, first_chunk=first)
+        first += len(lengths)
+
+    np.save(store_dir.joinpath('chunks.npy'), np.concatenate(chunks) if chunks else np.zeros((0, 2), np.int64))
+    with open(store_dir.joinpath('index.json'), 'w') as f:
+        json.dump({'chunk_shape': list(chunk_shape), 'compression': 'zlib' if level else None,
+                   'images': images}, f)
+
+
+class StoreVolume:
+    """
+    Lazy volume of a cohort store, supports numpy basic indexing
+    (integers and slices) in array order (z, y, x). Only the chunks
+    touched by the index are read and decoded.
+    """
+
+    def __init__(self, store, name):
+        self._store = store
+        self.name = name
+        entry = store.index['images'][name]
+        self.shape = tuple(entry['shape'])
+        self.dtype = np.dtype(entry['dtype'])
+        self.origin = tuple(entry['origin'])
+        self.spacing = tuple(entry['spacing'])
+        self.direction = tuple(entry['direction'])
+        self.chunk_shape = tuple(store.index['chunk_shape'])
+        self._grid = chunk_grid(self.shape, self.chunk_shape)
+        self._first_chunk = entry['first_chunk']
+        self._data_file = store.store_dir.joinpath(entry['data_file'])
+        self._data = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _read_chunk(self, idx):
+        if self._data is None:
+            self._data = np.memmap(str(self._data_file), dtype=np.uint8, mode='r')
+        offset, length = self._store.chunks[self._first_chunk + np.ravel_multi_index(idx, self._grid)]
+        buffer = self._data[offset:offset + length]
+        if self._store.index['compression']:
+            buffer = zlib.decompress(buffer)
+        shape = [min(c, s - i*c) for i, c, s in zip(idx, self.chunk_shape, self.shape)]
+        return np.frombuffer(buffer, dtype=self.dtype).reshape(shape)
+
+    def read(self, box):
+        """Reads a box (tuple of slices with step 1) of the volume."""
+        starts = [b.start for b in box]
+        out = np.empty([b.stop - b.start for b in box], dtype=self.dtype)
+        ranges = [range(b.start // c, -(-b.stop // c)) for b, c in zip(box, self.chunk_shape)]
+        for idx in itertools.product(*ranges):
+            chunk_start = [i*c for i, c in zip(idx, self.chunk_shape)]
+            chunk = self._read_chunk(idx)
+            src = tuple(slice(max(b.start - s, 0), min(b.stop - s, n))
+                        for b, s, n in zip(box, chunk_start, chunk.shape))
+            dst = tuple(slice(s + r.start - o, s + r.stop - o)
+                        for s, r, o in zip(chunk_start, src, starts))
+            out[dst] = chunk[src]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),)*(self.ndim - len(key) + 1) + key[i+1:]
+        key = key + (slice(None),)*(self.ndim - len(key))
+
+        box, post = [], []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step < 0:
+                    start, stop = stop + 1, start + 1
+                stop = max(stop, start)
+                box.append(slice(start, stop))
+                post.append(slice(None, None, step))
+            else:
+                k = int(k) + n if int(k) < 0 else int(k)
+                if not 0 <= k < n:
+                    raise IndexError(f'index {k} is out of bounds for size {n}')
+                box.append(slice(k, k + 1))
+                post.append(0)
+        return self.read(tuple(box))[tuple(post)]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array.astype(dtype) if dtype is not None else array
+
+    def to_sitk(self):
+        """Full volume as sitk image (with geometry)."""
+        img = sitk.GetImageFromArray(self[...])
+        img.SetOrigin(self.origin)
+        img.SetSpacing(self.spacing)
+        img.SetDirection(self.direction)
+        return img
+
+
+class CohortStore:
+    """
+    Reader of a chunked cohort store (see export_cohort).
+
+    Args:
+        store_dir (str/Path): store directory
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir.joinpath('index.json')) as f:
+            self.index = json.load(f)
+        self.chunks = np.load(self.store_dir.joinpath('chunks.npy'), mmap_mode='r')
+        self._volumes = {}
+
+    @property
+    def names(self):
+        return list(self.index['images'])
+
+    def __len__(self):
+        return len(self.index['images'])
+
+    def __contains__(self, name):
+        return name in self.index['images']
+
+    def __getitem__(self, name):
+        if name not in self._volumes:
+            self._volumes[name] = StoreVolume(self, name)
+        return self._volumes[name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a cohort of nifti files into a chunked store.')
+    parser.add_argument('input_dir', help='cohort directory')
+    parser.add_argument('store_dir', help='output store directory')
+    parser.add_argument('-p', '--pattern', default='**/*.nii*', help='glob pattern of the nifti files')
+    parser.add_argument('-c', '--chunk', default='16,64,64', help='chunk shape z,y,x')
+    parser.add_argument('-l', '--level', type=int, default=1, help='zlib level (0: uncompressed)')
+    parser.add_argument('--cores', type=int, default=4, help='number of processes')
+    args = parser.parse_args()
+
+    input_dir = Path(args.input_dir)
+    nii_files = sorted(f for f in input_dir.glob(args.pattern) if f.is_file())
+    # names: relative paths without suffix
+    names = [str(f.relative_to(input_dir)).replace('.gz', '').replace('.nii', '') for f in nii_files]
+    chunk_shape = tuple(int(c) for c in args.chunk.split(','))
+
+    print(f'export {len(nii_files)} images using {args.cores} CPU cores')
+    t = time.time()
+    export_cohort(nii_files, args.store_dir, names, chunk_shape, args.level, args.cores)
+    elapsed_time = time.time() - t
+    print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,212 @@
 import SimpleITK as sitk
 import argparse
+import time
+import numpy as np
 from pathlib import Path
+from joblib import Parallel, delayed
+from PIL import Image
 import matplotlib.pyplot as plt
 
-def main():
-    print("NIFI-image information")
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--nii', help='image .nii file')
+class MipProjector:
+    """Rotating maximum intensity projections around the z-axis.
+
+    The volume is rotated slice by slice in-plane. The sampling coordinates
+    (flat indices and interpolation weights into the axial plane) are
+    precomputed once per angle and shared by all slices and all volumes with
+    the same in-plane geometry (see get_projector).
+
+    Args:
+        shape (tuple): in-plane array shape (y, x)
+        spacing (tuple): in-plane spacing (y, x)
+        angles (list): rotation angles in degree (0 = coronal, 90 = sagittal)
+        order (int): interpolation order, 0 (nearest) or 1 (bilinear)
+    """
+
+    def __init__(self, shape, spacing, angles, order=0):
+        self.shape = tuple(shape)
+        self.spacing = tuple(spacing)
+        self.angles = list(angles)
+        self.order = order
+        # isotropic output grid large enough for the in-plane diagonal
+        self.pixel_spacing = min(spacing)
+        diagonal = np.hypot(shape[0]*spacing[0], shape[1]*spacing[1])
+        self.width = int(np.ceil(diagonal/self.pixel_spacing))
+        self.maps = [self._coordinate_map(angle) for angle in self.angles]
+
+    def _coordinate_map(self, angle):
+        """Sampling indices and weights of the rotated grid (depth, width)."""
+        ny, nx = self.shape
+        t = np.deg2rad(angle)
+        grid = (np.arange(self.width) - (self.width-1)/2)*self.pixel_spacing
+        v, u = np.meshgrid(grid, grid, indexing='ij')
+        x = (u*np.cos(t) + v*np.sin(t))/self.spacing[1] + (nx-1)/2
+        y = (-u*np.sin(t) + v*np.cos(t))/self.spacing[0] + (ny-1)/2
+        # sample outside of the field of view -> fill index (last column)
+        fill = ny*nx
+        if self.order == 0:
+            x, y = np.rint(x), np.rint(y)
+        # tolerance for rounding errors of the rotation (samples on the border)
+        eps = 1e-6
+        valid = (x >= -eps) & (x <= nx-1+eps) & (y >= -eps) & (y <= ny-1+eps)
+        # crop depth rows without any valid sample
+        rows = np.flatnonzero(valid.any(axis=1))
+        x, y, valid = x[rows], y[rows], valid[rows]
+
+        if self.order == 0:
+            index = np.where(valid, y.astype(np.int64)*nx + x.astype(np.int64), fill)
+            return index[None], None
+
+        x0 = np.clip(np.floor(x), 0, max(nx-2, 0)).astype(np.int64)
+        y0 = np.clip(np.floor(y), 0, max(ny-2, 0)).astype(np.int64)
+        wx, wy = x - x0, y - y0
+        x1, y1 = np.minimum(x0+1, nx-1), np.minimum(y0+1, ny-1)
+        index = np.stack([y0*nx + x0, y0*nx + x1, y1*nx + x0, y1*nx + x1])
+        weight = np.stack([(1-wy)*(1-wx), (1-wy)*wx, wy*(1-wx), wy*wx]).astype(np.float32)
+        index[:, ~valid] = fill
+        weight[:, ~valid] = 0.25
+        return index, weight
+
+    def project(self, volume, max_elements=2**24):
+        """Computes the rotating MIPs of a volume.
+
+        Args:
+            volume (np.array): image array (z, y, x)
+            max_elements (int): maximum number of samples per chunk (memory limit)
+
+        Returns:
+            np.array: MIPs (angle, z, width), row 0 = first slice
+        """
+        nz = volume.shape[0]
+        # flat slices with an additional fill column (volume minimum)
+        flat = np.empty((nz, self.shape[0]*self.shape[1] + 1),
+                        dtype=np.float32 if self.order else volume.dtype)
+        flat[:, :-1] = volume.reshape(nz, -1)
+        flat[:, -1] = volume.min()
+
+        mips = np.empty((len(self.angles), nz, self.width), dtype=flat.dtype)
+        for i, (index, weight) in enumerate(self.maps):
+            step = max(1, max_elements//index[0].size)
+            for z in range(0, nz, step):
+                chunk = flat[z:z+step]
+                if weight is None:
+                    samples = chunk[:, index[0]]
+                else:
+                    samples = chunk[:, index[0]]*weight[0]
+                    for k in range(1, 4):
+                        samples += chunk[:, index[k]]*weight[k]
+                np.max(samples, axis=1, out=mips[i, z:z+step])
+        return mips
+
+
+# process-local projector cache: (shape, spacing, angles, order) -> MipProjector
+_projectors = {}
+
+
+def get_projector(shape, spacing, angles, order=0, max_cached=8):
+    """Cached MipProjector, shared by all volumes of the same in-plane geometry."""
+    key = (tuple(shape), tuple(spacing), tuple(angles), order)
+    if key not in _projectors:
+        if len(_projectors) >= max_cached:
+            _projectors.pop(next(iter(_projectors)))
+        _projectors[key] = MipProjector(shape, spacing, angles, order)
+    return _projectors[key]
+
+
+def axis_mips(volume):
+    """Standard MIPs along the array axes.
+
+    Args:
+        volume (np.array): image array (z, y, x)
+
+    Returns:
+        dict: 'axial', 'coronal' and 'sagittal' projection
+    """
+    return {'axial': volume.max(axis=0),
+            'coronal': volume.max(axis=1),
+            'sagittal': volume.max(axis=2)}
+
+
+def to_rgb(mip, spacing, vmin, vmax, cmap='gray_r'):
+    """Converts a MIP (z, width) to an upright RGB image with square pixels.
+
+    Args:
+        mip (np.array): projection image, row 0 = first slice
+        spacing (tuple): pixel spacing (z, width)
+        vmin (float): lower window value
+        vmax (float): upper window value
+        cmap (str): matplotlib colormap
+
+    Returns:
+        np.array: uint8 RGB image
+    """
+    scale = spacing[0]/spacing[1]
+    rows = np.clip(np.round((np.arange(int(round(mip.shape[0]*scale))) + 0.5)/scale - 0.5),
+                   0, mip.shape[0]-1).astype(np.int64)
+    norm = np.clip((mip[rows[::-1]] - vmin)/max(vmax - vmin, 1e-12), 0, 1)
+    return (plt.get_cmap(cmap)(norm)[..., :3]*255).astype(np.uint8)
+
+
+def create_mip_nii(nii_file, out_dir, num_angles=36, order=0, axes=False, out_format='png',
+                   cmap='gray_r', percentile=99.5, duration=100, verbose=False):
+    """Writes rotating (and axis) MIPs of a nii image as png stack and/or gif movie.
+
+    Args:
+        nii_file (str/Path): input nii image
+        out_dir (str/Path): output directory
+        num_angles (int): number of angles over 360 degree
+        order (int): interpolation order, 0 (nearest) or 1 (bilinear)
+        axes (bool): additionally write the axial, coronal and sagittal MIPs
+        out_format (str): 'png', 'gif' or 'both'
+        cmap (str): matplotlib colormap
+        percentile (float): upper window percentile (of the coronal MIP)
+        duration (int): gif frame duration in ms
+        verbose (bool): print progress
+    """
+    nii_file, out_dir = Path(nii_file), Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    stem = nii_file.name.replace('.gz', '').replace('.nii', '')
+
+    img = sitk.ReadImage(str(nii_file))
+    volume = sitk.GetArrayViewFromImage(img)
+    spacing = img.GetSpacing()[::-1]
+
+    angles = tuple(np.arange(num_angles)*360.0/num_angles)
+    projector = get_projector(volume.shape[1:], spacing[1:], angles, order)
+    mips = projector.project(volume)
+    vmin, vmax = float(volume.min()), float(np.percentile(mips[0], percentile))
+
+    frames = [to_rgb(mip, (spacing[0], projector.pixel_spacing), vmin, vmax, cmap) for mip in mips]
+    if out_format in ('png', 'both'):
+        for angle, frame in zip(angles, frames):
+            Image.fromarray(frame).save(out_dir.joinpath(f'{stem}_mip_{angle:05.1f}.png'))
+    if out_format in ('gif', 'both'):
+        gif = [Image.fromarray(frame) for frame in frames]
+        gif[0].save(out_dir.joinpath(f'{stem}_mip.gif'), save_all=True,
+                    append_images=gif[1:], duration=duration, loop=0)
+    if axes:
+        axis_spacing = {'axial': spacing[1:], 'coronal': spacing[::2], 'sagittal': spacing[:2]}
+        for name, mip in axis_mips(volume).items():
+            Image.fromarray(to_rgb(mip, axis_spacing[name], vmin, vmax, cmap)).save(
+                out_dir.joinpath(f'{stem}_mip_{name}.png'))
+    if verbose:
+        print(f'{nii_file}: {len(angles)} MIPs -> {out_dir}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rotating maximum intensity projections (MIP)')
+    parser.add_argument('--nii', help='image .nii file (or glob pattern with --batch)')
+    parser.add_argument('-o', '--output', help='output directory (default: <image>_mip next to the image)')
+    parser.add_argument('-b', '--batch', action='store_true', help='--nii is a glob pattern')
+    parser.add_argument('-n', '--angles', type=int, default=36, help='number of rotation angles')
+    parser.add_argument('--order', type=int, choices=[0, 1], default=0, help='interpolation order')
+    parser.add_argument('--axes', action='store_true', help='write axial, coronal and sagittal MIPs')
+    parser.add_argument('-f', '--format', choices=['png', 'gif', 'both'], default='png')
+    parser.add_argument('--cmap', default='gray_r', help='matplotlib colormap')
+    parser.add_argument('--percentile', type=float, default=99.5, help='upper window percentile')
+    parser.add_argument('--cores', type=int, default=4, help='number of processes (batch mode)')
+    parser.add_argument('--show', action='store_true', help='show the coronal MIP (single image)')
+    parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
     nii_file = vars(args)['nii']
@@ -15,20 +214,39 @@ def main():
     if not nii_file:
         print('please specifiy .nii file')
         return 1
-    nii_file = Path(nii_file)
-    if not nii_file.exists():
-        print(str(nii_file), ' does not exist.')
 
-    reader = sitk.ImageFileReader()
-    reader.SetImageIO('NiftiImageIO')
-    reader.SetFileName(str(nii_file))
-    img = reader.Execute()
+    if args.batch:
+        pattern = Path(nii_file)
+        anchor = Path(pattern.anchor) if pattern.is_absolute() else Path('.')
+        nii_files = sorted(anchor.glob(str(pattern.relative_to(anchor))))
+    else:
+        nii_files = [Path(nii_file)]
+        if not nii_files[0].exists():
+            print(str(nii_file), ' does not exist.')
+            return 1
+
+    if args.show:
+        img = sitk.ReadImage(str(nii_files[0]))
+        mip_img = sitk.MaximumProjection(img, 1)
+        print(mip_img.GetSize())
+        plt.imshow(sitk.GetArrayFromImage(mip_img)[:, 0, :])
+        plt.show()
+        return
+
+    def out_dir(f):
+        stem = f.name.replace('.gz', '').replace('.nii', '')
+        return Path(args.output).joinpath(stem) if args.output and args.batch else \
+            Path(args.output) if args.output else f.parent.joinpath(stem + '_mip')
 
-    mip_img = sitk.MaximumProjection(img, 1)
-    print(mip_img.GetSize())
+    print(f'Creating MIPs of {len(nii_files)} images using {args.cores} CPU cores')
+    t = time.time()
+    Parallel(n_jobs=args.cores)(
+        delayed(create_mip_nii)(f, out_dir(f), args.angles, args.order, args.axes, args.format,
+                                args.cmap, args.percentile, verbose=args.verbose)
+        for f in nii_files)
+    elapsed_time = time.time() - t
+    print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
 
-    plt.imshow(sitk.GetArrayFromImage(mip_img)[:, 0, :])
-    plt.show()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,160 @@
+import SimpleITK as sitk
+import numpy as np
+from pathlib import Path
+
+
+def read_image_information(filepath, image_io=''):
+    """Reads the image information of a single image file (no pixel data).
+
+    Args:
+        filepath (str/Path): image file
+        image_io (str): sitk image io (e.g. 'GDCMImageIO'), default: by file name
+
+    Returns:
+        sitk.ImageFileReader with the image information
+    """
+    reader = sitk.ImageFileReader()
+    if image_io:
+        reader.SetImageIO(image_io)
+    reader.SetFileName(str(filepath))
+    reader.ReadImageInformation()
+    return reader
+
+
+def read_slice_information(filepath):
+    """Reads the image information of a single dicom file (no pixel data).
+
+    Args:
+        filepath (str/Path): dicom file
+
+    Returns:
+        sitk.ImageFileReader with the image information
+    """
+    return read_image_information(filepath, 'GDCMImageIO')
+
+
+class ImageGeometry:
+    """
+    Image geometry (size, origin, spacing, direction) without pixel data.
+    Provides the subset of the sitk image interface needed to sort images,
+    to transfer the geometry to another image and to transform between
+    indices and physical points.
+
+    Args:
+        size (tuple): image size
+        origin (tuple): origin
+        spacing (tuple): spacing
+        direction (tuple): direction (row major)
+        pixel_id (int): sitk pixel id of the image data
+    """
+
+    def __init__(self, size, origin, spacing, direction, pixel_id=sitk.sitkUInt8):
+        self._size = tuple(int(s) for s in size)
+        self.pixel_id = pixel_id
+        # 1-voxel image carrying the geometry (index <-> physical point transforms).
+        self._geometry = sitk.Image([1]*len(self._size), pixel_id)
+        self._geometry.SetOrigin(tuple(origin))
+        self._geometry.SetSpacing(tuple(spacing))
+        self._geometry.SetDirection(tuple(direction))
+
+    @classmethod
+    def from_file(cls, filepath, image_io=''):
+        """Geometry of an image file (header only)."""
+        reader = read_image_information(filepath, image_io)
+        return cls(reader.GetSize(), reader.GetOrigin(), reader.GetSpacing(),
+                   reader.GetDirection(), reader.GetPixelID())
+
+    @property
+    def dtype(self):
+        return sitk.GetArrayViewFromImage(self._geometry).dtype
+
+    def GetSize(self):
+        return self._size
+
+    def GetDimension(self):
+        return len(self._size)
+
+    def GetPixelID(self):
+        return self.pixel_id
+
+    def GetOrigin(self):
+        return self._geometry.GetOrigin()
+
+    def GetSpacing(self):
+        return self._geometry.GetSpacing()
+
+    def GetDirection(self):
+        return self._geometry.GetDirection()
+
+    def SetOrigin(self, origin):
+        self._geometry.SetOrigin(tuple(origin))
+
+    def SetSpacing(self, spacing):
+        self._geometry.SetSpacing(tuple(spacing))
+
+    def SetDirection(self, direction):
+        self._geometry.SetDirection(tuple(direction))
+
+    def TransformIndexToPhysicalPoint(self, index):
+        return self._geometry.TransformIndexToPhysicalPoint(index)
+
+    def TransformPhysicalPointToIndex(self, point):
+        return self._geometry.TransformPhysicalPointToIndex(point)
+
+    def TransformContinuousIndexToPhysicalPoint(self, index):
+        return self._geometry.TransformContinuousIndexToPhysicalPoint(index)
+
+
+class DicomSeriesGeometry(ImageGeometry):
+    """
+    Image geometry (size, origin, spacing, direction) of a dicom series, derived
+    from the slice headers only (no pixel data is decoded).
+
+    The geometry is computed as in sitk.ImageSeriesReader: the origin and the
+    direction (image orientation and its normal) of the first slice, the slice
+    spacing from the positions of the first and the last slice. For tilted or
+    sheared series the slice direction is not used, as in ITK.
+
+    Args:
+        dcm_dir (str/Path): dicom directory
+        dcm_series_id (str): series instance uid (default: first series in the directory)
+        file_names (list): explicitly given (sorted) dicom files, dcm_dir is ignored
+    """
+
+    def __init__(self, dcm_dir='', dcm_series_id='', file_names=None):
+        if file_names is None:
+            if dcm_series_id:
+                file_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(str(dcm_dir), dcm_series_id)
+            else:
+                file_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(str(dcm_dir))
+        if not file_names:
+            raise ValueError(f'{dcm_dir}: no dicom series found.')
+        self.file_names = list(file_names)
+
+        first = read_slice_information(self.file_names[0])
+        size = list(first.GetSize())
+        spacing = list(first.GetSpacing())
+        if len(self.file_names) > 1:
+            last = read_slice_information(self.file_names[-1])
+            slice_vector = np.array(last.GetOrigin()) - np.array(first.GetOrigin())
+            size[2] = len(self.file_names)
+            spacing[2] = np.linalg.norm(slice_vector)/(len(self.file_names) - 1)
+        super().__init__(size, first.GetOrigin(), spacing, first.GetDirection(), first.GetPixelID())
+
+
+def copy_geometry(img, geometry):
+    """Copies origin, spacing and direction (like sitk CopyInformation) in-place.
+
+    Args:
+        img (sitk.Image): target image
+        geometry: sitk image or DicomSeriesGeometry with the same size
+
+    Returns:
+        sitk.Image: the target image
+    """
+    if tuple(img.GetSize()) != tuple(geometry.GetSize()):
+        raise ValueError(f'image size {img.GetSize()} does not match the geometry size {geometry.GetSize()}.')
+    img.SetOrigin(geometry.GetOrigin())
+    img.SetSpacing(geometry.GetSpacing())
+    img.SetDirection(geometry.GetDirection())
+    return img
@@ -3,22 +3,29 @@ import scipy.ndimage.morphology
 from pathlib import Path
 import argparse
 import numpy as np
+from midastools.misc import imcache
 
 
 def fillholes_nii(nii_file,
-                  out_file):
+                  out_file,
+                  multi_label=False,
+                  axis=None,
+                  cache=False):
     """Binary fill holes using scipy.ndimage
 
     Args:
         nii_file (str/Path): input nii mask file
         out_file (str/Path): output path to save modified file
+        multi_label (bool, optional): fill holes per label. Defaults to False.
+        axis (int, optional): slice-wise 2d filling along this (array) axis. Defaults to None.
+        cache (bool, optional): read the mask through the process-local image cache. Defaults to False.
     """
     # Read nii image.
-    mask = sitk.ReadImage(str(nii_file))
+    mask = imcache.load_image(nii_file) if cache else sitk.ReadImage(str(nii_file))
 
     # Binary fill holes.
     input_mask = sitk.GetArrayFromImage(mask)
-    output_mask = fillholes(input_mask)
+    output_mask = fillholes(input_mask, multi_label, axis)
     filled_mask = sitk.GetImageFromArray(output_mask)
     filled_mask.SetDirection(mask.GetDirection())
     filled_mask.SetOrigin(mask.GetOrigin())
@@ -31,17 +38,67 @@ def fillholes_nii(nii_file,
     writer.Execute(filled_mask)
 
 
-def fillholes(input_mask):
+def fill_structure(ndim, axis=None):
+    """Connectivity structure for hole filling.
+
+    Args:
+        ndim (int): number of dimensions
+        axis (int, optional): no connectivity along this axis (slice-wise filling). Defaults to None.
+
+    Returns:
+        np.array: structure
+    """
+    structure = scipy.ndimage.generate_binary_structure(ndim, 1)
+    if axis is not None:
+        # Keep the center plane only, each slice is filled separately.
+        plane = [slice(None)] * ndim
+        for idx in (0, 2):
+            plane[axis] = idx
+            structure[tuple(plane)] = False
+    return structure
+
+
+def padded_box(bbox, shape, margin=1):
+    """Enlarges a bounding box (tuple of slices) by a margin."""
+    return tuple(slice(max(sl.start - margin, 0), min(sl.stop + margin, size))
+                 for sl, size in zip(bbox, shape))
+
+
+def fillholes(input_mask, multi_label=False, axis=None):
     """Binary fill holes using scipy.ndimage
+
+    Holes are filled inside the bounding box (plus one voxel margin) of
+    the foreground or, for multi-label masks, of each label.
     
     Args:
         input_mask (np.array): input mask
+        multi_label (bool, optional): fill holes per label, keep label values. Defaults to False.
+        axis (int, optional): slice-wise 2d filling along this (array) axis. Defaults to None.
     
     Returns:
         np.array: filled mask
     """
-    output_mask= scipy.ndimage.morphology.binary_fill_holes(input_mask)
-    output_mask = output_mask.astype(np.uint8)
+    structure = fill_structure(input_mask.ndim, axis)
+
+    if not multi_label:
+        label_mask = (input_mask != 0).astype(np.uint8)
+        output_mask = np.zeros(input_mask.shape, dtype=np.uint8)
+        bbox = scipy.ndimage.find_objects(label_mask)
+        if bbox:
+            bbox = padded_box(bbox[0], input_mask.shape)
+            output_mask[bbox] = scipy.ndimage.binary_fill_holes(label_mask[bbox], structure)
+        return output_mask
+
+    label_mask = input_mask.astype(np.int64) if input_mask.dtype.kind not in 'iu' else input_mask
+    output_mask = input_mask.copy()
+    boxes = [(idx, padded_box(bbox, input_mask.shape))
+             for idx, bbox in enumerate(scipy.ndimage.find_objects(label_mask), 1) if bbox is not None]
+    # Small (inner) labels first, holes enclosed by several labels go to the innermost one.
+    boxes = sorted(boxes, key=lambda b: np.prod([sl.stop - sl.start for sl in b[1]]))
+    for idx, bbox in boxes:
+        filled = scipy.ndimage.binary_fill_holes(label_mask[bbox] == idx, structure)
+        box_mask = output_mask[bbox]
+        box_mask[filled & (box_mask == 0)] = idx
     return output_mask
 
 
@@ -51,6 +108,8 @@ def main():
     parser.add_argument('nii_input', help='Input .nii file')
     parser.add_argument('-p', '--Praefix', help='Praefix for output filename')
     parser.add_argument('-o', '--Output', help='Output .nii file')
+    parser.add_argument('-m', '--MultiLabel', help='Fill holes per label', action='store_true')
+    parser.add_argument('-a', '--Axis', help='Slice-wise 2d filling along this (array) axis', type=int, choices=[0, 1, 2])
     args = parser.parse_args()
 
     nii_file = Path(args.nii_input)
@@ -65,7 +124,7 @@ def main():
             praefix = args.Praefix
         outpath = nii_file.parent.joinpath(praefix + nii_file.name)
 
-    fillholes_nii(nii_file, outpath)
+    fillholes_nii(nii_file, outpath, args.MultiLabel, args.Axis)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+import os
+import threading
+import SimpleITK as sitk
+from collections import OrderedDict
+from pathlib import Path
+from midastools.misc.nifti import image_array_view, SimpleITKAsNibabel
+
+
+class ImageCache:
+    """
+    Process-local LRU cache of decoded images.
+
+    Entries are keyed by (resolved path, mtime, size), a modified file is read
+    again. The least recently used images are evicted when the pixel data exceeds
+    the byte budget, images larger than the budget are not cached.
+
+    Cached images are never handed out directly: load_image returns a shallow
+    SimpleITK copy (copy-on-write, modifications do not affect the cache) and
+    load_array a read-only array view.
+
+    Args:
+        max_bytes (int): byte budget of the cached pixel data
+    """
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(filepath):
+        path = Path(filepath).resolve()
+        stat = path.stat()
+        return str(path), stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _nbytes(img):
+        return img.GetNumberOfPixels()*img.GetNumberOfComponentsPerPixel()*img.GetSizeOfPixelComponent()
+
+    def _get(self, filepath):
+        key = self._key(filepath)
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return img
+            self.misses += 1
+
+        img = sitk.ReadImage(key[0])
+        nbytes = self._nbytes(img)
+        if nbytes > self.max_bytes:
+            return img
+        with self._lock:
+            if key not in self._images:
+                # drop outdated versions of the same file
+                for old_key in [k for k in self._images if k[0] == key[0]]:
+                    self._remove(old_key)
+                self._images[key] = img
+                self.bytes += nbytes
+                while self.bytes > self.max_bytes:
+                    self._remove(next(iter(self._images)))
+                    self.evictions += 1
+        return img
+
+    def _remove(self, key):
+        self.bytes -= self._nbytes(self._images.pop(key))
+
+    def load_image(self, filepath):
+        """Loads an image file (cached) as sitk image (copy-on-write copy)."""
+        return sitk.Image(self._get(filepath))
+
+    def load_array(self, filepath):
+        """Loads an image file (cached) as read-only (z, y, x) array view."""
+        return image_array_view(self._get(filepath))
+
+    def load_nii(self, filepath):
+        """Loads an image file (cached) as nibabel image with read-only data proxy."""
+        return SimpleITKAsNibabel(self.load_image(filepath))
+
+    def stats(self):
+        """Cache statistics (hits, misses, evictions, number of images, bytes)."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'images': len(self._images), 'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        """Removes all cached images and resets the statistics."""
+        with self._lock:
+            self._images.clear()
+            self.bytes = self.hits = self.misses = self.evictions = 0
+
+
+# default cache of the process (budget in bytes via MIDASTOOLS_CACHE_BYTES)
+_cache = ImageCache(int(os.environ.get('MIDASTOOLS_CACHE_BYTES', 1024**3)))
+
+
+def get_cache():
+    return _cache
+
+
+def load_image(filepath):
+    return _cache.load_image(filepath)
+
+
+def load_array(filepath):
+    return _cache.load_array(filepath)
+
+
+def load_nii(filepath):
+    return _cache.load_nii(filepath)
+
+
+def cache_stats():
+    return _cache.stats()
@@ -2,43 +2,105 @@ import SimpleITK as sitk
 import argparse
 import numpy as np
 from pathlib import Path
-from skimage.measure import label
+from scipy import ndimage
+from midastools.misc import imcache
 
 
-def lcomp(mask):
+def label_components(mask):
+    """Labels connected components (full connectivity) using the
+    multi-threaded SimpleITK backend.
+
+    Args:
+        mask (np.array): binary mask
+
+    Returns:
+        np.array: component labels (uint32), labels in raster order
+    """
+    mask_img = sitk.GetImageFromArray(mask.astype(np.uint8))
+    labels = sitk.ConnectedComponent(mask_img, True)
+    return sitk.GetArrayFromImage(labels)
+
+
+def select_components(mask, top_k=1, min_size=0):
+    """Selects the top_k largest components of a binary mask.
+
+    Args:
+        mask (np.array): binary mask
+        top_k (int, optional): number of components to keep (None: all). Defaults to 1.
+        min_size (int, optional): min. component size (voxels). Defaults to 0.
+
+    Returns:
+        np.array: selected components (bool)
+    """
+    labels = label_components(mask)
+    counts = np.bincount(labels.ravel())
+    counts[0] = 0
+    # stable sort, ties are resolved by the label order
+    selected = np.argsort(-counts, kind='stable')
+    selected = selected[counts[selected] > max(min_size - 1, 0)]
+    if top_k is not None:
+        selected = selected[:top_k]
+    lut = np.zeros(len(counts), dtype=bool)
+    lut[selected] = True
+    return lut[labels]
+
+
+def lcomp(mask, top_k=1, min_size=0, multi_label=False):
     """Computes largest connected component for binary mask.
+
+    The mask is cropped to the foreground bounding box before labeling.
+    For multi-label masks, each label is processed separately (inside its
+    bounding box) and the label values are kept.
     
     Args:
         mask (np.array): input binary mask
+        top_k (int, optional): number of components to keep (None: all). Defaults to 1.
+        min_size (int, optional): min. component size (voxels). Defaults to 0.
+        multi_label (bool, optional): process each label separately. Defaults to False.
     
     Returns:
         np.array: largest connected component
     """
 
-    labels = label(mask)
-    unique, counts = np.unique(labels, return_counts=True)
-    # the 0 label is by default background so take the rest
-    list_seg = list(zip(unique, counts))[1:]
-    largest = max(list_seg, key=lambda x: x[1])[0]
-    labels_max = (labels == largest).astype(np.uint8)
+    if multi_label:
+        label_mask = mask.astype(np.int64) if mask.dtype.kind not in 'iu' else mask
+        labels_max = np.zeros_like(mask)
+    else:
+        label_mask = (mask != 0).astype(np.uint8)
+        labels_max = np.zeros(mask.shape, dtype=np.uint8)
+
+    for idx, bbox in enumerate(ndimage.find_objects(label_mask), 1):
+        if bbox is None:
+            continue
+        selected = select_components(label_mask[bbox] == idx, top_k, min_size)
+        labels_max[bbox][selected] = mask[bbox][selected] if multi_label else 1
+
     return labels_max
 
 
 def lcomp_nii(nii_file,
-              out_file):
+              out_file,
+              top_k=1,
+              min_size=0,
+              multi_label=False,
+              cache=False):
     """Computes largest connected component for binary mask nii file.
 
     Args:
         nii_file (str/Path): input binary mask (nii)
         out_file (str/Path): largest component mask (nii)
+        top_k (int, optional): number of components to keep (None: all). Defaults to 1.
+        min_size (int, optional): min. component size (voxels). Defaults to 0.
+        multi_label (bool, optional): process each label separately. Defaults to False.
+        cache (bool, optional): read the mask through the process-local image cache. Defaults to False.
 
     """
     # Read nii image.
-    mask = sitk.ReadImage(str(nii_file))
+    mask = imcache.load_image(nii_file) if cache else sitk.ReadImage(str(nii_file))
 
     # Select largest component.
     input_mask = sitk.GetArrayFromImage(mask)
-    lcomp_mask = lcomp(input_mask)
+    lcomp_mask = lcomp(input_mask, top_k, min_size, multi_label)
 
     lcomp_mask = sitk.GetImageFromArray(lcomp_mask)
     lcomp_mask.SetDirection(mask.GetDirection())
@@ -58,6 +120,9 @@ def main():
     parser.add_argument('nii_input', help='Input .nii file')
     parser.add_argument('-p', '--Praefix', help='Praefix for output filename')
     parser.add_argument('-o', '--Output', help='Output .nii file')
+    parser.add_argument('-k', '--TopK', help='Number of components to keep (default 1)', type=int, default=1)
+    parser.add_argument('-s', '--MinSize', help='Min. component size (voxels)', type=int, default=0)
+    parser.add_argument('-m', '--MultiLabel', help='Process each label separately', action='store_true')
     args = parser.parse_args()
 
     nii_file = Path(args.nii_input)
@@ -72,7 +137,7 @@ def main():
             praefix = args.Praefix
         outpath = nii_file.parent.joinpath(praefix + nii_file.name)
 
-    lcomp_nii(nii_file, outpath)
+    lcomp_nii(nii_file, outpath, args.TopK, args.MinSize, args.MultiLabel)
 
 
 if __name__ == '__main__':
@@ -19,6 +19,7 @@ import sys
 import time
 import re
 import tempfile
+import traceback
 import pydicom as dicom
 from pathlib import Path
 import sys
@@ -27,8 +28,11 @@ import dicom2nifti.settings
 import SimpleITK as sitk
 import shutil
 import argparse
+import numpy as np
 from zipfile import ZipFile
 from joblib import Parallel, delayed
+from midastools.misc import zcompose
+from midastools.misc.orientation import reorient_sitk
 
 
 def unzip(zip_file, output_dir):
@@ -268,6 +272,166 @@ def dcm2nii_zipped_dixon(zip_file, output_dir,
         tmp.cleanup()
         return
 
+def read_zipped_headers(zip_obj):
+    """Reads the dicom headers (no pixel data) of all files in a zip archive.
+    
+    Args:
+        zip_obj (ZipFile): opened zip archive
+    
+    Returns:
+        list of (member name, pydicom dataset) tuples
+    """
+
+    headers = []
+    for info in zip_obj.infolist():
+        if info.is_dir():
+            continue
+        try:
+            with zip_obj.open(info) as f:
+                ds = dicom.dcmread(f, stop_before_pixels=True)
+        except dicom.errors.InvalidDicomError:
+            continue
+        if 'ImagePositionPatient' in ds:
+            headers.append((info.filename, ds))
+    return headers
+
+
+def sort_dixon_headers(headers):
+    """Groups dicom headers by dixon contrast and station (series).
+
+    Uses the same contrast rules as sort_dcm_dir.
+    
+    Args:
+        headers (list): (member name, pydicom dataset) tuples
+    
+    Returns:
+        dict contrast -> list of stations (lists of (member name, dataset) tuples)
+    """
+
+    contrasts = ['fat','water','in','opp']
+    max_echo_time = max(float(ds.EchoTime) for _, ds in headers)
+
+    stations = {contrast: {} for contrast in contrasts}
+    for name, ds in headers:
+        image_type = str(ds[0x00511019].value) if (0x0051, 0x1019) in ds else ''
+        if 'DIXF' in image_type: # fat
+            contrast = contrasts[0]
+        elif 'DIXW' in image_type: # water
+            contrast = contrasts[1]
+        elif float(ds.EchoTime) == max_echo_time: # in
+            contrast = contrasts[2]
+        else: # op
+            contrast = contrasts[3]
+        stations[contrast].setdefault(ds.SeriesInstanceUID, []).append((name, ds))
+
+    return {contrast: list(series.values()) for contrast, series in stations.items()}
+
+
+def dcm_station_to_sitk(zip_obj, station):
+    """Converts the dicom slices of a single station (in memory) to a sitk image.
+    
+    Args:
+        zip_obj (ZipFile): opened zip archive
+        station (list): (member name, dataset) tuples of the station
+    
+    Returns:
+        sitk image (LAS orientation, as the dicom2nifti conversion)
+    """
+
+    ds0 = station[0][1]
+    orientation = np.array(ds0.ImageOrientationPatient, dtype=float)
+    row_dir, col_dir = orientation[:3], orientation[3:]
+    normal = np.cross(row_dir, col_dir)
+    station = sorted(station, key=lambda s: np.dot(normal, np.array(s[1].ImagePositionPatient, dtype=float)))
+    positions = [np.dot(normal, np.array(ds.ImagePositionPatient, dtype=float)) for _, ds in station]
+    slice_spacing = float(np.median(np.diff(positions))) if len(positions) > 1 else float(ds0.SliceThickness)
+
+    slices = []
+    for name, _ in station:
+        with zip_obj.open(name) as f:
+            ds = dicom.dcmread(f)
+        pixels = ds.pixel_array
+        slope = float(getattr(ds, 'RescaleSlope', 1.0))
+        intercept = float(getattr(ds, 'RescaleIntercept', 0.0))
+        if slope != 1.0 or intercept != 0.0:
+            pixels = pixels.astype(np.float32) * slope + intercept
+        slices.append(pixels)
+
+    img = sitk.GetImageFromArray(np.stack(slices))
+    pixel_spacing = [float(sp) for sp in ds0.PixelSpacing]
+    img.SetSpacing((pixel_spacing[1], pixel_spacing[0], slice_spacing))
+    img.SetOrigin([float(p) for p in station[0][1].ImagePositionPatient])
+    img.SetDirection(np.stack([row_dir, col_dir, normal], axis=1).ravel().tolist())
+    # same orientation as the dicom2nifti converted station files
+    return reorient_sitk(img, ('L', 'A', 'S'))
+
+
+def dcm2nii_zipped_dixon_composed(zip_file, output_dir,
+                                  add_id=False,
+                                  single_dir=False,
+                                  blend=False,
+                                  verbose=False):
+    """Convert dixon station zip (with four contrasts) to composed whole-body nifti files.
+
+    Fused pipeline: the stations are converted in memory directly from the zip
+    (no unzip, no intermediate station nifti files) and composed along the z-axis.
+    The crop layout is computed once and shared by all contrasts, only the
+    composed volume of each contrast is written.
+    
+    Args:
+        zip_file (str/Path): zip file with the dicom stations
+        output_dir (str/Path): output directory for nifti files
+        add_id (bool): add subject id (parsed from zip filename) as praefix
+        single_dir (bool): save nifti files in a single directory (no subdirs)
+        blend (bool): linear blending of the station overlap regions
+        verbose (bool): activate prints
+    """
+
+    f = Path(zip_file)
+    output_dir = Path(output_dir)
+    # get subject id
+    subj_id = re.match('.*([0-9]{6}).*', f.name).group(1)
+
+    if verbose:
+        print('converting: ', f)
+
+    if single_dir:
+        # use id praefix, if all files are saved in one directory
+        dest_dir = output_dir
+        subj_str = (subj_id + '_')
+    else:
+        # create folder with subject id
+        dest_dir = output_dir.joinpath(subj_id)
+        subj_str = (subj_id + '_') if add_id else ''
+
+    try:
+        with ZipFile(str(f), 'r') as zip_obj:
+            stations = sort_dixon_headers(read_zipped_headers(zip_obj))
+            dest_dir.mkdir(exist_ok=True)
+            layout, ref_sizes = None, None
+            for contrast, contrast_stations in stations.items():
+                if not contrast_stations:
+                    continue
+                imgs = zcompose.sort_imgs([dcm_station_to_sitk(zip_obj, station)
+                                           for station in contrast_stations])
+                sizes = [im.GetSize() for im in imgs]
+                if layout is None:
+                    layout, ref_sizes = zcompose.compose_layout(imgs, blend), sizes
+                elif sizes != ref_sizes:
+                    raise ValueError(f'{subj_id}: station sizes of {contrast} differ from the other contrasts.')
+                dtype = np.result_type(*[sitk.GetArrayViewFromImage(im).dtype for im in imgs])
+                img_array = np.empty(layout['shape'], dtype=dtype)
+                zcompose.fill_composed(img_array, (sitk.GetArrayViewFromImage(im) for im in imgs), layout)
+                nii_path = dest_dir.joinpath(f'{subj_str}{contrast}_composed.nii.gz')
+                zcompose.write_nii(img_array, imgs[0], nii_path)
+                if verbose:
+                    print(f'{nii_path}: {img_array.shape[::-1]}')
+                del imgs, img_array
+
+    except Exception as err:
+        print(f'conversion error {subj_id}: {err}\n{traceback.format_exc()}', file=sys.stderr)
+
+
 if __name__ == '__main__':
     """
     python dcm2nii_NAKO_wb_Dixon_zipped.py '/path/to/zip_dir' '/path/to/output_dir' (:dixon) (-v) (:cores)
@@ -279,6 +443,9 @@ if __name__ == '__main__':
     parser.add_argument('out_dir', help='Output directory to store niftis.')
     parser.add_argument('--dixon', action='store_true',
                         help='Dicom directories includes different dixon contrasts.')
+    parser.add_argument('--compose', action='store_true',
+                        help='Compose the dixon stations to whole-body volumes (in memory, requires --dixon).')
+    parser.add_argument('--blend', action='store_true', help='Linear blending of station overlaps (--compose).')
     parser.add_argument('--id', action='store_true')
     parser.add_argument('--cores', type=int, choices=range(1, num_cores+1))
     parser.add_argument('-v', '--verbose', action='store_true')
@@ -289,7 +456,10 @@ if __name__ == '__main__':
     out_dir = Path(args.out_dir)
     
     def process_file(f):
-        if args.dixon:
+        if args.dixon and args.compose:
+            dcm2nii_zipped_dixon_composed(f, out_dir, args.id,
+                                          args.singledir, args.blend, args.verbose)
+        elif args.dixon:
             dcm2nii_zipped_dixon(f, out_dir, args.id,
                                  args.singledir, args.verbose)
         else:
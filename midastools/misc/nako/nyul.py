@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Histogram standardization (Nyúl) for NAKO brain MRI.
+
+Cohort-level alternative to the per-subject FCM normalization in brain.py.
+Training computes percentile landmarks of each image inside the brain mask
+(e.g. created by robex_skull_stripping) in a streaming fashion and fits a
+standard scale. Applying the model is a vectorized piecewise-linear lookup.
+
+Paper: https://doi.org/10.1109/42.836373
+
+Example:
+    Example usage::
+        $ python nyul.py --fit train.csv -m nyul.json --cores 8
+        $ python nyul.py --apply apply.csv -m nyul.json --cores 8
+
+"""
+
+import argparse
+import csv
+import json
+import time
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from joblib import Parallel, delayed
+from midastools.misc.cohort_stats import image_stats, merge_stats
+
+PERCENTILES = (1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 99)
+
+
+def image_landmarks_nii(nii_file, mask_file, percentiles=PERCENTILES, relative_accuracy=0.001):
+    """Percentile landmarks inside the brain mask (streamed slab by slab).
+
+    Args:
+        nii_file (str/Path): image file (nii.gz)
+        mask_file (str/Path): brain mask file (nii.gz), all labels > 0
+        percentiles (tuple): landmark percentiles
+        relative_accuracy (float): relative accuracy of the quantile sketch
+
+    Returns:
+        np.array: landmarks
+    """
+    stats = merge_stats([image_stats(nii_file, mask_file, relative_accuracy=relative_accuracy)])
+    brain = merge_stats([{'brain': s} for s in stats.values()])['brain']
+    landmarks = brain.sketch.quantile(np.array(percentiles)/100)
+    return np.clip(landmarks, brain.min, brain.max)
+
+
+def image_landmarks(volume, mask, percentiles=PERCENTILES):
+    """Percentile landmarks inside the brain mask (in memory, exact).
+
+    Args:
+        volume (np.array): image
+        mask (np.array): brain mask
+        percentiles (tuple): landmark percentiles
+
+    Returns:
+        np.array: landmarks
+    """
+    return np.percentile(volume[mask > 0], percentiles)
+
+
+def fit_standard_scale(landmarks, scale=(1.0, 100.0)):
+    """Fits the standard scale: the first and last landmark of each image are
+    mapped linearly to the scale range, the mapped landmarks are averaged.
+
+    Args:
+        landmarks (np.array): (images, landmarks) array
+        scale (tuple): standard scale range
+
+    Returns:
+        np.array: standard scale landmarks
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    low, high = landmarks[:, :1], landmarks[:, -1:]
+    mapped = scale[0] + (landmarks - low)/np.maximum(high - low, 1e-12)*(scale[1] - scale[0])
+    return mapped.mean(axis=0)
+
+
+def standardize(volume, landmarks, standard_scale, dtype=np.float32, block_size=2**20):
+    """Piecewise-linear mapping of the image landmarks to the standard scale
+    (the first and last segment are extrapolated).
+
+    The mapping is computed block by block in the output dtype, only the
+    output image is allocated at full size.
+
+    Args:
+        volume (np.array): image
+        landmarks (np.array): landmarks of the image
+        standard_scale (np.array): standard scale landmarks
+        dtype: output dtype
+        block_size (int): number of voxels per block
+
+    Returns:
+        np.array: standardized image
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    standard_scale = np.asarray(standard_scale, dtype=np.float64)
+    slopes = (np.diff(standard_scale)/np.maximum(np.diff(landmarks), 1e-12)).astype(dtype)
+    offsets = landmarks[:-1].astype(dtype)
+    values = standard_scale[:-1].astype(dtype)
+    volume = np.asanyarray(volume)
+    # flat views in memory order (C or fortran ordered images)
+    order = 'F' if volume.flags.f_contiguous else 'C'
+    out = np.empty(volume.shape, dtype=dtype, order=order)
+    flat_volume, flat_out = volume.reshape(-1, order=order), out.reshape(-1, order=order)
+    for start in range(0, flat_volume.size, block_size):
+        block = flat_volume[start:start + block_size]
+        segment = np.clip(np.searchsorted(landmarks, block, side='right') - 1, 0, len(slopes) - 1)
+        block_out = flat_out[start:start + block_size]
+        np.subtract(block, offsets[segment], out=block_out, casting='unsafe')
+        block_out *= slopes[segment]
+        block_out += values[segment]
+    return out
+
+
+def fit(jobs, percentiles=PERCENTILES, scale=(1.0, 100.0), num_cores=4):
+    """Computes the landmarks of all training images (process pool) and fits the model.
+
+    Args:
+        jobs (list): (image file, brain mask file) tuples
+        percentiles (tuple): landmark percentiles
+        scale (tuple): standard scale range
+        num_cores (int): number of processes
+
+    Returns:
+        (dict, pd.DataFrame): model, landmark table of the training images
+    """
+    landmarks = Parallel(n_jobs=num_cores)(
+        delayed(image_landmarks_nii)(nii_file, mask_file, percentiles) for nii_file, mask_file in jobs)
+    table = pd.DataFrame(landmarks, columns=[f'p{p:g}' for p in percentiles])
+    table.insert(0, 'image', [str(nii_file) for nii_file, _ in jobs])
+    model = {'percentiles': list(percentiles),
+             'scale': list(scale),
+             'standard_scale': fit_standard_scale(np.array(landmarks), scale).tolist()}
+    return model, table
+
+
+def save_model(model, model_file):
+    with open(str(model_file), 'w') as f:
+        json.dump(model, f, indent=2)
+
+
+def load_model(model_file):
+    with open(str(model_file)) as f:
+        return json.load(f)
+
+
+def standardize_nii(nii_file, mask_file, out_file, model, landmarks=None):
+    """Standardizes a nii image.
+
+    Args:
+        nii_file (str/Path): image file
+        mask_file (str/Path): brain mask file (only needed without landmarks)
+        out_file (str/Path): output file (float32)
+        model (dict): model (see fit)
+        landmarks (np.array): precomputed image landmarks, default: computed (streaming)
+    """
+    if landmarks is None:
+        landmarks = image_landmarks_nii(nii_file, mask_file, model['percentiles'])
+    img = nib.load(str(nii_file))
+    out = standardize(np.asanyarray(img.dataobj), landmarks, model['standard_scale'])
+    out_img = nib.Nifti1Image(out, img.affine, img.header)
+    out_img.set_data_dtype(np.float32)
+    nib.save(out_img, str(out_file))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nyúl histogram standardization (brain mask landmarks).')
+    parser.add_argument('-f', '--fit', help='.csv file with columns image,mask (training)')
+    parser.add_argument('-a', '--apply', help='.csv file with columns image,mask,out')
+    parser.add_argument('-m', '--model', help='model .json file', required=True)
+    parser.add_argument('-l', '--landmarks', help='landmark table .csv of the training images (--fit)')
+    parser.add_argument('--scale', default='1,100', help='standard scale range min,max (--fit)')
+    parser.add_argument('--cores', type=int, default=4, help='number of processes')
+    args = parser.parse_args()
+
+    t = time.time()
+    if args.fit:
+        with open(args.fit, newline='') as f:
+            jobs = [(row['image'], row['mask']) for row in csv.DictReader(f)]
+        print(f'Fitting standard scale on {len(jobs)} images using {args.cores} CPU cores')
+        scale = tuple(float(s) for s in args.scale.split(','))
+        model, table = fit(jobs, scale=scale, num_cores=args.cores)
+        save_model(model, args.model)
+        if args.landmarks:
+            table.to_csv(args.landmarks, index=False)
+        print(f'standard scale: {np.round(model["standard_scale"], 2).tolist()}')
+
+    if args.apply:
+        model = load_model(args.model)
+        with open(args.apply, newline='') as f:
+            jobs = [(row['image'], row['mask'], row['out']) for row in csv.DictReader(f)]
+        print(f'Standardizing {len(jobs)} images using {args.cores} CPU cores')
+        Parallel(n_jobs=args.cores)(
+            delayed(standardize_nii)(nii_file, mask_file, out_file, model)
+            for nii_file, mask_file, out_file in jobs)
+
+    elapsed_time = time.time() - t
+    print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+
+
+if __name__ == '__main__':
+    main()
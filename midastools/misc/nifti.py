@@ -4,52 +4,156 @@ import SimpleITK as sitk
 
 # https://niftynet.readthedocs.io/en/v0.2.2/_modules/niftynet/io/simple_itk_as_nibabel.html
 
+# LPS (itk) <-> RAS (nibabel)
+LPS_TO_RAS = np.diag([-1., -1., 1., 1.])
+
+
+class _ImageBuffer:
+    """
+    Exposes the pixel buffer of a SimpleITK image via the numpy array interface.
+    Arrays created from it reference this object (array.base), which keeps the
+    SimpleITK image (and thus the buffer) alive as long as the array exists.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.__array_interface__ = sitk.GetArrayViewFromImage(image).__array_interface__
+
+
+def image_array_view(image):
+    """Read-only (z, y, x) array view of a SimpleITK image buffer, keeps the image alive."""
+    array = np.asarray(_ImageBuffer(image))
+    array.flags.writeable = False
+    return array
+
+
+class SimpleITKArrayProxy:
+    """
+    Lazy nibabel-style array proxy of a SimpleITK image. The data is
+    exposed in nibabel (x, y, z) axis order as transposed view of the
+    SimpleITK buffer, no pixel data is copied.
+    """
+
+    def __init__(self, image):
+        self._image = image
+        view = sitk.GetArrayViewFromImage(image)
+        self._shape = view.shape[::-1]
+        self._dtype = view.dtype
+
+    @property
+    def is_proxy(self):
+        return True
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def ndim(self):
+        return len(self._shape)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def image(self):
+        return self._image
+
+    def get_unscaled(self):
+        return image_array_view(self._image).T
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.get_unscaled()
+        if dtype is not None and np.dtype(dtype) != array.dtype:
+            return array.astype(dtype)
+        return array.copy() if copy else array
+
+    def __getitem__(self, slicer):
+        return self.get_unscaled()[slicer]
+
 
 class SimpleITKAsNibabel(nibabel.Nifti1Image):
     """
     Minimal interface to use a SimpleITK image as if it were
-    a nibabel object. Currently only supports the subset of the
-    interface used by NiftyNet and is read only
+    a nibabel object. The image data is a lazy proxy (read only view
+    of the SimpleITK buffer), the affine is computed in closed form.
     """
 
     def __init__(self, filename):
-        try:
-            self._SimpleITKImage = sitk.ReadImage(filename)
-        except RuntimeError as err:
-            if 'Unable to determine ImageIO reader' in str(err):
-                raise nibabel.filebasedimages.ImageFileError(str(err))
-            else:
-                raise
-        # self._header = SimpleITKAsNibabelHeader(self._SimpleITKImage)
+        """
+        Args:
+            filename: image file or SimpleITK image
+        """
+        if isinstance(filename, sitk.Image):
+            self._SimpleITKImage = filename
+        else:
+            try:
+                self._SimpleITKImage = sitk.ReadImage(str(filename))
+            except RuntimeError as err:
+                if 'Unable to determine ImageIO reader' in str(err):
+                    raise nibabel.filebasedimages.ImageFileError(str(err))
+                else:
+                    raise
         affine = make_affine(self._SimpleITKImage)
-        # super(SimpleITKAsNibabel, self).__init__(
-        #     sitk.GetArrayFromImage(self._SimpleITKImage).transpose(), affine)
         nibabel.Nifti1Image.__init__(
             self,
-            sitk.GetArrayFromImage(self._SimpleITKImage).transpose(), affine)
+            SimpleITKArrayProxy(self._SimpleITKImage), affine)
 
-
-class SimpleITKAsNibabelHeader(nibabel.spatialimages.SpatialHeader):
-    def __init__(self, image_reference):
-        super(SimpleITKAsNibabelHeader, self).__init__(
-            data_dtype=sitk.GetArrayViewFromImage(image_reference).dtype,
-            shape=sitk.GetArrayViewFromImage(image_reference).shape,
-            zooms=image_reference.GetSpacing())
+    @property
+    def sitk_image(self):
+        return self._SimpleITKImage
 
 
 def make_affine(simpleITKImage):
+    """Closed form RAS affine (nibabel) of an image geometry (sitk image or
+    any object with GetOrigin, GetSpacing and GetDirection), 2d images are
+    embedded in 3d."""
+    ndim = len(simpleITKImage.GetOrigin())
     # get affine transform in LPS
-    c = [simpleITKImage.TransformContinuousIndexToPhysicalPoint(p)
-         for p in ((1, 0, 0),
-                   (0, 1, 0),
-                   (0, 0, 1),
-                   (0, 0, 0))]
-    c = np.array(c)
-    affine = np.concatenate([
-        np.concatenate([c[0:3] - c[3:], c[3:]], axis=0),
-        [[0.], [0.], [0.], [1.]]
-    ], axis=1)
-    affine = np.transpose(affine)
+    affine = np.eye(4)
+    direction = np.array(simpleITKImage.GetDirection(), dtype=float).reshape(ndim, ndim)
+    affine[:ndim, :ndim] = direction*np.array(simpleITKImage.GetSpacing(), dtype=float)
+    affine[:ndim, 3] = simpleITKImage.GetOrigin()
     # convert to RAS to match nibabel
-    affine = np.matmul(np.diag([-1., -1., 1., 1.]), affine)
-    return affine
+    return LPS_TO_RAS @ affine
+
+
+def affine_to_geometry(affine):
+    """Origin, spacing and direction (LPS, sitk convention) of a nibabel affine.
+
+    Args:
+        affine (np.array): 4x4 RAS affine
+
+    Returns:
+        (tuple, tuple, tuple): origin, spacing, direction (row major)
+    """
+    lps = LPS_TO_RAS @ np.asarray(affine, dtype=float)
+    spacing = np.linalg.norm(lps[:3, :3], axis=0)
+    direction = lps[:3, :3]/spacing
+    return tuple(lps[:3, 3]), tuple(spacing), tuple(direction.ravel())
+
+
+def nibabel_to_sitk(nii):
+    """Converts a nibabel image to a SimpleITK image.
+
+    SimpleITK images own their pixel buffer, so the data is copied exactly once
+    (from the on-disk dtype, memory mapped for .nii files without scaling) and
+    the returned image does not depend on the nibabel image. Images created
+    with SimpleITKAsNibabel return the wrapped SimpleITK image (no copy).
+
+    Args:
+        nii: nibabel image (3d)
+
+    Returns:
+        sitk.Image
+    """
+    if isinstance(nii.dataobj, SimpleITKArrayProxy) and np.allclose(nii.affine, make_affine(nii.dataobj.image)):
+        return nii.dataobj.image
+    # (x, y, z) fortran ordered data -> (z, y, x) c ordered view
+    img = sitk.GetImageFromArray(np.asanyarray(nii.dataobj).T)
+    origin, spacing, direction = affine_to_geometry(nii.affine)
+    img.SetOrigin(origin)
+    img.SetSpacing(spacing)
+    img.SetDirection(direction)
+    return img
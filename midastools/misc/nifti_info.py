@@ -1,12 +1,132 @@
-import SimpleITK as sitk
 import argparse
-from pathlib import Path
+import gzip
+import time
+import numpy as np
+import pandas as pd
 import nibabel as nib
+from pathlib import Path
+from joblib import Parallel, delayed
+
+GEOMETRY_FIELDS = ['shape', 'spacing', 'origin', 'direction', 'orientation']
+
+
+def read_nii_header(nii_file):
+    """ Reads only the nifti header (348/540 bytes, streamed out of gzip for .nii.gz).
+
+    Args:
+        nii_file: Path (str/pathlib) to nii file.
+
+    Returns: nib.Nifti1Header or nib.Nifti2Header
+
+    """
+    opener = gzip.open if str(nii_file).endswith('.gz') else open
+    with opener(str(nii_file), 'rb') as f:
+        binaryblock = f.read(540)
+    # sizeof_hdr (348: nifti1, 540: nifti2) in either byte order
+    sizeof_hdr = {int.from_bytes(binaryblock[:4], order) for order in ('little', 'big')}
+    header_class = nib.Nifti2Header if 540 in sizeof_hdr else nib.Nifti1Header
+    return header_class(binaryblock[:header_class.template_dtype.itemsize], check=False)
+
+
+def header_info(header):
+    """ Geometry of a nifti header in sitk (LPS) convention.
+
+    Args:
+        header: nibabel nifti header
+
+    Returns: dict with dtype, shape, spacing, origin, direction, orientation
+
+    """
+    affine = header.get_best_affine()
+    ndim = min(len(header.get_data_shape()), 3)
+    # RAS -> LPS
+    lps = np.diag([-1.0, -1.0, 1.0]) @ affine[:3, :3]
+    spacing = np.linalg.norm(lps, axis=0)
+    direction = lps/np.where(spacing > 0, spacing, 1.0)
+    origin = np.diag([-1.0, -1.0, 1.0]) @ affine[:3, 3]
+    return {'dtype': str(header.get_data_dtype()),
+            'shape': tuple(int(s) for s in header.get_data_shape()),
+            'spacing': tuple(np.round(spacing[:ndim], 6).tolist()),
+            'origin': tuple(np.round(origin[:ndim], 4).tolist()),
+            'direction': tuple(np.round(direction[:ndim, :ndim].ravel(), 6).tolist()),
+            'orientation': ''.join(nib.aff2axcodes(affine))}
+
+
+def nii_info(nii_file):
+    """ Header information of a nii file, errors are reported in the 'error' field.
+
+    Args:
+        nii_file: Path (str/pathlib) to nii file.
+
+    Returns: dict (path, dtype, shape, spacing, origin, direction, orientation, error)
+
+    """
+    info = {'path': str(nii_file)}
+    try:
+        info.update(header_info(read_nii_header(nii_file)))
+        info['error'] = ''
+    except Exception as e:
+        info['error'] = str(e)
+    return info
+
+
+def check_consistency(table, tol=1e-3):
+    """ Flags geometry inconsistencies between files of the same subject.
+
+    Each file is compared with the first (readable) file of its subject (e.g. mask vs image).
+    Files without subject ('', e.g. directly under the scanned directory) are not compared.
+
+    Args:
+        table: DataFrame with 'subject' column and geometry columns.
+        tol: absolute tolerance for spacing, origin and direction.
+
+    Returns: DataFrame with additional 'inconsistent' column (names of the differing fields).
+
+    """
+    def differs(a, b, field):
+        if field in ('orientation', 'shape'):
+            return a[:3] != b[:3]
+        return len(a) != len(b) or not np.allclose(a, b, atol=tol)
+
+    inconsistent = {idx: '' for idx in table.index}
+    valid = table[(table['error'] == '') & (table['subject'] != '')]
+    for _, group in valid.groupby('subject', sort=False):
+        ref = group.iloc[0]
+        for idx, row in group.iterrows():
+            inconsistent[idx] = ','.join(field for field in GEOMETRY_FIELDS
+                                         if differs(row[field], ref[field], field))
+    table['inconsistent'] = pd.Series(inconsistent)
+    return table
+
+
+def scan_nii(root_dir, pattern='**/*.nii*', subject_level=0, num_cores=4, tol=1e-3):
+    """ Scans a directory tree for nifti files (headers only) using a process pool.
+
+    Args:
+        root_dir: root directory.
+        pattern: glob pattern of the nifti files.
+        subject_level: index of the (relative) path component with the subject id
+            (files above this level have no subject and are not checked).
+        num_cores: number of processes.
+        tol: tolerance of the consistency check.
+
+    Returns: DataFrame with one row per file.
+
+    """
+    root_dir = Path(root_dir)
+    nii_files = sorted(f for f in root_dir.glob(pattern) if f.is_file())
+    infos = Parallel(n_jobs=num_cores, batch_size=64)(delayed(nii_info)(f) for f in nii_files)
+    table = pd.DataFrame(infos, columns=['path', 'dtype'] + GEOMETRY_FIELDS + ['error'])
+    parts = [f.relative_to(root_dir).parts for f in nii_files]
+    table.insert(1, 'subject', [p[subject_level] if len(p) > subject_level + 1 else '' for p in parts])
+    return check_consistency(table, tol)
+
 
-# todo orientation
 def main():
-    """ Shows basic information for nifti files.
-    (Size, Spacing, Origin, Direction)
+    """ Shows basic information for nifti files (header only).
+    (Size, Spacing, Origin, Direction, Orientation)
+
+    A directory is scanned recursively and written as table (.csv).
 
     Returns:
 
@@ -14,19 +134,33 @@ def main():
 
     # Parse arguments.
     parser = argparse.ArgumentParser()
-    parser.add_argument('nii', help='.nii file')
+    parser.add_argument('nii', help='.nii file (or directory to scan)')
     parser.add_argument('-m', '--multiline', action="store_true", help="multi line output")
     parser.add_argument('-s', '--short', action="store_true", help="short output (size, spacing)")
+    parser.add_argument('-o', '--output', help="output table .csv (directory scan)")
+    parser.add_argument('-p', '--pattern', default='**/*.nii*', help="glob pattern (directory scan)")
+    parser.add_argument('-l', '--subject-level', type=int, default=0,
+                        help="path component (relative to the directory) with the subject id")
+    parser.add_argument('--cores', type=int, default=4, help="number of processes (directory scan)")
     args = parser.parse_args()
     nii_file = args.nii
 
-    # Load nii file.
-    reader = sitk.ImageFileReader()
-    reader.SetImageIO('NiftiImageIO')
-    reader.SetFileName(str(nii_file))
-    img = reader.Execute()
-    affine = nib.load(nii_file).affine
-    
+    if Path(nii_file).is_dir():
+        t = time.time()
+        table = scan_nii(nii_file, args.pattern, args.subject_level, args.cores)
+        elapsed_time = time.time() - t
+        print(f'{len(table)} files, {(table["error"] != "").sum()} errors, '
+              f'{(table["inconsistent"] != "").sum()} inconsistent, '
+              f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+        if args.output:
+            table.to_csv(args.output, index=False)
+        else:
+            print(table[table['inconsistent'] != ''].to_string())
+        return
+
+    # Read nii header.
+    info = header_info(read_nii_header(nii_file))
+
     sep = ''
 
     if args.multiline:
@@ -34,17 +168,17 @@ def main():
 
     if args.short:
         template = ' Size: {}{} Spacing: {}{} Orientation: {}'
-        print(template.format(img.GetSize(), sep,
-                              img.GetSpacing(), sep,
-                              nib.aff2axcodes(affine)))
+        print(template.format(info['shape'], sep,
+                              info['spacing'], sep,
+                              tuple(info['orientation'])))
 
     else:
         template = ' Size: {}{} Spacing: {}{} Origin: {}{} Direction: {}{} Orientation: {}'
-        print(template.format(img.GetSize(), sep,
-                              img.GetSpacing(), sep,
-                              img.GetOrigin(), sep,
-                              img.GetDirection(), sep,
-                              nib.aff2axcodes(affine)))
+        print(template.format(info['shape'], sep,
+                              info['spacing'], sep,
+                              info['origin'], sep,
+                              info['direction'], sep,
+                              tuple(info['orientation'])))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,48 +1,224 @@
 import argparse
+import time
 import numpy as np
 import nibabel as nib
+import SimpleITK as sitk
 from pathlib import Path
+from joblib import Parallel, delayed
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import array_to_file, apply_read_scaling
 from nibabel.orientations import ornt_transform, axcodes2ornt, inv_ornt_aff, apply_orientation, io_orientation, aff2axcodes
+from midastools.misc.nifti import make_affine, affine_to_geometry
+from midastools.misc import imcache
 
 
 def reorient_nii_file(input_file,
                     output_file,
-                    target_orientation = ('L', 'A', 'S')):
+                    target_orientation = ('L', 'A', 'S'),
+                    verbose=True,
+                    cache=False):
     input_file = Path(input_file)
     output_file = Path(output_file)
-    print('reorient nifti files ...')
-    print(f'{input_file.name} -> {output_file.name}')
-    img = nib.load(str(input_file))
-    new_img = reorient_nii(img, target_orientation)
-    nib.save(new_img, str(output_file))
+    if verbose:
+        print('reorient nifti files ...')
+        print(f'{input_file.name} -> {output_file.name}')
+    if cache:
+        # read-only view of the cached image (scaling applied by SimpleITK)
+        img = imcache.load_nii(input_file)
+    else:
+        # memory mapped for uncompressed .nii files
+        img = nib.load(str(input_file), mmap='r')
+    raw_array, header = reorient_raw(img, target_orientation)
+    write_raw_nii(raw_array, header, output_file)
 
-def reorient_nii(img,
+def reorient_raw(img,
                  target_orientation=('L', 'A', 'S'),
                  verbose=False):
-    new_ornt = axcodes2ornt(target_orientation)
-    vox_array = img.get_fdata()
+    """Reorients the unscaled on-disk data of a nifti image.
+
+    No voxel data is copied: the reoriented array is a flip/transpose view
+    of the (memory mapped) on-disk array, the scaling (scl_slope, scl_inter)
+    and the data type are kept in the returned header.
+
+    Args:
+        img (nib.Nifti1Image): input image
+        target_orientation (tuple): target axis codes
+        verbose (bool): print orientation change
+
+    Returns:
+        (np.array, nib.Nifti1Header): reoriented unscaled array (view), header
+    """
+    # the loaded header has no scaling, it is stored in the array proxy
+    slope, inter = None, None
+    if nib.is_proxy(img.dataobj):
+        raw_array = img.dataobj.get_unscaled()
+        # SimpleITK backed proxies (SimpleITKAsNibabel) hold scaled data
+        slope, inter = getattr(img.dataobj, 'slope', None), getattr(img.dataobj, 'inter', None)
+    else:
+        raw_array = np.asanyarray(img.dataobj)
     affine = img.affine
-    orig_ornt = io_orientation(img.affine)
-    ornt_trans = ornt_transform(orig_ornt, new_ornt)
-    orig_shape = vox_array.shape
-    new_vox_array = apply_orientation(vox_array, ornt_trans)
-    aff_trans = inv_ornt_aff(ornt_trans, orig_shape)
-    new_affine = np.dot(affine, aff_trans)
+    ornt_trans = ornt_transform(io_orientation(affine), axcodes2ornt(target_orientation))
+    new_raw_array = apply_orientation(raw_array, ornt_trans)
+    new_affine = np.dot(affine, inv_ornt_aff(ornt_trans, raw_array.shape))
     if verbose:
         print(f'{aff2axcodes(affine)} -> {aff2axcodes(new_affine)}')
-    new_img = nib.Nifti1Image(new_vox_array, new_affine, img.header)
+
+    header = img.header.copy()
+    header.set_data_shape(new_raw_array.shape)
+    header.set_data_dtype(raw_array.dtype)
+    header.set_qform(new_affine)
+    header.set_sform(new_affine)
+    if slope is not None:
+        header.set_slope_inter(slope, inter)
+    return new_raw_array, header
+
+def write_raw_nii(raw_array, header, output_file):
+    """Writes unscaled data with a given header (.nii or .nii.gz).
+
+    The data is streamed in fortran order slab by slab, the scaling of the
+    header is kept as is.
+
+    Args:
+        raw_array (np.array): unscaled data (any memory layout, e.g. a view)
+        header (nib.Nifti1Header): header with shape, dtype and scaling
+        output_file (str/Path): output file
+    """
+    header = header.copy()
+    header.set_data_offset(max(header.get_data_offset(), 352 + header.extensions.get_sizeondisk()))
+    with ImageOpener(str(output_file), 'wb') as f:
+        header.write_to(f)
+        array_to_file(raw_array, f, raw_array.dtype, offset=header.get_data_offset(), order='F')
+
+class ScaledArrayProxy:
+    """
+    Lazy nibabel-style array proxy of unscaled data (e.g. the reoriented view
+    of reorient_raw) with nifti scaling. The scaled data is only computed on
+    access, in the requested dtype.
+    """
+
+    def __init__(self, raw_array, slope=None, inter=None):
+        self._raw_array = raw_array
+        self.slope = 1.0 if slope is None else float(slope)
+        self.inter = 0.0 if inter is None else float(inter)
+
+    @property
+    def is_proxy(self):
+        return True
+
+    @property
+    def shape(self):
+        return self._raw_array.shape
+
+    @property
+    def ndim(self):
+        return self._raw_array.ndim
+
+    @property
+    def dtype(self):
+        return self._raw_array.dtype
+
+    def get_unscaled(self):
+        return self._raw_array
+
+    def _scaled(self, raw_array, dtype=None):
+        if dtype is None:
+            return apply_read_scaling(raw_array, self.slope, self.inter)
+        array = np.array(raw_array, dtype=dtype)
+        if self.slope != 1.0:
+            array *= array.dtype.type(self.slope)
+        if self.inter != 0.0:
+            array += array.dtype.type(self.inter)
+        return array
+
+    def __array__(self, dtype=None, copy=None):
+        array = self._scaled(self._raw_array, dtype)
+        return array.copy() if copy and array is self._raw_array else array
+
+    def __getitem__(self, slicer):
+        return self._scaled(self._raw_array[slicer])
+
+def reorient_nii(img,
+                 target_orientation=('L', 'A', 'S'),
+                 verbose=False):
+    # dtype preserving (no float64 copy): the data is a lazy proxy of the
+    # reoriented unscaled view, the scaling is only applied on access
+    raw_array, header = reorient_raw(img, target_orientation, verbose)
+    new_img = nib.Nifti1Image(ScaledArrayProxy(raw_array, *header.get_slope_inter()),
+                              header.get_best_affine(), header)
     return new_img
 
+def reorient_sitk(img,
+                  target_orientation=('L', 'A', 'S')):
+    """Reorients a sitk image (axis permutation and flips only, as reorient_nii).
+
+    Args:
+        img (sitk.Image): input image (3d)
+        target_orientation (tuple): target axis codes (nibabel convention)
+
+    Returns:
+        sitk.Image: reoriented image (the input image, if already in the target orientation)
+    """
+    affine = make_affine(img)
+    ornt_trans = ornt_transform(io_orientation(affine), axcodes2ornt(target_orientation))
+    if np.array_equal(ornt_trans, axcodes2ornt(('R', 'A', 'S'))):
+        return img
+    # sitk arrays are (z, y, x), nibabel orientations (x, y, z)
+    new_array = apply_orientation(sitk.GetArrayViewFromImage(img).T, ornt_trans).T
+    new_affine = np.dot(affine, inv_ornt_aff(ornt_trans, img.GetSize()))
+    new_img = sitk.GetImageFromArray(new_array)
+    origin, spacing, direction = affine_to_geometry(new_affine)
+    new_img.SetOrigin(origin)
+    new_img.SetSpacing(spacing)
+    new_img.SetDirection(direction)
+    return new_img
+
+def reorient_dir(input_dir,
+                 output_dir,
+                 target_orientation=('L', 'A', 'S'),
+                 pattern='**/*.nii*',
+                 num_cores=4,
+                 overwrite=False):
+    """Reorients all nifti files of a directory tree (subdirectory structure is kept).
+
+    Args:
+        input_dir (str/Path): input directory
+        output_dir (str/Path): output directory
+        target_orientation (tuple): target axis codes
+        pattern (str): glob pattern of the nifti files
+        num_cores (int): number of processes
+        overwrite (bool): overwrite existing output files
+    """
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+    jobs = []
+    for f in sorted(input_dir.glob(pattern)):
+        out_file = output_dir.joinpath(f.relative_to(input_dir))
+        if overwrite or not out_file.exists():
+            out_file.parent.mkdir(parents=True, exist_ok=True)
+            jobs.append((f, out_file))
+    print(f'reorient {len(jobs)} nifti files using {num_cores} CPU cores')
+
+    t = time.time()
+    Parallel(n_jobs=num_cores)(
+        delayed(reorient_nii_file)(f, out_file, target_orientation, False) for f, out_file in jobs)
+    elapsed_time = time.time() - t
+    print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+
 def main():
     # reorient nifti files to LAS coordinate system
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', help="input nii file", required=True)
-    parser.add_argument('-o', '--output',  help="output nii file", required=True)
+    parser.add_argument('-i', '--input', help="input nii file (or directory for batch mode)", required=True)
+    parser.add_argument('-o', '--output',  help="output nii file (or directory for batch mode)", required=True)
     parser.add_argument('-t', '--orientation', help="target orientation", required=True)
+    parser.add_argument('-p', '--pattern', help="glob pattern (batch mode)", default='**/*.nii*')
+    parser.add_argument('--cores', type=int, default=4, help="number of processes (batch mode)")
+    parser.add_argument('--overwrite', action='store_true', help="overwrite existing files (batch mode)")
     args = parser.parse_args()
 
     args.orientation = tuple([c for c in args.orientation])
-    reorient_nii_file(args.input, args.output, args.orientation)
+    if Path(args.input).is_dir():
+        reorient_dir(args.input, args.output, args.orientation, args.pattern, args.cores, args.overwrite)
+    else:
+        reorient_nii_file(args.input, args.output, args.orientation)
 
 if __name__ == '__main__':
     main()
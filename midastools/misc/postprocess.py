@@ -0,0 +1,181 @@
+import SimpleITK as sitk
+import argparse
+import ast
+import time
+from pathlib import Path
+from joblib import Parallel, delayed
+from midastools.misc import fillholes, lcomp, smoothing
+
+# Available mask operations: function(mask, spacing, **params) -> mask
+# (spacing in array axis order).
+OPERATIONS = {
+    'fillholes': lambda mask, spacing, **params: fillholes.fillholes(mask, **params),
+    'lcomp': lambda mask, spacing, **params: lcomp.lcomp(mask, **params),
+    'smooth': lambda mask, spacing, **params: smoothing.smooth_img(mask, spacing=spacing, **params),
+    'smooth_volume': lambda mask, spacing, **params: smoothing.smooth_volume(mask, spacing=spacing, **params),
+}
+
+
+def parse_operation(op_str):
+    """Parses an operation string 'name:key=value,key=value'.
+
+    Values are parsed as python literals, otherwise kept as strings.
+
+    Args:
+        op_str (str): operation string, e.g. 'lcomp:top_k=2,min_size=10'
+
+    Returns:
+        (str, dict): operation name and parameters
+    """
+    name, _, param_str = op_str.partition(':')
+    if name not in OPERATIONS:
+        raise ValueError(f'Unknown operation {name}, choose from {list(OPERATIONS)}.')
+    params = {}
+    for item in filter(None, param_str.split(',')):
+        key, _, value = item.partition('=')
+        try:
+            params[key.strip()] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            params[key.strip()] = value.strip()
+    return name, params
+
+
+def postprocess(mask, operations, spacing=(1.0, 1.0, 1.0), verbose=False):
+    """Applies a chain of mask operations in memory.
+
+    Args:
+        mask (np.array): input mask
+        operations (list): ordered list of (name, params) tuples
+        spacing (tuple, optional): voxel spacing (array axis order). Defaults to (1.0, 1.0, 1.0).
+        verbose (bool, optional): print operations. Defaults to False.
+
+    Returns:
+        np.array: processed mask
+    """
+    for name, params in operations:
+        if verbose:
+            print(f'{name} {params}')
+        mask = OPERATIONS[name](mask, spacing, **params)
+    return mask
+
+
+def postprocess_nii(nii_file, out_file, operations, verbose=False):
+    """Applies a chain of mask operations to a nii file.
+
+    The file is read once and written once, the mask stays in memory
+    through the whole chain.
+
+    Args:
+        nii_file (str/Path): input nii mask file
+        out_file (str/Path): output nii file
+        operations (list): ordered list of (name, params) tuples
+        verbose (bool, optional): print operations. Defaults to False.
+    """
+    mask = sitk.ReadImage(str(nii_file))
+    result = postprocess(sitk.GetArrayFromImage(mask), operations,
+                         spacing=mask.GetSpacing()[::-1], verbose=verbose)
+
+    result = sitk.GetImageFromArray(result)
+    result.CopyInformation(mask)
+
+    if verbose:
+        print('Writing output to :', out_file)
+    sitk.WriteImage(result, str(out_file))
+
+
+def postprocess_batch(nii_files, out_files, operations, num_cores=4, verbose=False):
+    """Applies a chain of mask operations to many nii files using a process pool.
+
+    Args:
+        nii_files (list): input nii mask files
+        out_files (list): output nii files
+        operations (list): ordered list of (name, params) tuples
+        num_cores (int, optional): number of processes. Defaults to 4.
+        verbose (bool, optional): print progress. Defaults to False.
+    """
+    t = time.time()
+    Parallel(n_jobs=num_cores)(
+        delayed(postprocess_nii)(nii_file, out_file, operations, verbose)
+        for nii_file, out_file in zip(nii_files, out_files))
+    elapsed_time = time.time() - t
+    print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+
+
+def batch_files(pattern, out_dir=None, praefix=None):
+    """Input and output files of a glob pattern (batch mode).
+
+    Without output directory the results are written next to the inputs
+    (praefix + file name). With output directory the subdirectory structure
+    below the fixed part of the pattern is kept (praefix + file name if given).
+
+    Args:
+        pattern (str): glob pattern of the input files, e.g. /data/*/mask.nii.gz
+        out_dir (str/Path, optional): output directory. Defaults to None.
+        praefix (str, optional): praefix of the output file names. Defaults to 'pp_'
+            without output directory, no praefix otherwise.
+
+    Returns:
+        (list, list): input files, output files
+    """
+    pattern = Path(pattern)
+    anchor = Path(pattern.anchor) if pattern.is_absolute() else Path('.')
+    nii_files = sorted(anchor.glob(str(pattern.relative_to(anchor))))
+    if out_dir is None:
+        praefix = praefix or 'pp_'
+        return nii_files, [f.parent.joinpath(praefix + f.name) for f in nii_files]
+
+    # fixed (wildcard free) leading part of the pattern
+    base_dir = anchor
+    for part in pattern.relative_to(anchor).parts[:-1]:
+        if any(c in part for c in '*?['):
+            break
+        base_dir = base_dir.joinpath(part)
+    praefix = praefix or ''
+    out_files = []
+    for f in nii_files:
+        relative = f.relative_to(base_dir)
+        out_files.append(Path(out_dir).joinpath(relative.parent, praefix + relative.name))
+    return nii_files, out_files
+
+
+def main():
+    # Commandline argument parsing.
+    parser = argparse.ArgumentParser(description='Mask post-processing chain (e.g. fillholes -> lcomp -> smooth)')
+    parser.add_argument('nii_input', help='Input .nii file (or glob pattern with --batch)')
+    parser.add_argument('-c', '--Operation', action='append', required=True,
+                        help=f'Operation {list(OPERATIONS)} with parameters, e.g. lcomp:top_k=2 '
+                             '(repeat for a chain, applied in the given order)')
+    parser.add_argument('-p', '--Praefix', help='Praefix for output filename')
+    parser.add_argument('-o', '--Output', help='Output .nii file (output directory with --batch)')
+    parser.add_argument('-b', '--batch', action='store_true', help='nii_input is a glob pattern')
+    parser.add_argument('--cores', type=int, default=4, help='number of processes (batch mode)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    operations = [parse_operation(op) for op in args.Operation]
+
+    if args.batch:
+        nii_files, out_files = batch_files(args.nii_input, args.Output, args.Praefix)
+        for out_file in out_files:
+            out_file.parent.mkdir(parents=True, exist_ok=True)
+        print(f'Post-processing {len(nii_files)} files using {args.cores} CPU cores')
+        postprocess_batch(nii_files, out_files, operations, args.cores, args.verbose)
+        return
+
+    praefix = 'pp_'
+    if args.Praefix:
+        praefix = args.Praefix
+
+    nii_file = Path(args.nii_input)
+    print('Post-processing mask, nii image : ', str(nii_file))
+
+    # If outpath is not set, use praefix and input filepath.
+    outpath = args.Output
+    if not outpath:
+        outpath = nii_file.parent.joinpath(praefix + nii_file.name)
+
+    postprocess_nii(nii_file, outpath, operations, args.verbose)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,17 +3,22 @@ import json
 import argparse
 import numpy as np
 from pathlib import Path
+from midastools.misc.dcm_geometry import DicomSeriesGeometry
+from midastools.misc import imcache
 
 
-def load_image_data(filepath):
+def load_image_data(filepath, cache=False):
     """ Loads nii file into sitk image object.
 
     Args:
         filepath: Path (str/pathlib) to nii file.
+        cache: Use the process-local image cache (misc.imcache).
 
     Returns: sitk image
 
     """
+    if cache:
+        return imcache.load_image(filepath)
     reader = sitk.ImageFileReader()
     reader.SetImageIO('NiftiImageIO')
     reader.SetFileName(str(filepath))
@@ -21,15 +26,18 @@ def load_image_data(filepath):
     return img
 
 
-def load_dcm_data(dirpath):
+def load_dcm_data(dirpath, header_only=False):
     """ Reads dicom directory into sitk image object.
 
     Args:
         dirpath: dicom directory path
+        header_only: Only read the geometry from the slice headers (no pixel data).
 
-    Returns: sitk image
+    Returns: sitk image (DicomSeriesGeometry if header_only)
 
     """
+    if header_only:
+        return DicomSeriesGeometry(dirpath)
     reader = sitk.ImageSeriesReader()
     dicom_names = reader.GetGDCMSeriesFileNames(dirpath)
     reader.SetFileNames(dicom_names)
@@ -1,4 +1,6 @@
 from midastools.vtk import vtk_conversion, vtk_mesh
+from midastools.misc import imcache
+from scipy import ndimage
 import SimpleITK as sitk
 import numpy as np
 import argparse
@@ -6,59 +8,153 @@ from pathlib import Path
 
 
 def smooth_img(volume,
-               smooth_filter='sinc',
+               smooth_filter='laplacian',
                smooth_iter=40,
-               relaxation=0.2):
+               relaxation=0.2,
+               spacing=(1.0, 1.0, 1.0)):
     """Smooths mask volume.
 
+    All labels are meshed in a single marching cubes pass, smoothed and
+    voxelized back with their label value.
+
     Args:
         volume (np.array): mask volume
-        smooth_filter: 'sinc' oder 'laplacian'
+        smooth_filter: 'laplacian' oder 'sinc' (earlier versions always used 'laplacian')
         smooth_iter: laplacian smoothing parameters
         relaxation: laplacian smoothing parameters
+        spacing: voxel spacing (volume axis order)
 
-    Returns: sitk image
+    Returns: np.array (uint8, input dtype for labels > 255)
 
     """
+    label_values = np.flatnonzero(np.bincount(volume.astype(np.int64).ravel()))
+    label_values = [int(v) for v in label_values if v != 0]
+
     vtk_data = vtk_conversion.np_to_vtk_data(volume)
     vtk_image = vtk_conversion.vtk_data_to_image(vtk_data, 
                                                 origin=(0,0,0), 
                                                 dims=volume.shape,
-                                                spacing=(1.0, 1.0, 1.0))
+                                                spacing=spacing)
+
+    vtk_polys = vtk_mesh.marching_cube_labels(vtk_image,
+                                              label_values=label_values,
+                                              smooth_filter=smooth_filter,
+                                              smooth_itr=smooth_iter,
+                                              relaxation=relaxation)
+
+    # labels > 255 keep the input dtype
+    result = np.zeros(volume.shape, dtype=np.uint8 if max(label_values, default=0) <= 255 else volume.dtype)
+    for label_value, vtk_poly in vtk_polys.items():
+        if vtk_poly.GetNumberOfPolys() == 0:
+            continue
+        # Voxelize inside the bounding box of the smoothed label mesh only.
+        bounds = np.array(vtk_poly.GetBounds()).reshape(3, 2)
+        bbox = tuple(slice(max(int(np.floor(lo / sp)) - 1, 0), min(int(np.ceil(hi / sp)) + 2, size))
+                     for (lo, hi), sp, size in zip(bounds, spacing, volume.shape))
+        label_img = vtk_conversion.poly_to_img(vtk_poly,
+                                               origin=[sl.start * sp for sl, sp in zip(bbox, spacing)],
+                                               dim=[sl.stop - sl.start for sl in bbox],
+                                               spacing=spacing)
+        label_img = vtk_conversion.vtk_to_numpy_image(label_img)
+        box_result = result[bbox]
+        box_result[(label_img > 0) & (box_result == 0)] = label_value
+    return result
 
-    vtk_poly = vtk_mesh.marching_cube(vtk_image)
-    vtk_poly = vtk_mesh.smooth(vtk_poly, smooth_filter='laplacian')
 
-    result = vtk_conversion.poly_to_img(vtk_poly,
-                                        origin=(0, 0, 0), 
-                                        dim=volume.shape,
-                                        spacing=(1.0, 1.0, 1.0))
+def smooth_volume(volume,
+                  sigma=1.0,
+                  spacing=(1.0, 1.0, 1.0),
+                  method='sdf'):
+    """Smooths (multi-label) mask volume without mesh round-trip.
+
+    Each label is smoothed inside its bounding box: Gaussian smoothing of
+    the signed distance map ('sdf') or of the anti-aliased mask ('gaussian')
+    and thresholding back to the label. Voxels claimed by several labels
+    go to the label with the highest smoothed score.
+
+    Args:
+        volume (np.array): mask volume
+        sigma (float): Gaussian sigma in physical units (mm)
+        spacing: voxel spacing (volume axis order)
+        method: 'sdf' or 'gaussian'
+
+    Returns: np.array, smoothed mask (volume dtype)
+
+    """
+    if method not in ('sdf', 'gaussian'):
+        raise ValueError(f'The smoothing method {method} is not supported.')
+
+    spacing = np.asarray(spacing, dtype=float)
+    sigma_vox = sigma / spacing
+    margin = np.ceil(3 * sigma_vox).astype(int) + 1
+    label_mask = volume.astype(np.int64) if volume.dtype.kind not in 'iu' else volume
+
+    result = np.zeros_like(volume)
+    score = {}
+    for idx, bbox in enumerate(ndimage.find_objects(label_mask), 1):
+        if bbox is None:
+            continue
+        bbox = tuple(slice(max(sl.start - m, 0), min(sl.stop + m, size))
+                     for sl, m, size in zip(bbox, margin, volume.shape))
+        mask = (label_mask[bbox] == idx)
+
+        if method == 'sdf':
+            dist = (ndimage.distance_transform_edt(~mask, sampling=spacing) -
+                    ndimage.distance_transform_edt(mask, sampling=spacing)).astype(np.float32)
+            label_score = -ndimage.gaussian_filter(dist, sigma_vox, mode='nearest')
+        else:
+            label_score = ndimage.gaussian_filter(mask.astype(np.float32), sigma_vox, mode='constant') - 0.5
+
+        # Resolve overlaps with previously processed labels.
+        inside = label_score > 0
+        box_result = result[bbox]
+        for other, (other_box, other_score) in score.items():
+            overlap = tuple(slice(max(a.start, b.start), min(a.stop, b.stop)) for a, b in zip(bbox, other_box))
+            if any(sl.start >= sl.stop for sl in overlap):
+                continue
+            local = tuple(slice(sl.start - b.start, sl.stop - b.start) for sl, b in zip(overlap, bbox))
+            other_local = tuple(slice(sl.start - b.start, sl.stop - b.start) for sl, b in zip(overlap, other_box))
+            lost = (result[overlap] == other) & (other_score[other_local] >= label_score[local])
+            inside[local] &= ~lost
+
+        box_result[inside] = idx
+        score[idx] = (bbox, label_score)
 
-    result = vtk_conversion.vtk_to_numpy_image(result)
     return result
 
 
 def smooth_nii(nii_file,
                out_file,
-               smooth_filter='sinc',
+               smooth_filter='laplacian',
                smooth_iter=40,
-               relaxation=0.2):
+               relaxation=0.2,
+               mode='mesh',
+               sigma=1.0,
+               cache=False):
     """Smooths input nii file and saves the smoothed volume.
     
     Args:
         nii_file (str/Path): input nii mask file
         outpath (str/Path): output path to save modified file
-        smooth_filter: 'sinc' oder 'laplacian'
+        smooth_filter: 'laplacian' oder 'sinc' (earlier versions always used 'laplacian')
         smooth_iter: laplacian smoothing parameters
         relaxation: laplacian smoothing parameters
+        mode: 'mesh' (surface smoothing) or 'volume' (see smooth_volume)
+        sigma: Gaussian sigma (mm), volume mode only
+        cache: read the mask through the process-local image cache
     """
-    img = sitk.ReadImage(str(nii_file))
+    img = imcache.load_image(nii_file) if cache else sitk.ReadImage(str(nii_file))
     volume = sitk.GetArrayFromImage(img)
-   
-    result = smooth_img(volume,
-                        smooth_filter='sinc',
-                        smooth_iter=40,
-                        relaxation=0.2)
+    spacing = img.GetSpacing()[::-1]
+
+    if mode == 'volume':
+        result = smooth_volume(volume, sigma=sigma, spacing=spacing)
+    else:
+        result = smooth_img(volume,
+                            smooth_filter=smooth_filter,
+                            smooth_iter=smooth_iter,
+                            relaxation=relaxation,
+                            spacing=spacing)
 
     img_result = sitk.GetImageFromArray(result)
     img_result.SetDirection(img.GetDirection())
@@ -80,6 +176,9 @@ def main():
 
     parser.add_argument('--smooth_iter', help='laplacian smoothing iterations', type=int)
     parser.add_argument('--relaxation', help='laplacian smoothing relaxation', type=float)
+    parser.add_argument('-m', '--Mode', help='mesh smoothing or volumetric (fast, multi-label) smoothing',
+                        choices={'mesh', 'volume'}, default='mesh')
+    parser.add_argument('-s', '--Sigma', help='Gaussian sigma in mm (volume mode)', type=float, default=1.0)
     args = parser.parse_args()
 
     nii_file = Path(args.nii_input)
@@ -93,7 +192,7 @@ def main():
             praefix = args.Praefix
         out_file = nii_file.parent.joinpath(praefix + nii_file.name)
 
-    smooth_filter = 'sinc'
+    smooth_filter = 'laplacian'
     if args.Filter:
         smooth_filter = args.Filter
 
@@ -105,7 +204,8 @@ def main():
     if args.relaxation:
         relaxation = args.relaxation
 
-    smooth_nii(nii_file, out_file, smooth_filter, smooth_iter, relaxation)
+    smooth_nii(nii_file, out_file, smooth_filter, smooth_iter, relaxation,
+               mode=args.Mode, sigma=args.Sigma)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,10 @@
 from tifffile import imread # requires the package 'imagecodecs'
 import SimpleITK as sitk
-import sys
+import argparse
+import csv
+import time
+from joblib import Parallel, delayed
+from midastools.misc.dcm_geometry import DicomSeriesGeometry, copy_geometry
 
 
 
@@ -16,20 +20,82 @@ def load_dcm_data(dirpath):
     return reader.Execute()
 
 
+def load_dcm_geometry(dirpath):
+    """ Reads the geometry of a dicom directory (slice headers only, no pixel data).
+    Args:
+        dirpath: dicom directory path
+    Returns: DicomSeriesGeometry (size, origin, spacing, direction)
+    """
+    return DicomSeriesGeometry(dirpath)
 
-def main(tif_path, dcm_path, out_path):
+
+def convert(tif_path, dcm_path, out_path, geometry=None):
+    """ reads .tif (Mevis labelmap format) file and exports the respective .nii.gz file
+    requires the original DICOM data set (only the headers are read)
+    tif_path: e.g. /path/labelmask.tif
+    dcm_path: e.g. /path/dcm/
+    out_path: e.g. /path/labelmask.nii.gz
+    geometry: precomputed DicomSeriesGeometry of dcm_path (optional)
+    """
+    labelmask = imread(str(tif_path))
+    if geometry is None:
+        geometry = load_dcm_geometry(str(dcm_path))
+    mask_img = sitk.GetImageFromArray(labelmask)
+    copy_geometry(mask_img, geometry)
+    sitk.WriteImage(mask_img, str(out_path))
+
+
+def convert_batch(jobs, num_cores=4, verbose=False):
+    """ converts many MeVis labelmaps concurrently
+    jobs: list of (tif_path, dcm_path, out_path) tuples
+    num_cores: number of processes
+    verbose: print progress
+    """
+    def process_job(tif_path, dcm_path, out_path):
+        try:
+            convert(tif_path, dcm_path, out_path)
+            if verbose:
+                print(f'{tif_path} -> {out_path}')
+        except Exception as e:
+            print(f'conversion error {tif_path}: {e}')
+
+    t = time.time()
+    Parallel(n_jobs=num_cores)(delayed(process_job)(*job) for job in jobs)
+    elapsed_time = time.time() - t
+    print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+
+
+def main(tif_path=None, dcm_path=None, out_path=None):
 
     """ reads .tif (Mevis labelmap format) file and exports the respective .nii.gz file
     requires the original DICOM data set
     tif_path: e.g. /path/labelmask.tif
     dcm_path: e.g. /path/dcm/
     out_path: e.g. /path/labelmask.nii.gz
+    Without arguments, the command line is parsed (single file or --batch csv).
      """
-    labelmask = imread(tif_path)
-    dcm_img = load_dcm_data(dcm_path)
-    mask_img = sitk.GetImageFromArray(labelmask)
-    mask_img.CopyInformation(dcm_img)
-    sitk.WriteImage(mask_img, out_path)
+    if tif_path is not None:
+        convert(tif_path, dcm_path, out_path)
+        return
+
+    parser = argparse.ArgumentParser(description='Convert MeVis .tif labelmaps to nifti (geometry from the dicom headers).')
+    parser.add_argument('tif_path', nargs='?', help='labelmap .tif file')
+    parser.add_argument('dcm_path', nargs='?', help='dicom directory of the original data set')
+    parser.add_argument('out_path', nargs='?', help='output .nii.gz file')
+    parser.add_argument('-b', '--batch', help='.csv file with columns tif,dcm,out')
+    parser.add_argument('--cores', type=int, default=4, help='number of processes (batch mode)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.batch:
+        with open(args.batch, newline='') as f:
+            jobs = [(row['tif'], row['dcm'], row['out']) for row in csv.DictReader(f)]
+        print(f'Converting {len(jobs)} labelmaps using {args.cores} CPU cores')
+        convert_batch(jobs, args.cores, args.verbose)
+    elif args.tif_path and args.dcm_path and args.out_path:
+        convert(args.tif_path, args.dcm_path, args.out_path)
+    else:
+        parser.error('tif_path, dcm_path and out_path (or --batch) are required')
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,6 +1,14 @@
 import SimpleITK as sitk
+import nibabel as nib
+import argparse
+import os
+import sys
+import time
 from pathlib import Path
 import numpy as np
+from joblib import Parallel, delayed
+from midastools.misc.nifti import make_affine
+from midastools.misc.dcm_geometry import ImageGeometry, read_image_information
 
 
 def sort_imgs(imgs):
@@ -23,44 +31,138 @@ def sort_imgs(imgs):
     imgs = sorted(imgs, key=get_min_z)
     return imgs
 
-def compose_imgs(imgs):
+def station_overlaps(imgs):
     """
-    Composes nii files along the z-axis.
-    Assumptions: XY-shape and spacing has to be the same for all images.
+    Computes the number of overlapping slices between consecutive (sorted) images.
 
     Args:
-        imgs: List of sitk image objects.
+        imgs: List of sitk image objects (sorted along the z-axis).
 
-    Returns: Composed (sitk) image.
+    Returns: List with the number of overlapping slices (len(imgs) - 1 entries).
 
     """
-
-    print([im.GetOrigin() for im in imgs])
+    overlaps = []
     for i in range(1, len(imgs)):
         # Get the coordinates of the last slice (max. z-coord.) of the previous image.
         idx_last_slice = imgs[i-1].GetSize()[2] - 1
         z_last_slice = imgs[i-1].TransformIndexToPhysicalPoint([0, 0, idx_last_slice])
         # Get the corresponding slice index of the following image.
         idx_slice = imgs[i].TransformPhysicalPointToIndex(z_last_slice)[2]
-        delta_slices = idx_slice + 1
-        # Crop both images.
-        crop_a = int(delta_slices/2)
-        crop_b = delta_slices - crop_a
-        imgs[i] = imgs[i][:, :, crop_a:]
-        imgs[i-1] = imgs[i-1][:, :, :(idx_last_slice + 1 - crop_b)]
-        # Alternative:
-        # Start with the next slice. Crop the other slices of the following image.
-        # imgs[i] = imgs[i][:, :, (idx_slice+1):]
-        # todo mean in overlay areas
-
-    # Get numpy arrays for the (cropped) images
-    img_arrays = []
-    for i in range(0, len(imgs)):
-        img_arrays.append(sitk.GetArrayFromImage(imgs[i]).transpose([2, 1, 0]))
-    # Concatenate arrays to one common array.
-    img_array = np.concatenate(img_arrays, axis=2)
+        overlaps.append(max(idx_slice + 1, 0))
+    return overlaps
+
+
+def compose_layout(imgs, blend=False):
+    """
+    Computes the slice ranges and positions of all (sorted) images in the composed volume.
+
+    Works on sitk images or header-only StationHeader objects.
+
+    Args:
+        imgs: List of sitk image / StationHeader objects (sorted along the z-axis).
+        blend: Linear blending of the overlap regions (otherwise the overlap
+               is split half and half between both images).
+
+    Returns: dict with slice ranges 'starts', 'stops', 'positions', 'overlaps'
+             and the composed array 'shape' (z, y, x).
+
+    """
+    sizes = [im.GetSize()[2] for im in imgs]
+    xy_size = imgs[0].GetSize()[:2]
+    for im in imgs[1:]:
+        if im.GetSize()[:2] != xy_size:
+            raise ValueError(f'XY-size {im.GetSize()[:2]} does not match {xy_size}.')
+    overlaps = station_overlaps(imgs)
+
+    # Slice range [start, stop) of each image and its position in the composed array.
+    starts = [0] * len(imgs)
+    stops = list(sizes)
+    if not blend:
+        for i, delta_slices in enumerate(overlaps, 1):
+            # Crop both images.
+            crop_a = int(delta_slices/2)
+            crop_b = delta_slices - crop_a
+            starts[i] = crop_a
+            stops[i-1] -= crop_b
+    positions = [0]
+    for i in range(1, len(imgs)):
+        positions.append(positions[i-1] + stops[i-1] - starts[i-1] - (overlaps[i-1] if blend else 0))
+
+    shape = (positions[-1] + stops[-1] - starts[-1], xy_size[1], xy_size[0])
+    return {'starts': starts, 'stops': stops, 'positions': positions,
+            'overlaps': overlaps, 'shape': shape, 'blend': blend}
+
+
+def fill_composed(img_array, station_arrays, layout):
+    """
+    Copies the station arrays into the preallocated composed array.
+
+    Args:
+        img_array: preallocated output array (layout['shape']).
+        station_arrays: iterable with the (z, y, x) arrays of the sorted stations,
+                        may be a generator (one station in memory at a time).
+        layout: see compose_layout.
+
+    Returns: Composed array (z, y, x).
+
+    """
+    dtype = img_array.dtype
+    for i, station_array in enumerate(station_arrays):
+        im_array = station_array[layout['starts'][i]:layout['stops'][i]]
+        pos = layout['positions'][i]
+        delta_slices = layout['overlaps'][i-1] if (layout['blend'] and i > 0) else 0
+        if delta_slices:
+            # Linear weights for the overlap region (previous -> current image).
+            weights = (np.arange(1, delta_slices + 1) / (delta_slices + 1.0)).reshape(-1, 1, 1)
+            blended = ((1.0 - weights) * img_array[pos:pos + delta_slices] +
+                       weights * im_array[:delta_slices])
+            if np.issubdtype(dtype, np.integer):
+                blended = np.rint(blended)
+            img_array[pos:pos + delta_slices] = blended
+        img_array[pos + delta_slices:pos + len(im_array)] = im_array[delta_slices:]
+
+    return img_array
+
+
+def compose_arrays(imgs, blend=False):
+    """
+    Composes images along the z-axis into one preallocated array.
+
+    The final z-extent is computed first, each station is copied directly
+    into place (native (z, y, x) array order, no transposes).
+    Assumptions: XY-shape and spacing has to be the same for all images.
+
+    Args:
+        imgs: List of sitk image objects (sorted along the z-axis).
+        blend: Linear blending of the overlap regions (otherwise the overlap
+               is split half and half between both images).
+
+    Returns: Composed array (z, y, x).
+
+    """
+    layout = compose_layout(imgs, blend)
+    dtype = np.result_type(*[sitk.GetArrayViewFromImage(im).dtype for im in imgs])
+    img_array = np.empty(layout['shape'], dtype=dtype)
+    return fill_composed(img_array,
+                         (sitk.GetArrayViewFromImage(im) for im in imgs),
+                         layout)
+
+
+def compose_imgs(imgs, blend=False):
+    """
+    Composes nii files along the z-axis.
+    Assumptions: XY-shape and spacing has to be the same for all images.
+
+    Args:
+        imgs: List of sitk image objects.
+        blend: Linear blending of the overlap regions.
+
+    Returns: Composed (sitk) image.
+
+    """
+    img_array = compose_arrays(imgs, blend)
     # Convert array back to sitk image and copy meta information vom imgs[0].
-    img_composed = sitk.GetImageFromArray(img_array.transpose([2, 1, 0]))
+    img_composed = sitk.GetImageFromArray(img_array)
     img_composed.SetDirection(imgs[0].GetDirection())
     img_composed.SetOrigin(imgs[0].GetOrigin())
     img_composed.SetSpacing(imgs[0].GetSpacing())
@@ -68,42 +170,240 @@ def compose_imgs(imgs):
     return img_composed
 
 
+def write_nii(img_array, ref_img, out_file):
+    """
+    Writes a (z, y, x) array with the geometry of ref_img without further copies.
+
+    The file is written to a temporary name first and renamed afterwards,
+    incomplete files never carry the final name.
+
+    Args:
+        img_array: (z, y, x) array.
+        ref_img: sitk image / StationHeader with origin, spacing and direction.
+        out_file: output .nii/.nii.gz file.
+
+    """
+    out_file = Path(out_file)
+    tmp_file = out_file.parent.joinpath('.tmp_' + out_file.name)
+    # (z, y, x) C-order array -> (x, y, z) nifti view.
+    nii = nib.Nifti1Image(img_array.T, make_affine(ref_img))
+    nii.header.set_zooms(ref_img.GetSpacing())
+    nib.save(nii, str(tmp_file))
+    os.replace(str(tmp_file), str(out_file))
+
+
+def write_composed(imgs, out_file, blend=False):
+    """
+    Composes images along the z-axis and writes the result to a nii file.
+
+    The composed array is written without further copies (peak memory
+    about one output volume besides the input images).
+
+    Args:
+        imgs: List of sitk image objects (sorted along the z-axis).
+        out_file: output .nii/.nii.gz file.
+        blend: Linear blending of the overlap regions.
+
+    Returns: Size of the composed image (x, y, z).
+
+    """
+    img_array = compose_arrays(imgs, blend)
+    write_nii(img_array, imgs[0], out_file)
+    return img_array.shape[::-1]
+
+
+class StationHeader(ImageGeometry):
+    """
+    Image geometry of a station file, read from the file header only (no pixel data).
+    Provides the subset of the sitk image interface used by sort_headers and compose_layout.
+    """
+
+    def __init__(self, filepath):
+        reader = read_image_information(filepath)
+        super().__init__(reader.GetSize(), reader.GetOrigin(), reader.GetSpacing(),
+                         reader.GetDirection(), reader.GetPixelID())
+        self.filepath = Path(filepath)
+        self.flip = False
+
+    def set_flip(self):
+        """Flips the z-axis (same geometry as sitk.Flip), the pixel data is flipped on load."""
+        origin = self.TransformIndexToPhysicalPoint([0, 0, self.GetSize()[2] - 1])
+        direction = np.array(self.GetDirection()).reshape(3, 3)
+        direction[:, 2] *= -1
+        self.SetOrigin(origin)
+        self.SetDirection(direction.ravel().tolist())
+        self.flip = not self.flip
+
+    def load_array(self):
+        """Loads the (z, y, x) pixel array (flipped if necessary)."""
+        img = sitk.ReadImage(str(self.filepath))
+        img_array = sitk.GetArrayFromImage(img)
+        return img_array[::-1] if self.flip else img_array
+
+
+def sort_headers(headers):
+    """
+    Sorts station headers along the z-axis (flipping descending stations).
+
+    Args:
+        headers: List of StationHeader objects.
+
+    Returns: sorted list.
+
+    """
+    def get_z(im, idx):
+        return im.TransformIndexToPhysicalPoint([0, 0, idx])[2]
+
+    for im in headers:
+        if get_z(im, im.GetSize()[2] - 1) < get_z(im, 0):
+            im.set_flip()
+    return sorted(headers, key=lambda im: get_z(im, 0))
+
+
+def validate_headers(headers, ref_headers=None, tol=1e-3):
+    """
+    Checks that all stations share XY-size, spacing and direction
+    (and match the sizes of ref_headers, e.g. another dixon contrast).
+
+    Raises: ValueError
+
+    """
+    ref = headers[0]
+    for im in headers:
+        if (im.GetSize()[:2] != ref.GetSize()[:2] or
+                not np.allclose(im.GetSpacing(), ref.GetSpacing(), atol=tol) or
+                not np.allclose(im.GetDirection(), ref.GetDirection(), atol=tol)):
+            raise ValueError(f'{im.filepath}: geometry does not match {ref.filepath}.')
+    if ref_headers is not None:
+        if [im.GetSize() for im in headers] != [im.GetSize() for im in ref_headers]:
+            raise ValueError(f'{ref.filepath.parent}: station sizes differ between sequences.')
+
+
+def compose_subject(station_files, out_files, blend=False, overwrite=False, verbose=False):
+    """
+    Composes the stations of all sequences (e.g. dixon contrasts) of a subject.
+
+    The stations are sorted and validated using the file headers only. The crop
+    computation of the first sequence is shared by all sequences, only one
+    station is loaded at a time into the preallocated output volume.
+
+    Args:
+        station_files: dict sequence -> list of station files.
+        out_files: dict sequence -> output file.
+        blend: Linear blending of the overlap regions.
+        overwrite: Recompose existing output files (otherwise they are skipped).
+        verbose: print progress.
+
+    Returns: dict sequence -> composed size (x, y, z), None for skipped sequences.
+
+    """
+    sequences = [seq for seq in station_files if overwrite or not Path(out_files[seq]).exists()]
+    result = {seq: None for seq in station_files}
+    if not sequences:
+        return result
+
+    headers = {seq: sort_headers([StationHeader(f) for f in station_files[seq]]) for seq in sequences}
+    ref_headers = headers[sequences[0]]
+    validate_headers(ref_headers)
+    layout = compose_layout(ref_headers, blend)
+
+    for seq in sequences:
+        validate_headers(headers[seq], ref_headers)
+        dtype = np.result_type(*[h.dtype for h in headers[seq]])
+        img_array = np.empty(layout['shape'], dtype=dtype)
+        fill_composed(img_array, (h.load_array() for h in headers[seq]), layout)
+        write_nii(img_array, headers[seq][0], out_files[seq])
+        result[seq] = img_array.shape[::-1]
+        del img_array
+        if verbose:
+            print(f'{out_files[seq]}: composed image size {result[seq]}')
+    return result
+
+
+def find_subjects(root_dir, subject_pattern, station_pattern, sequences, output_pattern):
+    """
+    Discovers the station files per subject and sequence.
+
+    Args:
+        root_dir: cohort root directory.
+        subject_pattern: glob pattern for subject directories (relative to root_dir).
+        station_pattern: glob pattern for station files, '{sequence}' is replaced.
+        sequences: list of sequences (e.g. fat, water, in, opp).
+        output_pattern: output filename, '{sequence}' is replaced.
+
+    Returns: list of (station_files, out_files) dicts per subject.
+
+    """
+    jobs = []
+    for subj_dir in sorted(Path(root_dir).glob(subject_pattern)):
+        if not subj_dir.is_dir():
+            continue
+        station_files = {}
+        out_files = {}
+        for seq in sequences:
+            files = sorted(f for f in subj_dir.glob(station_pattern.format(sequence=seq))
+                           if not f.name.startswith('.tmp_'))
+            out_file = subj_dir.joinpath(output_pattern.format(sequence=seq))
+            files = [f for f in files if f != out_file]
+            if files:
+                station_files[seq] = files
+                out_files[seq] = out_file
+        if station_files:
+            jobs.append((station_files, out_files))
+    return jobs
+
+
+def compose_cohort(jobs, blend=False, overwrite=False, num_cores=4, verbose=False):
+    """
+    Composes all subjects of a cohort in a process pool.
+
+    Subjects with existing outputs are skipped (resume), errors are reported
+    per subject.
+
+    Args:
+        jobs: list of (station_files, out_files) dicts (see find_subjects).
+        blend: Linear blending of the overlap regions.
+        overwrite: Recompose existing output files.
+        num_cores: number of processes.
+        verbose: print progress.
+
+    Returns: list of results (see compose_subject) or error messages.
+
+    """
+    def process_subject(station_files, out_files):
+        try:
+            return compose_subject(station_files, out_files, blend, overwrite, verbose)
+        except Exception as err:
+            subj_dir = Path(next(iter(out_files.values()))).parent
+            print(f'composition error {subj_dir}: {err}', file=sys.stderr)
+            return str(err)
+
+    t = time.time()
+    results = Parallel(n_jobs=num_cores)(
+        delayed(process_subject)(station_files, out_files) for station_files, out_files in jobs)
+    elapsed_time = time.time() - t
+    print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+    return results
+
+
 def main():
-    #work_dir = Path('/home/raheppt1/data_samples/compose')
-    #path_composed = Path('/home/raheppt1/data_samples/compose/composed.nii')
-    #nii_files = list(work_dir.glob('F*nii*'))
-
-    work_dir = Path('/mnt/share/nora/imgdata/UKB3001ABDS')
-    path_composed = Path('/home/raheppt1/data_samples/compose/composed.nii')
-    subj_dir = work_dir.glob('**/Dixon_BH*')
-    sequence = 'opp'
-
-    for dir in subj_dir:
-        nii_files = list(dir.glob(sequence+'_s*nii*'))
-        path_composed = dir.joinpath(sequence+'_composed.nii')
-        print(path_composed)
-
-        # Read nii files.
-        imgs = [sitk.ReadImage(str(file)) for file in nii_files]
-        info = [(img.GetSize(), img.GetSpacing()) for img in imgs]
-
-        # Sort images along the z-axis.
-        imgs = sort_imgs(imgs)
-
-        # Compose images.
-        img_composed = compose_imgs(imgs)
-
-        last_slice = img_composed.GetSize()[2] - 1
-        start_z = img_composed.TransformIndexToPhysicalPoint([0, 0, 0])[2]
-        end_z = img_composed.TransformIndexToPhysicalPoint([0, 0, last_slice])[2]
-        #print('start ', start_z)
-        #print('end ', end_z)
-        #img_composed = compose_imgs(imgs)
-        # Write composed image to nii file.
-        sitk.WriteImage(img_composed, str(path_composed))
-        print(f'Composed image size {img_composed.GetSize()}')
-    return
+    parser = argparse.ArgumentParser(description='Compose whole-body stations along the z-axis (cohort).')
+    parser.add_argument('root_dir', help='Cohort root directory.')
+    parser.add_argument('--subjects', default='**/Dixon_BH*', help='glob pattern for subject directories')
+    parser.add_argument('--stations', default='{sequence}_s*nii*', help='glob pattern for station files')
+    parser.add_argument('--sequences', default='fat,water,in,opp', help='comma separated sequences')
+    parser.add_argument('--output', default='{sequence}_composed.nii', help='output filename')
+    parser.add_argument('--blend', action='store_true', help='linear blending of overlap regions')
+    parser.add_argument('--overwrite', action='store_true', help='recompose existing outputs (no resume)')
+    parser.add_argument('--cores', type=int, default=4, help='number of processes')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    jobs = find_subjects(args.root_dir, args.subjects, args.stations,
+                         args.sequences.split(','), args.output)
+    print(f'composing {len(jobs)} subjects using {args.cores} CPU cores')
+    compose_cohort(jobs, args.blend, args.overwrite, args.cores, args.verbose)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,24 +1,383 @@
 import numpy as np
 import pydicom
 import sys
+import csv
+import time
 import argparse
 import SimpleITK as sitk
+import nibabel as nib
+from pathlib import Path
+from joblib import Parallel, delayed
+from midastools.misc.nifti import make_affine
+from midastools.misc.dcm_geometry import DicomSeriesGeometry
+
+# Dicom tags needed for the SUV conversion.
+PET_TAGS = ['RadiopharmaceuticalInformationSequence',
+            'AcquisitionTime',
+            'PatientWeight',
+            'PatientID',
+            'StudyInstanceUID',
+            'SeriesInstanceUID']
+
+# Additional dicom tags needed to split a dynamic series into frames.
+FRAME_TAGS = ['AcquisitionTime',
+              'SeriesTime',
+              'FrameReferenceTime',
+              'ActualFrameDuration',
+              'DecayCorrection',
+              'ImagePositionPatient',
+              'ImageOrientationPatient']
+
+SUV_CACHE_FIELDS = ['header', 'mtime', 'size',
+                    'patient_id', 'study_uid', 'series_uid',
+                    'total_dose', 'start_time', 'half_life',
+                    'acq_time', 'weight', 'suv_factor']
+
 
 def conv_time(time_str):
     return (float(time_str[:2]) * 3600 + float(time_str[2:4]) * 60 + float(time_str[4:13]))
 
+
+def read_pet_header(dcm_file, tags=PET_TAGS):
+    """Reads the pet dicom tags of a single dicom file.
+
+    Only the selected tags are parsed, the pixel data is skipped.
+
+    Args:
+        dcm_file (str/Path): dicom file
+        tags (list, optional): dicom keywords to read. Defaults to PET_TAGS.
+
+    Returns:
+        pydicom dataset (without pixel data)
+    """
+    return pydicom.dcmread(str(dcm_file),
+                           stop_before_pixels=True,
+                           specific_tags=list(tags))
+
+
+def calc_suv_param(ds):
+    """Computes the SUV conversion factor from pet dicom tags.
+
+    Args:
+        ds: pydicom dataset (e.g. from read_pet_header)
+
+    Returns:
+        dict: dose, times, half-life, weight and suv factor
+    """
+    rp_info = ds.RadiopharmaceuticalInformationSequence[0]
+    param = {'total_dose': float(rp_info.RadionuclideTotalDose),
+             'start_time': str(rp_info.RadiopharmaceuticalStartTime),
+             'half_life': float(rp_info.RadionuclideHalfLife),
+             'acq_time': str(ds.AcquisitionTime),
+             'weight': float(ds.PatientWeight)}
+    time_diff = conv_time(param['acq_time']) - conv_time(param['start_time'])
+    act_dose = param['total_dose'] * 0.5 ** (time_diff / param['half_life'])
+    param['suv_factor'] = 1000 * param['weight'] / act_dose
+    return param
+
+
+class SuvFactorCache:
+    """
+    Local (csv) table with the SUV parameters of already processed dicom headers.
+    Entries are keyed by the header path and invalidated if the
+    modification time or file size of the header changes.
+    """
+
+    def __init__(self, cache_file=None):
+        """
+        Args:
+            cache_file (str/Path, optional): csv table, in memory only if None.
+        """
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.table = {}
+        if self.cache_file and self.cache_file.exists():
+            with open(str(self.cache_file), newline='') as f:
+                for row in csv.DictReader(f):
+                    self.table[row['header']] = row
+
+    @staticmethod
+    def _file_stat(dcm_file):
+        stat = Path(dcm_file).stat()
+        return str(stat.st_mtime_ns), str(stat.st_size)
+
+    def get_param(self, dcm_file):
+        """Returns the SUV parameters for a dicom header.
+
+        The dicom file is only read (header only) if there is no valid
+        cache entry.
+
+        Args:
+            dcm_file (str/Path): dicom file with pet dicom tags
+
+        Returns:
+            dict: SUV parameters (see calc_suv_param)
+        """
+        key = str(Path(dcm_file).resolve())
+        mtime, size = self._file_stat(dcm_file)
+        row = self.table.get(key)
+        if row is None or row['mtime'] != mtime or row['size'] != size:
+            ds = read_pet_header(dcm_file)
+            row = calc_suv_param(ds)
+            row.update({'header': key, 'mtime': mtime, 'size': size,
+                        'patient_id': str(ds.get('PatientID', '')),
+                        'study_uid': str(ds.get('StudyInstanceUID', '')),
+                        'series_uid': str(ds.get('SeriesInstanceUID', ''))})
+            self.table[key] = row
+        param = dict(row)
+        for k in ['total_dose', 'half_life', 'weight', 'suv_factor']:
+            param[k] = float(param[k])
+        return param
+
+    def save(self):
+        """Writes the table to the cache file."""
+        if not self.cache_file:
+            return
+        with open(str(self.cache_file), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUV_CACHE_FIELDS)
+            writer.writeheader()
+            for key in sorted(self.table):
+                writer.writerow({k: self.table[key][k] for k in SUV_CACHE_FIELDS})
+
+
+def convert_suv_nii(nii_file, out_file, suv_factor, dtype=np.float32):
+    """Converts a pet (corr) nii file to SUV values.
+
+    The image is loaded once in float32 and multiplied in place. For
+    float16 the SUV values are rounded to half precision afterwards (the
+    activity concentrations exceed the float16 range). Nifti has no half
+    precision data type, float16 images are stored as float32.
+
+    Args:
+        nii_file (str/Path): pet image .nii file
+        out_file (str/Path): output .nii file
+        suv_factor (float): SUV conversion factor
+        dtype (optional): np.float32 or np.float16. Defaults to np.float32.
+    """
+    img = nib.load(str(nii_file))
+    data = img.get_fdata(dtype=np.float32)
+    np.multiply(data, np.float32(suv_factor), out=data)
+    if np.dtype(dtype) != np.float32:
+        data = data.astype(dtype)
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1.0, 0.0)
+    nib.save(nib.Nifti1Image(data, img.affine, header), str(out_file))
+
+
+def convert_suv_batch(jobs,
+                      cache_file=None,
+                      dtype=np.float32,
+                      num_cores=4,
+                      verbose=False):
+    """Converts a cohort of pet (corr) nii files to SUV values.
+
+    The SUV factors are computed from header-only dicom reads (cached in
+    a local table), the volumes are converted in a process pool.
+
+    Args:
+        jobs (list): list of (nii_file, dcm_header, out_file) tuples
+        cache_file (str/Path, optional): csv table to cache SUV factors. Defaults to None.
+        dtype (optional): np.float32 or np.float16. Defaults to np.float32.
+        num_cores (int, optional): number of processes. Defaults to 4.
+        verbose (bool, optional): print progress. Defaults to False.
+
+    Returns:
+        list: SUV factors of the jobs
+    """
+    cache = SuvFactorCache(cache_file)
+    suv_factors = [cache.get_param(dcm_header)['suv_factor']
+                   for _, dcm_header, _ in jobs]
+    cache.save()
+
+    def process_job(job, suv_factor):
+        nii_file, _, out_file = job
+        if verbose:
+            print(f'{nii_file} -> {out_file} (SUV factor {suv_factor})')
+        convert_suv_nii(nii_file, out_file, suv_factor, dtype)
+
+    t = time.time()
+    Parallel(n_jobs=num_cores)(
+        delayed(process_job)(job, suv_factor) for job, suv_factor in zip(jobs, suv_factors))
+    elapsed_time = time.time() - t
+    if verbose:
+        print(f'elapsed time: {time.strftime("%H:%M:%S", time.gmtime(elapsed_time))}')
+    return suv_factors
+
+
+def read_dynamic_frames(dcm_files):
+    """Splits a dynamic pet dicom series into frames (header-only reads).
+
+    Slices are grouped by their frame reference time and sorted
+    along the slice normal. The start of a frame is the earliest acquisition
+    time of its slices (series time + frame reference time if the
+    acquisition time is missing), independent of the file order.
+
+    Args:
+        dcm_files (list): dicom files of the dynamic series
+
+    Returns:
+        list: one dict per frame (sorted by time) with the keys
+              'files', 'start_time' (s), 'reference_time' (s), 'series_time' (s),
+              'duration' (s), 'decay_correction'
+    """
+    frames = {}
+    for f in dcm_files:
+        ds = read_pet_header(f, FRAME_TAGS)
+        frame_key = float(ds.get('FrameReferenceTime', 0.0))
+        orientation = np.array(ds.ImageOrientationPatient, dtype=float)
+        normal = np.cross(orientation[:3], orientation[3:])
+        position = float(np.dot(normal, np.array(ds.ImagePositionPatient, dtype=float)))
+        series_time = conv_time(str(ds.get('SeriesTime', ds.get('AcquisitionTime'))))
+        reference_time = series_time + frame_key / 1000.0
+        acq_time = conv_time(str(ds.AcquisitionTime)) if ds.get('AcquisitionTime') else reference_time
+        frame = frames.setdefault(frame_key, {'slices': [],
+                                              'start_time': acq_time,
+                                              'reference_time': reference_time,
+                                              'series_time': series_time,
+                                              'duration': float(ds.get('ActualFrameDuration', 0.0)) / 1000.0,
+                                              'decay_correction': str(ds.get('DecayCorrection', 'START')).upper()})
+        frame['slices'].append((position, str(f)))
+        frame['start_time'] = min(frame['start_time'], acq_time)
+
+    frame_list = []
+    for frame_key in sorted(frames):
+        frame = frames.pop(frame_key)
+        frame['files'] = [f for _, f in sorted(frame.pop('slices'))]
+        frame_list.append(frame)
+    return frame_list
+
+
+def calc_frame_suv_factor(param, frame):
+    """Computes the SUV conversion factor of a single frame.
+
+    The injected dose is decayed according to the decay correction of the
+    frame: 'START' (decay corrected to the series start) the decay at the
+    series time, 'ADMIN' (decay corrected to the administration time) no
+    decay and 'NONE' (no decay correction) the mean decay over the frame.
+    The frame is given by its reference time (FrameReferenceTime, taken as
+    the frame midpoint) and duration (ActualFrameDuration).
+
+    Args:
+        param (dict): SUV parameters (see calc_suv_param)
+        frame (dict): frame information (see read_dynamic_frames)
+
+    Returns:
+        float: SUV factor of the frame
+    """
+    decay_const = np.log(2) / param['half_life']
+    inj_time = conv_time(param['start_time'])
+    if frame['decay_correction'] == 'NONE':
+        frame_start = frame['reference_time'] - frame['duration'] / 2
+        decay = np.exp(-decay_const * (frame_start - inj_time))
+        if frame['duration'] > 0:
+            decay_frame = decay_const * frame['duration']
+            decay *= (1.0 - np.exp(-decay_frame)) / decay_frame
+    elif frame['decay_correction'] == 'ADMIN':
+        decay = 1.0
+    else:
+        decay = np.exp(-decay_const * (frame['series_time'] - inj_time))
+    return 1000 * param['weight'] / (param['total_dose'] * decay)
+
+
+def create_nii_memmap(out_file, shape, affine, dtype=np.float32):
+    """Creates an (uncompressed) nii file and returns a writable memory map.
+
+    Args:
+        out_file (str/Path): output .nii file
+        shape (tuple): image shape (x, y, z, ...)
+        affine (np.array): 4x4 affine (RAS)
+        dtype (optional): data type. Defaults to np.float32.
+
+    Returns:
+        np.memmap: image data (fortran order, nifti axes)
+    """
+    if str(out_file).endswith('.gz'):
+        raise ValueError(f'{out_file}: memory mapped output requires an uncompressed .nii file.')
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units('mm', 'sec')
+    offset = 352
+    header.set_data_offset(offset)
+    with open(str(out_file), 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (offset - f.tell()))
+        f.truncate(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(str(out_file), dtype=dtype, mode='r+',
+                     offset=offset, shape=tuple(shape), order='F')
+
+
+def convert_suv_dynamic(dcm_dir, out_file, dcm_series_id='', dtype=np.float32, verbose=False):
+    """Converts a dynamic (4D) pet dicom series to SUV values, frame by frame.
+
+    Only one frame is decoded at a time and written into a preallocated
+    (memory mapped) 4D nii file, peak memory stays near one frame.
+    Nifti has no half precision data type, float16 frames are stored
+    as float32.
+
+    Args:
+        dcm_dir (str/Path): dicom directory
+        out_file (str/Path): output .nii file (uncompressed)
+        dcm_series_id (str, optional): series id. Defaults to ''.
+        dtype (optional): np.float32 or np.float16. Defaults to np.float32.
+        verbose (bool, optional): print frame information. Defaults to False.
+
+    Returns:
+        list: frame information incl. the applied SUV factors
+    """
+    reader = sitk.ImageSeriesReader()
+    if not dcm_series_id:
+        dcm_files = reader.GetGDCMSeriesFileNames(str(dcm_dir))
+    else:
+        dcm_files = reader.GetGDCMSeriesFileNames(str(dcm_dir), dcm_series_id)
+    param = calc_suv_param(read_pet_header(dcm_files[0]))
+    frames = read_dynamic_frames(dcm_files)
+    out_dtype = np.float32 if np.dtype(dtype) == np.float16 else dtype
+
+    out_data = None
+    for idx_frame, frame in enumerate(frames):
+        reader.SetFileNames(frame['files'])
+        reader.SetOutputPixelType(sitk.sitkFloat32)
+        frame_img = reader.Execute()
+        if out_data is None:
+            shape = frame_img.GetSize() + (len(frames),)
+            out_data = create_nii_memmap(out_file, shape, make_affine(frame_img), out_dtype)
+        elif frame_img.GetSize() != out_data.shape[:3]:
+            raise ValueError(f'frame {idx_frame}: size {frame_img.GetSize()} does not match {out_data.shape[:3]}')
+
+        frame['suv_factor'] = calc_frame_suv_factor(param, frame)
+        if verbose:
+            print(f'frame {idx_frame}: start {frame["start_time"]:.1f}s, '
+                  f'duration {frame["duration"]:.1f}s, SUV factor {frame["suv_factor"]}')
+        # (z, y, x) view of the frame -> (x, y, z) slab of the output file.
+        # The SUV values are computed in float32 and rounded to half precision
+        # afterwards (the activity concentrations exceed the float16 range).
+        frame_data = sitk.GetArrayViewFromImage(frame_img).T
+        np.multiply(frame_data, np.float32(frame['suv_factor']), out=out_data[..., idx_frame])
+        if np.dtype(dtype) != out_data.dtype:
+            out_data[..., idx_frame] = out_data[..., idx_frame].astype(dtype)
+        del frame_img
+
+    out_data.flush()
+    del out_data
+    return frames
+
+
 class Pet:
 
     def load_pet_param(self):
-        ds = pydicom.dcmread(self.dcm_pet_names[0])
-        self.total_dose = ds.RadiopharmaceuticalInformationSequence[0].RadionuclideTotalDose
-        self.start_time = ds.RadiopharmaceuticalInformationSequence[0].RadiopharmaceuticalStartTime
-        self.half_life = ds.RadiopharmaceuticalInformationSequence[0].RadionuclideHalfLife
-        self.acq_time = ds.AcquisitionTime
-        self.weight = ds.PatientWeight
+        ds = read_pet_header(self.dcm_pet_names[0])
+        param = calc_suv_param(ds)
+        self.total_dose = param['total_dose']
+        self.start_time = param['start_time']
+        self.half_life = param['half_life']
+        self.acq_time = param['acq_time']
+        self.weight = param['weight']
         self.time_diff = conv_time(self.acq_time) - conv_time(self.start_time)
         self.act_dose = self.total_dose * 0.5 ** (self.time_diff / self.half_life)
-        self.suv_factor = 1000 * self.weight / self.act_dose
+        self.suv_factor = param['suv_factor']
 
     def get_pet_image_suv(self):
         return self.image_suv
@@ -58,14 +417,21 @@ class Pet:
         self.image_pet = reader.Execute()
         self.load_pet_param()
 
-    def load_dcm_dir(self, dcm_dir, dcm_series_id):
+    def load_dcm_dir(self, dcm_dir, dcm_series_id, header_only=False):
         """
         Use dicom directory / series id to load the image data and
         to extract pet dicom tags.
         :param dcm_dir: dicom directory
         :param dcm_series_id: series id
+        :param header_only: only read the geometry (self.geometry) and the
+                            pet dicom tags, no pixel data is decoded
         :return:
         """
+        if header_only:
+            self.geometry = DicomSeriesGeometry(dcm_dir, dcm_series_id)
+            self.dcm_pet_names = self.geometry.file_names
+            self.load_pet_param()
+            return
         reader = sitk.ImageSeriesReader()
         # Reading PET DICOM dir
         if not dcm_series_id:
@@ -77,7 +443,7 @@ class Pet:
         self.load_pet_param()
 
     def __init__(self, dcm_dir='', dcm_series_id='',
-                 nii_path='', dcm_header_path=''):
+                 nii_path='', dcm_header_path='', header_only=False):
 
         # pet parameters
         self.total_dose = -1
@@ -92,9 +458,10 @@ class Pet:
         self.dcm_pet_names = []
         self.image_pet = []
         self.image_suv = []
+        self.geometry = None
 
         if dcm_dir:
-            self.load_dcm_dir(dcm_dir, dcm_series_id)
+            self.load_dcm_dir(dcm_dir, dcm_series_id, header_only)
 
         if nii_path and dcm_header_path:
             self.load_nii(nii_path, dcm_header_path)
@@ -103,10 +470,16 @@ class Pet:
 def main():
     print('Convert PET corr. to PET SUV')
     parser = argparse.ArgumentParser()
-    parser.add_argument('--nii', help='pet image .nii file', required=True)
-    parser.add_argument('--header', help='single .dcm file with pet dicom tags', required=True)
-    parser.add_argument('--out', help='.nii output file', required=True)
+    parser.add_argument('--nii', help='pet image .nii file')
+    parser.add_argument('--header', help='single .dcm file with pet dicom tags')
+    parser.add_argument('--out', help='.nii output file')
+    parser.add_argument('--dynamic', help='dynamic pet dicom directory (frame by frame conversion)')
+    parser.add_argument('--series', help='dicom series id (dynamic mode)', default='')
+    parser.add_argument('--batch', help='.csv file with columns nii,header,out (cohort conversion)')
+    parser.add_argument('--cache', help='.csv table to cache the SUV factors (batch mode)')
+    parser.add_argument('--cores', help='number of processes (batch mode)', type=int, default=4)
     parser.add_argument('--dtype', help='output file dtype', default='float32', choices=['float32', 'float16'])
+    parser.add_argument('-v', '--verbose', action='store_true')
 
     args = parser.parse_args()
     nii_file = args.nii
@@ -118,13 +491,24 @@ def main():
     elif args.dtype == 'float16':
        args.dtype = np.float16
 
-    if nii_file and dcm_header and out_file:
-        img = sitk.ReadImage(nii_file)
-        print('size', img.GetSize())
+    if args.dynamic and out_file:
+        frames = convert_suv_dynamic(args.dynamic, out_file, args.series, dtype=args.dtype, verbose=args.verbose)
+        print(f'converted {len(frames)} frames')
+    elif args.batch:
+        with open(args.batch, newline='') as f:
+            jobs = [(row['nii'], row['header'], row['out']) for row in csv.DictReader(f)]
+        print(f'converting {len(jobs)} files using {args.cores} CPU cores')
+        convert_suv_batch(jobs,
+                          cache_file=args.cache,
+                          dtype=args.dtype,
+                          num_cores=args.cores,
+                          verbose=args.verbose)
+    elif nii_file and dcm_header and out_file:
         print(nii_file, dcm_header, out_file)
-        pet_obj = Pet(nii_path=nii_file, dcm_header_path=dcm_header)
-        image_pet_suv = pet_obj.calc_suv_image().astype(args.dtype)
-        sitk.WriteImage(image_pet_suv, out_file)
+        param = calc_suv_param(read_pet_header(dcm_header))
+        convert_suv_nii(nii_file, out_file, param['suv_factor'], args.dtype)
+    else:
+        parser.error('--nii, --header and --out (or --batch, or --dynamic and --out) are required')
 
 if __name__ == '__main__':
     main()
@@ -5,7 +5,109 @@ import nibabel as ni
 import numpy as np
 import matplotlib.pyplot as plt
 import skimage.measure
+import pandas as pd
+from scipy import ndimage
 from pathlib import Path
+from joblib import Parallel, delayed
+from midastools.misc import imcache
+
+
+def label_components(mask_arr, b_class_components=True):
+    """Labels the connected components of a mask.
+
+    Args:
+        mask_arr: array of a tumor mask.
+        b_class_components: Detect connected components (otherwise label 1 is used as single component).
+
+    Returns: labeled array, number of components
+
+    """
+    if b_class_components:
+        amask_comp, num_comp = skimage.measure.label(mask_arr,
+                                                     background=None,
+                                                     return_num=True,
+                                                     connectivity=None)
+    else:
+        amask_comp = (mask_arr == 1).astype(np.uint8)
+        num_comp = 1
+    return amask_comp, num_comp
+
+
+def suv_peak_kernel(spacing, volume_ml=1.0):
+    """Spherical averaging kernel for SUVpeak (mean SUV inside a 1 ml sphere).
+
+    Args:
+        spacing: voxel spacing in mm (array axis order).
+        volume_ml: sphere volume in ml.
+
+    Returns: normalized kernel array
+
+    """
+    radius = (3.0 * volume_ml * 1000.0 / (4.0 * np.pi)) ** (1.0 / 3.0)
+    half_size = [int(radius // sp) for sp in spacing]
+    grid = np.meshgrid(*[np.arange(-h, h + 1) * sp for h, sp in zip(half_size, spacing)],
+                       indexing='ij')
+    kernel = (sum(g ** 2 for g in grid) <= radius ** 2).astype(np.float64)
+    return kernel / kernel.sum()
+
+
+def lesion_stats(img_arr, label_arr, num_comp, spacing=(1.0, 1.0, 1.0)):
+    """
+    Computes a per-component statistics table in one pass (label-indexed reductions).
+
+    Args:
+        img_arr: array of a PET-SUV image.
+        label_arr: labeled lesion mask (1..num_comp, 0 = background).
+        num_comp: number of components.
+        spacing: voxel spacing in mm (array axis order, i.e. reversed sitk spacing).
+
+    Returns: pandas DataFrame with voxel count, MTV (ml), SUVmax, SUVmean, SUVpeak, TLG,
+             centroid and bounding box (voxel indices) per component.
+
+    """
+    index = np.arange(1, num_comp + 1)
+    labels_flat = label_arr.ravel()
+    counts = np.bincount(labels_flat, minlength=num_comp + 1)[1:num_comp + 1]
+    suv_sum = np.bincount(labels_flat, weights=img_arr.ravel().astype(np.float64),
+                          minlength=num_comp + 1)[1:num_comp + 1]
+    valid = counts > 0
+    index, counts, suv_sum = index[valid], counts[valid], suv_sum[valid]
+
+    columns = {'label': index, 'voxels': counts}
+    columns['mtv_ml'] = counts * float(np.prod(spacing)) / 1000.0
+    columns['suv_max'] = np.atleast_1d(ndimage.maximum(img_arr, label_arr, index=index))
+    columns['suv_mean'] = suv_sum / counts
+
+    # SUVpeak: maximum of the 1 ml sphere mean inside the lesion, evaluated
+    # in the bounding box of each lesion (padded by the kernel radius) only.
+    kernel = suv_peak_kernel(spacing).astype(np.float32)
+    half_size = [k // 2 for k in kernel.shape]
+    comp_boxes = ndimage.find_objects(label_arr, max_label=num_comp)
+    comp_boxes = [comp_boxes[i - 1] for i in index]
+    suv_peak = np.zeros(len(index))
+    for idx, (label, comp_box) in enumerate(zip(index, comp_boxes)):
+        box = tuple(slice(max(b.start - h, 0), min(b.stop + h, n))
+                    for b, h, n in zip(comp_box, half_size, img_arr.shape))
+        img_mean = ndimage.correlate(img_arr[box].astype(np.float32), kernel, mode='nearest')
+        suv_peak[idx] = img_mean[label_arr[box] == label].max()
+    columns['suv_peak'] = suv_peak
+    columns['tlg'] = columns['suv_mean'] * columns['mtv_ml']
+
+    centroids = np.atleast_2d(ndimage.center_of_mass(label_arr > 0, label_arr, index))
+    for d in range(img_arr.ndim):
+        columns[f'centroid_{d}'] = centroids[:, d] if len(index) else []
+    for d in range(img_arr.ndim):
+        columns[f'bbox_min_{d}'] = [b[d].start for b in comp_boxes]
+        columns[f'bbox_max_{d}'] = [b[d].stop for b in comp_boxes]
+
+    return pd.DataFrame(columns)
+
+
+def write_table(table, filepath):
+    """Writes a DataFrame to a .csv file."""
+    if Path(filepath).suffix.lower() != '.csv':
+        raise ValueError(f'{filepath}: statistics tables are written as .csv files.')
+    table.to_csv(str(filepath), index=False)
 
 
 def isocont(img_arr,
@@ -15,11 +117,16 @@ def isocont(img_arr,
             b_use_percentile_threshold=True,
             percentile_threshold=25,
             maximum_threshold=10,
+            b_out_stats=False,
+            spacing=(1.0, 1.0, 1.0),
             verbose=True):
     """
     Computes a mask based on percentile/relative maximum SUV value thresholds inside all
     connected components of the original mask.
 
+    Thresholds are computed and applied inside the bounding box of each component
+    only, the runtime scales with the lesion volume instead of the image size.
+
     Args:
         img_arr: array of a PET-SUV image.
         mask_arr: array of a tumor mask.
@@ -29,51 +136,55 @@ def isocont(img_arr,
                                     are used.
         percentile_threshold: Set percentile (SUV value) threshold in percent.
         maximum_threshold: Set relative maximum (SUV value) threshold.
+        b_out_stats: Additionally return a per-component statistics table (see lesion_stats).
+        spacing: voxel spacing in mm (array axis order), used for the statistics.
         verbose:
 
-    Returns: array of the new mask.
+    Returns: array of the new mask (and statistics table, if b_out_stats).
 
     """
     maximum_threshold = float(maximum_threshold)
 
-    # Get numpy array from sitk objects.
-    # amask = sitk.GetArrayFromImage(mask)
-    # animg = sitk.GetArrayFromImage(img)
-
-    amask = mask_arr
-    animg = img_arr
+    amask = np.asarray(mask_arr)
+    animg = np.asarray(img_arr)
 
     # Classify connected image components
-    if b_class_components:
-        amask_comp, num_comp = skimage.measure.label(amask,
-                                                     neighbors=None,
-                                                     background=None,
-                                                     return_num=True,
-                                                     connectivity=None)
-    else:
-        amask_comp = amask
-        num_comp = 1
+    amask_comp, num_comp = label_components(amask, b_class_components)
 
     print(f'Detected {num_comp} connected components.')
 
+    if b_out_labeled_mask:
+        if b_out_stats:
+            return amask_comp, lesion_stats(animg, amask_comp, num_comp, spacing)
+        return amask_comp
+
+    # Bounding boxes and maximum SUV values of all components.
+    comp_boxes = ndimage.find_objects(amask_comp, max_label=num_comp)
+    comp_max = ndimage.maximum(animg, amask_comp, index=np.arange(1, num_comp + 1))
+    comp_max = np.atleast_1d(comp_max)
+
     # Create new mask based on the selected threshold.
     amask_th = np.zeros_like(amask)
 
     # Calculate SUV value thresholds for each connected component.
-    for comp in range(num_comp):
+    for comp, comp_box in enumerate(comp_boxes):
+        if comp_box is None:
+            continue
 
         if verbose:
             print(f'Component {comp}')
 
-        sel_comp = (amask_comp == (comp + 1))
-        # Get SUV values inside the selected component.
-        suv_values = animg[sel_comp]
+        sel_comp = (amask_comp[comp_box] == (comp + 1))
+        img_box = animg[comp_box]
+        suv_max = comp_max[comp]
 
-        suv_max = np.max(suv_values)
+        if b_use_percentile_threshold or verbose:
+            # Get SUV values inside the selected component.
+            suv_values = img_box[sel_comp]
 
         if verbose:
             print(f'#SUV values {suv_values.shape}')
-            print(f'Max. SUV value: {np.max(suv_values)}')
+            print(f'Max. SUV value: {suv_max}')
             print(f'{percentile_threshold} percentile SUV value threshold {np.percentile(suv_values, percentile_threshold)}')
             print(f'Relative max. SUV value threshold ({maximum_threshold}%): {suv_max * maximum_threshold/100.0}')
 
@@ -85,15 +196,200 @@ def isocont(img_arr,
         if verbose:
             print(f'Used threshold: {th}')
 
-        amask_th = amask_th + np.logical_and(np.greater_equal(animg, th), sel_comp)
+        amask_th[comp_box] += np.logical_and(np.greater_equal(img_box, th), sel_comp)
+
+    if b_out_stats:
+        amask_lesions = np.where(amask_th > 0, amask_comp, 0)
+        return amask_th, lesion_stats(animg, amask_lesions, num_comp, spacing)
 
     return amask_th
 
 
+def isocont_sweep(img_arr,
+                  mask_arr,
+                  thresholds,
+                  b_class_components=True,
+                  b_use_percentile_threshold=True,
+                  b_out_stacked_mask=False,
+                  spacing=(1.0, 1.0, 1.0),
+                  verbose=False):
+    """
+    Computes volume-vs-threshold curves for a list of thresholds in a single pass.
+
+    The components are labeled once and the SUV values of each component are
+    sorted once, all thresholds are evaluated on the sorted values.
+
+    Args:
+        img_arr: array of a PET-SUV image.
+        mask_arr: array of a tumor mask.
+        thresholds: list of percentile or relative maximum thresholds (percent).
+        b_class_components: Detected connected components and use component based threshold.
+        b_use_percentile_threshold: Use percentile based thresholds (otherwise relative maximum value thresholds
+                                    are used.
+        b_out_stacked_mask: Additionally return the stacked mask, each voxel contains the number of
+                            (ascending) thresholds it passes (see sweep_mask).
+        spacing: voxel spacing in mm (array axis order).
+        verbose:
+
+    Returns: pandas DataFrame (label, threshold, threshold_value, voxels, mtv_ml)
+             (and stacked mask, if b_out_stacked_mask).
+
+    """
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    animg = np.asarray(img_arr)
+    amask_comp, num_comp = label_components(np.asarray(mask_arr), b_class_components)
+
+    print(f'Detected {num_comp} connected components.')
+
+    comp_boxes = ndimage.find_objects(amask_comp, max_label=num_comp)
+    voxel_volume = float(np.prod(spacing)) / 1000.0
+    if b_out_stacked_mask:
+        amask_stacked = np.zeros(amask_comp.shape, dtype=np.uint8 if len(thresholds) < 256 else np.uint16)
+
+    rows = []
+    for comp, comp_box in enumerate(comp_boxes):
+        if comp_box is None:
+            continue
+        sel_comp = (amask_comp[comp_box] == (comp + 1))
+        img_box = animg[comp_box]
+        suv_values = np.sort(img_box[sel_comp])
+
+        if b_use_percentile_threshold:
+            th_values = np.percentile(suv_values, thresholds)
+        else:
+            th_values = suv_values[-1] * thresholds / 100.0
+        # Number of voxels >= threshold for all thresholds.
+        counts = len(suv_values) - np.searchsorted(suv_values, th_values, side='left')
+
+        if verbose:
+            print(f'Component {comp}: {list(zip(thresholds, counts))}')
+
+        for th, th_value, count in zip(thresholds, th_values, counts):
+            rows.append((comp + 1, th, th_value, count, count * voxel_volume))
+
+        if b_out_stacked_mask:
+            levels = np.searchsorted(th_values, img_box, side='right')
+            amask_stacked[comp_box][sel_comp] = levels[sel_comp]
+
+    curves = pd.DataFrame(rows, columns=['label', 'threshold', 'threshold_value', 'voxels', 'mtv_ml'])
+    if b_out_stacked_mask:
+        return curves, amask_stacked
+    return curves
+
+
+def sweep_mask(amask_stacked, thresholds, threshold):
+    """
+    Selects the mask of a single threshold from a stacked sweep mask.
+
+    Args:
+        amask_stacked: stacked mask (see isocont_sweep).
+        thresholds: thresholds used for the sweep.
+        threshold: selected threshold (one of thresholds).
+
+    Returns: binary mask (uint8).
+
+    """
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    idx = int(np.searchsorted(thresholds, float(threshold)))
+    if idx == len(thresholds) or thresholds[idx] != float(threshold):
+        raise ValueError(f'Threshold {threshold} is not part of the sweep {list(thresholds)}.')
+    return (amask_stacked > idx).astype(np.uint8)
+
+
+def isocont_nii(pet_file,
+                mask_file,
+                out_file,
+                b_out_labeled_mask=False,
+                b_out_stats=False,
+                cache=False,
+                **kwargs):
+    """
+    Applies isocont to nii files and writes the new mask.
+
+    Args:
+        pet_file: PET-SUV .nii file.
+        mask_file: tumor mask .nii file.
+        out_file: output mask .nii file.
+        b_out_labeled_mask: Output labeled component mask, no thresholding.
+        b_out_stats: Compute the per-component statistics table.
+        cache: Read the PET image through the process-local image cache
+            (e.g. several masks of the same PET image).
+        **kwargs: further isocont parameters.
+
+    Returns: statistics table (if b_out_stats) or None
+
+    """
+    # Read image and mask data.
+    img = imcache.load_image(pet_file) if cache else sitk.ReadImage(str(pet_file))
+    mask = sitk.ReadImage(str(mask_file))
+
+    result = isocont(sitk.GetArrayFromImage(img),
+                     sitk.GetArrayFromImage(mask),
+                     b_out_labeled_mask=b_out_labeled_mask,
+                     b_out_stats=b_out_stats,
+                     spacing=img.GetSpacing()[::-1],
+                     **kwargs)
+    stats = None
+    if b_out_stats:
+        amask_th, stats = result
+    else:
+        amask_th = result
+
+    # Create mask_out sitk img. If out_labeled_mask, the output image just
+    # contains the labeled connected component mask.
+    if b_out_labeled_mask:
+        mask_out = sitk.GetImageFromArray(amask_th.astype(np.uint16))
+    else:
+        mask_out = sitk.GetImageFromArray(amask_th.astype(np.uint8))
+
+    # Copy MetaData from original mask.
+    mask_out.SetDirection(mask.GetDirection())
+    mask_out.SetOrigin(mask.GetOrigin())
+    mask_out.SetSpacing(mask.GetSpacing())
+
+    writer = sitk.ImageFileWriter()
+    writer.SetFileName(str(out_file))
+    writer.Execute(mask_out)
+
+    return stats
+
+
+def isocont_batch(jobs,
+                  stats_file=None,
+                  num_cores=4,
+                  **kwargs):
+    """
+    Applies isocont to a cohort of nii files using a process pool.
+
+    Args:
+        jobs: list of (pet_file, mask_file, out_file) tuples.
+        stats_file: .csv file for the combined statistics table (optional).
+        num_cores: number of processes.
+        **kwargs: further isocont_nii parameters.
+
+    Returns: combined statistics table (if stats_file) or None
+
+    """
+    b_out_stats = stats_file is not None
+    tables = Parallel(n_jobs=num_cores)(
+        delayed(isocont_nii)(pet_file, mask_file, out_file, b_out_stats=b_out_stats, **kwargs)
+        for pet_file, mask_file, out_file in jobs)
+
+    if not b_out_stats:
+        return None
+
+    for (pet_file, mask_file, _), table in zip(jobs, tables):
+        table.insert(0, 'mask', str(mask_file))
+        table.insert(0, 'pet', str(pet_file))
+    stats = pd.concat(tables, ignore_index=True)
+    write_table(stats, stats_file)
+    return stats
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--pet',  help='pet image .nii file', required=True)
-    parser.add_argument('-m', '--mask', help='mask .nii file', required=True)
+    parser.add_argument('-i', '--pet',  help='pet image .nii file')
+    parser.add_argument('-m', '--mask', help='mask .nii file')
     parser.add_argument('-o', '--out',  help='output .nii file')
     parser.add_argument('-l', '--Praefix', help='praefix for output filename')
 
@@ -105,18 +401,24 @@ def main():
     parser.add_argument('-c', '--OutputCompLabels', help='output component label mask', action='store_true')
     parser.add_argument('-g', '--NoComponents', help='do not detect connected components first', action='store_true')
     parser.add_argument('-v', '--Verbose', help='verbose', action='store_true')
+    parser.add_argument('-s', '--Stats', help='lesion statistics output file (.csv)')
+    parser.add_argument('--Sweep', help='threshold sweep, list of thresholds (e.g. 10,20,30). '
+                                        'Writes the volume curves to --Stats and the stacked mask '
+                                        '(or the mask of --SweepSelect) to the output file')
+    parser.add_argument('--SweepSelect', help='write the mask of this sweep threshold', type=float)
+    parser.add_argument('-b', '--Batch', help='.csv file with columns pet,mask(,out) (cohort mode)')
+    parser.add_argument('--cores', help='number of processes (cohort mode)', type=int, default=4)
 
     args = parser.parse_args()
 
-    path_pet = Path(args.pet)
-    path_mask = Path(args.mask)
-    # todo test if nii file exists
-    path_mask_out = args.out
-    if not path_mask_out:
-        praefix = 'iso_'
-        if args.Praefix:
-            praefix = args.Praefix
-        path_mask_out = path_mask.parent.joinpath(praefix + path_mask.name)
+    if not args.Batch and not (args.pet and args.mask):
+        parser.error('--pet and --mask (or --Batch) are required')
+    if args.Stats and Path(args.Stats).suffix.lower() != '.csv':
+        parser.error('--Stats must be a .csv file')
+
+    praefix = 'iso_'
+    if args.Praefix:
+        praefix = args.Praefix
 
     maximum_threshold = 10.0
     if args.SetMaximumThreshold:
@@ -130,37 +432,67 @@ def main():
         if args.ThresholdType == 'Maximum':
             b_use_percentile_threshold = False
 
-    # Read image and mask data.
-    img = sitk.ReadImage(str(path_pet))
-    mask = sitk.ReadImage(str(path_mask))
-
     verbose = args.Verbose
     b_class_components = not args.NoComponents
     b_out_labeled_mask = args.OutputCompLabels
 
-    amask_th = isocont(img,
-                       mask,
-                       b_out_labeled_mask=b_out_labeled_mask,
-                       b_class_components=b_class_components,
-                       b_use_percentile_threshold=b_use_percentile_threshold,
-                       percentile_threshold=percentile_threshold,
-                       maximum_threshold=maximum_threshold,
-                       verbose=verbose)
-
-    # Create mask_out sitk img. If out_labeled_mask, the output image just
-    # contains the labeled connected component mask.
-    mask_out = sitk.GetImageFromArray(amask_th.astype(np.uint8))
-    if b_out_labeled_mask:
-        mask_out = sitk.GetImageFromArray(amask_comp.astype(np.uint8))
+    params = dict(b_out_labeled_mask=b_out_labeled_mask,
+                  b_class_components=b_class_components,
+                  b_use_percentile_threshold=b_use_percentile_threshold,
+                  percentile_threshold=percentile_threshold,
+                  maximum_threshold=maximum_threshold,
+                  verbose=verbose)
+
+    if args.Sweep:
+        thresholds = [float(th) for th in args.Sweep.split(',')]
+        path_mask = Path(args.mask)
+        path_mask_out = args.out
+        if not path_mask_out:
+            path_mask_out = path_mask.parent.joinpath(praefix + path_mask.name)
+        img = sitk.ReadImage(str(args.pet))
+        mask = sitk.ReadImage(str(path_mask))
+        curves, amask_stacked = isocont_sweep(sitk.GetArrayFromImage(img),
+                                              sitk.GetArrayFromImage(mask),
+                                              thresholds,
+                                              b_class_components=b_class_components,
+                                              b_use_percentile_threshold=b_use_percentile_threshold,
+                                              b_out_stacked_mask=True,
+                                              spacing=img.GetSpacing()[::-1],
+                                              verbose=verbose)
+        if args.Stats:
+            write_table(curves, args.Stats)
+        else:
+            print(curves.groupby('threshold')[['voxels', 'mtv_ml']].sum())
+        if args.SweepSelect is not None:
+            amask_stacked = sweep_mask(amask_stacked, thresholds, args.SweepSelect)
+        mask_out = sitk.GetImageFromArray(amask_stacked)
+        mask_out.CopyInformation(mask)
+        sitk.WriteImage(mask_out, str(path_mask_out))
+        return
+
+    if args.Batch:
+        jobs = []
+        for row in pd.read_csv(args.Batch).to_dict('records'):
+            path_mask = Path(row['mask'])
+            path_mask_out = row.get('out')
+            if not isinstance(path_mask_out, str):
+                path_mask_out = path_mask.parent.joinpath(praefix + path_mask.name)
+            jobs.append((row['pet'], path_mask, path_mask_out))
+        isocont_batch(jobs, stats_file=args.Stats, num_cores=args.cores, **params)
+        return
 
-    # Copy MetaData from original mask.
-    mask_out.SetDirection(mask.GetDirection())
-    mask_out.SetOrigin(mask.GetOrigin())
-    mask_out.SetSpacing(mask.GetSpacing())
+    path_pet = Path(args.pet)
+    path_mask = Path(args.mask)
+    # todo test if nii file exists
+    path_mask_out = args.out
+    if not path_mask_out:
+        path_mask_out = path_mask.parent.joinpath(praefix + path_mask.name)
 
-    writer = sitk.ImageFileWriter()
-    writer.SetFileName(str(path_mask_out))
-    writer.Execute(mask_out)
+    stats = isocont_nii(path_pet, path_mask, path_mask_out,
+                        b_out_stats=args.Stats is not None,
+                        **params)
+    if stats is not None:
+        write_table(stats, args.Stats)
 
 
 if __name__ == '__main__':
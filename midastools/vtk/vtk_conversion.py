@@ -1,9 +1,46 @@
 import vtk
 from vtk.util import numpy_support
 import math
+import numpy as np
+import SimpleITK as sitk
+from midastools.misc.nifti import image_array_view
 
 
-def poly_to_img(poly, origin=None, dim=None, spacing=(1.0, 1.0, 1.0)):
+def poly_to_img(poly, origin=None, dim=None, spacing=(1.0, 1.0, 1.0), direction=None, ref_img=None):
+    """
+    Voxelizes a closed surface mesh (foreground 1, background 0, unsigned char).
+
+    The stencil is only evaluated inside the (index) bounding box of the mesh,
+    the image buffers are numpy-backed.
+
+    :param poly: vtk poly data (closed surface, physical coordinates)
+    :param origin: image origin (default: mesh bounds)
+    :param dim: image dimensions (default: mesh bounds / spacing)
+    :param spacing: image spacing
+    :param direction: direction cosines (9 values, row-major as in sitk), default: identity
+    :param ref_img: sitk image, overrides origin, dim, spacing and direction
+    :return: vtk image data
+    """
+
+    if ref_img is not None:
+        origin = ref_img.GetOrigin()
+        dim = ref_img.GetSize()
+        spacing = ref_img.GetSpacing()
+        direction = ref_img.GetDirection()
+
+    # for non-identity directions, rotate the mesh into the index-aligned frame
+    if direction is not None and not np.allclose(direction, np.eye(3).ravel()):
+        if origin is None:
+            raise ValueError('poly_to_img: an origin is required for non-identity directions.')
+        matrix = np.array(direction, dtype=float).reshape(3, 3)
+        points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData()).astype(float)
+        points = (points - origin) @ matrix + origin
+        poly_aligned = vtk.vtkPolyData()
+        poly_aligned.ShallowCopy(poly)
+        vtk_points = vtk.vtkPoints()
+        vtk_points.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+        poly_aligned.SetPoints(vtk_points)
+        poly = poly_aligned
 
     # compute dimensions and origin
     bounds = [0 for _ in range(6)]
@@ -19,136 +56,319 @@ def poly_to_img(poly, origin=None, dim=None, spacing=(1.0, 1.0, 1.0)):
         origin[1] = bounds[2]  # + spacing[0]/2
         origin[2] = bounds[4]  # + spacing[0]/2
 
-    # generate empty image volume
-    image_ = vtk.vtkImageData()
-    image_.SetSpacing(*spacing)
-    image_.SetDimensions(*dim)
-    image_.SetExtent(0, dim[0]-1, 0, dim[1]-1, 0, dim[2]-1)
-    image_.SetOrigin(*origin)
-    image_.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
-
-    # fill image with foreground voxels
+    dim = [int(d) for d in dim]
     inval = 1
     outval = 0
-    count = image_.GetNumberOfPoints()
-    for idx_pix in range(count):
-        image_.GetPointData().GetScalars().SetTuple1(idx_pix, inval)
-
-    # create image stencil
-    pol_to_stenc = vtk.vtkPolyDataToImageStencil()
-    pol_to_stenc.SetTolerance(0)
-    pol_to_stenc.SetInputData(poly)
-    pol_to_stenc.SetOutputOrigin(*origin)
-    pol_to_stenc.SetOutputSpacing(*spacing)
-    pol_to_stenc.SetOutputWholeExtent(image_.GetExtent())
-    pol_to_stenc.Update()
-
-    # cut the corresponding white image and set the background
-    image_stenc = vtk.vtkImageStencil()
-    image_stenc.SetInputData(image_)
-    image_stenc.SetStencilData(pol_to_stenc.GetOutput())
-    image_stenc.ReverseStencilOff()
-    image_stenc.SetBackgroundValue(outval)
-    image_stenc.Update()
-
-    return image_stenc.GetOutput()
+    np_image = np.full(dim, outval, dtype=np.uint8, order='F')
+
+    # index extent of the mesh bounds (one voxel margin)
+    sub_extent = []
+    for idx_dim in range(3):
+        idx_min = int(math.floor((bounds[idx_dim * 2] - origin[idx_dim]) / spacing[idx_dim])) - 1
+        idx_max = int(math.ceil((bounds[idx_dim * 2 + 1] - origin[idx_dim]) / spacing[idx_dim])) + 1
+        sub_extent += [max(idx_min, 0), min(idx_max, dim[idx_dim] - 1)]
+
+    if all(sub_extent[2 * i] <= sub_extent[2 * i + 1] for i in range(3)):
+        sub_dim = [sub_extent[2 * i + 1] - sub_extent[2 * i] + 1 for i in range(3)]
+
+        # generate foreground image volume (mesh bounds only)
+        image_ = vtk.vtkImageData()
+        image_.SetSpacing(*spacing)
+        image_.SetExtent(*sub_extent)
+        image_.SetOrigin(*origin)
+        image_.GetPointData().SetScalars(
+            numpy_support.numpy_to_vtk(np.full(int(np.prod(sub_dim)), inval, dtype=np.uint8),
+                                       deep=True, array_type=vtk.VTK_UNSIGNED_CHAR))
+
+        # create image stencil
+        pol_to_stenc = vtk.vtkPolyDataToImageStencil()
+        pol_to_stenc.SetTolerance(0)
+        pol_to_stenc.SetInputData(poly)
+        pol_to_stenc.SetOutputOrigin(*origin)
+        pol_to_stenc.SetOutputSpacing(*spacing)
+        pol_to_stenc.SetOutputWholeExtent(image_.GetExtent())
+        pol_to_stenc.Update()
+
+        # cut the corresponding white image and set the background
+        image_stenc = vtk.vtkImageStencil()
+        image_stenc.SetInputData(image_)
+        image_stenc.SetStencilData(pol_to_stenc.GetOutput())
+        image_stenc.ReverseStencilOff()
+        image_stenc.SetBackgroundValue(outval)
+        image_stenc.Update()
+
+        np_sub = numpy_support.vtk_to_numpy(image_stenc.GetOutput().GetPointData().GetScalars())
+        np_image[sub_extent[0]:sub_extent[1] + 1,
+                 sub_extent[2]:sub_extent[3] + 1,
+                 sub_extent[4]:sub_extent[5] + 1] = np_sub.reshape(sub_dim, order='F')
+
+    # full image volume
+    image_out = vtk.vtkImageData()
+    image_out.SetSpacing(*spacing)
+    image_out.SetDimensions(*dim)
+    image_out.SetExtent(0, dim[0]-1, 0, dim[1]-1, 0, dim[2]-1)
+    image_out.SetOrigin(*origin)
+    if direction is not None and hasattr(image_out, 'SetDirectionMatrix'):
+        image_out.SetDirectionMatrix(*direction)
+    image_out.GetPointData().SetScalars(
+        numpy_support.numpy_to_vtk(np_image.ravel(order='F'), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR))
+
+    return image_out
+
+
+def np_cells_to_vtk_cell_array(connectivity, offsets):
+    """
+    Builds a vtkCellArray from flat point ids and cell offsets (bulk array transfer).
+
+    :param connectivity: flat array of point ids of all cells
+    :param offsets: array of N_c + 1 cell offsets into connectivity
+    :return: vtk cell array
+    """
 
+    id_type = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+    connectivity = np.asarray(connectivity, dtype=id_type)
+    offsets = np.asarray(offsets, dtype=id_type)
 
-def np_verts_to_vtk_poly(np_verts, np_triangles=None):
+    vtk_cells = vtk.vtkCellArray()
+    if hasattr(vtk_cells, 'SetData') and hasattr(vtk_cells, 'GetOffsetsArray'):
+        # vtk >= 9: offsets / connectivity storage
+        vtk_cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                          numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=True))
+    else:
+        # legacy layout [n, id_0, ..., id_n-1, n, ...]
+        sizes = np.diff(offsets)
+        cells = np.empty(len(connectivity) + len(sizes), dtype=id_type)
+        starts = offsets[:-1] + np.arange(len(sizes))
+        cells[starts] = sizes
+        cells[np.delete(np.arange(len(cells)), starts)] = connectivity
+        vtk_cells.SetCells(len(sizes), numpy_support.numpy_to_vtkIdTypeArray(cells, deep=True))
+
+    return vtk_cells
+
+
+def np_uniform_cells_to_vtk_cell_array(np_cells):
     """
-    Takes in N_v x 3 numpy array of coordinates and N_t x 3 numpy array of triangle faces
+    Builds a vtkCellArray from an N_c x k array of point ids (cells of equal size).
     """
 
-    vtk_points = vtk.vtkPoints()
-    vtk_vertices = vtk.vtkCellArray()
+    np_cells = np.asarray(np_cells)
+    if np_cells.ndim != 2:
+        np_cells = np_cells.reshape(len(np_cells), -1 if np_cells.size else 0)
+    offsets = np.arange(len(np_cells) + 1)*np_cells.shape[1]
+    return np_cells_to_vtk_cell_array(np_cells.ravel(), offsets)
 
-    vtk_poly = vtk.vtkPolyData()
 
-    verts_temp = np_verts.tolist()
-    for vert_ in verts_temp:
-        id = vtk_points.InsertNextPoint(vert_)
-        vtk_vertices.InsertNextCell(1)
-        vtk_vertices.InsertCellPoint(id)
+def vtk_cell_array_to_np(vtk_cells):
+    """
+    Returns the flat point ids and the N_c + 1 cell offsets of a vtkCellArray.
+    """
+
+    if hasattr(vtk_cells, 'GetOffsetsArray'):
+        # vtk >= 9: offsets / connectivity storage
+        offsets = numpy_support.vtk_to_numpy(vtk_cells.GetOffsetsArray())
+        connectivity = numpy_support.vtk_to_numpy(vtk_cells.GetConnectivityArray())
+        if not len(offsets):
+            offsets = np.zeros(1, dtype=connectivity.dtype)
+        return connectivity, offsets
+
+    # legacy layout [n, id_0, ..., id_n-1, n, ...]
+    cells = numpy_support.vtk_to_numpy(vtk_cells.GetData())
+    n_cells = vtk_cells.GetNumberOfCells()
+    if n_cells and len(cells) % n_cells == 0 and np.all(cells[::len(cells)//n_cells] == len(cells)//n_cells - 1):
+        k = len(cells)//n_cells - 1
+        return cells.reshape(n_cells, k + 1)[:, 1:].ravel(), np.arange(n_cells + 1)*k
+    starts = np.zeros(n_cells, dtype=np.int64)
+    pos = 0
+    for idx in range(n_cells):
+        starts[idx] = pos
+        pos += int(cells[pos]) + 1
+    sizes = cells[starts]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    return np.delete(cells, starts), offsets
+
+
+def np_verts_to_vtk_poly(np_verts, np_triangles=None):
+    """
+    Takes in N_v x 3 numpy array of coordinates and N_t x 3 numpy array of triangle faces
+    (one vertex cell per point, triangle polys), using bulk array transfers.
+    """
 
-    vtk_poly.SetVerts(vtk_vertices)
+    vtk_poly = vtk.vtkPolyData()
+    vtk_points = np_to_vtk_points(np_verts)
+    n_points = vtk_points.GetNumberOfPoints()
+    vtk_poly.SetVerts(np_cells_to_vtk_cell_array(np.arange(n_points), np.arange(n_points + 1)))
     vtk_poly.SetPoints(vtk_points)
 
     if np_triangles is not None:
-        vtk_triangles = vtk.vtkCellArray()
+        vtk_poly.SetPolys(np_uniform_cells_to_vtk_cell_array(np_triangles))
+
+    return vtk_poly
+
+
+def np_triangles_to_vtk_poly(np_verts, np_triangles):
+    """
+    Builds a triangle mesh (no vertex cells) from N_v x 3 coordinates and N_t x 3 faces
+    using bulk array transfers.
+    """
 
-        triangles_temp = np_triangles.tolist()
-        for tri_ in triangles_temp:
-            vtk_tri = vtk.vtkTriangle()
-            vtk_tri.GetPointIds().SetId(0, tri_[0])
-            vtk_tri.GetPointIds().SetId(1, tri_[1])
-            vtk_tri.GetPointIds().SetId(2, tri_[2])
-            vtk_triangles.InsertNextCell(vtk_tri)
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(np_verts), deep=True))
 
-        vtk_poly.SetPolys(vtk_triangles)
+    vtk_poly = vtk.vtkPolyData()
+    vtk_poly.SetPoints(vtk_points)
+    vtk_poly.SetPolys(np_uniform_cells_to_vtk_cell_array(np_triangles))
 
     return vtk_poly
 
 
 def vtk_poly_to_np_verts(vtk_poly):
     """
-    Note: code expects that polydata contains vertices and only triangle polygons
+    Returns the point coordinates and the triangles of the polygons of a poly data object.
+    Non-triangle polygons (mixed cell types, e.g. quads) are fan-triangulated,
+    vertex and line cells are ignored.
     :param vtk_poly:
-    :return:
+    :return: N_v x 3 coordinates, N_t x 3 triangles
     """
 
     # make sure you're fetching the correct info GetVerts() / GetPoints()
     vtk_verts = vtk_poly.GetPoints()
     np_verts = numpy_support.vtk_to_numpy(vtk_verts.GetData())
 
-    vtk_poly_cells = vtk_poly.GetPolys()
-    n_polys = vtk_poly.GetNumberOfPolys()
-    np_triangles_raw = numpy_support.vtk_to_numpy(vtk_poly_cells.GetData())
-    np_triangles = np_triangles_raw.reshape((n_polys, -1))[..., 1:]  # Note: there is currently no check that assures that triangles are received
+    connectivity, offsets = vtk_cell_array_to_np(vtk_poly.GetPolys())
+    sizes = np.diff(offsets)
+    if len(sizes) and np.all(sizes == 3):
+        return np_verts, connectivity.reshape(-1, 3)
+
+    # fan triangulation (p0, p_i, p_i+1) of all polygons with >= 3 points
+    n_triangles = np.maximum(sizes - 2, 0)
+    first = np.repeat(offsets[:-1], n_triangles)
+    local = np.arange(n_triangles.sum()) - np.repeat(np.cumsum(n_triangles) - n_triangles, n_triangles)
+    np_triangles = np.stack([connectivity[first],
+                             connectivity[first + local + 1],
+                             connectivity[first + local + 2]], axis=1)
 
     return np_verts, np_triangles
 
 
 def vtk_to_itk_image(image_vtk):
+    """
+    Converts vtk image data to a SimpleITK image (dtype, origin, spacing and direction preserved).
+    SimpleITK images own their buffer, so the pixel data is copied once.
+    :param image_vtk: vtk image data
+    :return: sitk image
+    """
 
-    # TODO: needs ITKVtkGlue which requires ITK to be compiled from source and built again a specific VTK version
-    #       pypi wheel is coming - try from source https://github.com/InsightSoftwareConsortium/ITKVtkGlue/blob/master/setup.py in the meantime
-    raise NotImplementedError('Requires ITKVtkGlue module during ITK compilation.')
+    np_image, geometry = vtk_to_numpy_image(image_vtk, return_geometry=True)
+    n_components = image_vtk.GetNumberOfScalarComponents()
+    # vtk (x, y, z[, c]) fortran order -> sitk (z, y, x[, c]) c order view
+    img = sitk.GetImageFromArray(np.moveaxis(np_image, [0, 1, 2], [2, 1, 0]) if n_components > 1 else np_image.T,
+                                 isVector=n_components > 1)
+    img.SetOrigin(geometry['origin'])
+    img.SetSpacing(geometry['spacing'])
+    img.SetDirection(geometry['direction'])
+    return img
 
 
-def vtk_to_numpy_image(vtk_image):
+def vtk_image_geometry(vtk_image):
+    """
+    Origin (of index 0 of the extent), spacing and direction (row-major) of vtk image data.
+    """
+
+    direction = np.eye(3)
+    if hasattr(vtk_image, 'GetDirectionMatrix'):
+        matrix = vtk_image.GetDirectionMatrix()
+        direction = np.array([[matrix.GetElement(i, j) for j in range(3)] for i in range(3)])
+    spacing = np.array(vtk_image.GetSpacing())
+    extent_min = np.array(vtk_image.GetExtent()[::2])
+    origin = np.array(vtk_image.GetOrigin()) + direction @ (extent_min*spacing)
+    return {'origin': tuple(origin.tolist()),
+            'spacing': tuple(spacing.tolist()),
+            'direction': tuple(direction.ravel().tolist())}
+
+
+def vtk_to_numpy_image(vtk_image, return_geometry=False):
+    """
+    Returns the scalars of vtk image data as (x, y, z[, components]) array.
+    The array is a view of the vtk buffer (and keeps it alive), the dtype is preserved.
+    :param vtk_image: vtk image data
+    :param return_geometry: also return origin, spacing and direction (dict)
+    :return: numpy array (, geometry)
+    """
 
     dims = vtk_image.GetDimensions()
     data = vtk_image.GetPointData().GetScalars()  # was .GetArray(0)
 
     np_image = numpy_support.vtk_to_numpy(data)
-    np_image = np_image.reshape(dims, order='F')
+    if data.GetNumberOfComponents() > 1:
+        np_image = np.moveaxis(np_image.reshape(dims[::-1] + (-1,)), [0, 1, 2], [2, 1, 0])
+    else:
+        np_image = np_image.reshape(dims, order='F')
 
+    if return_geometry:
+        return np_image, vtk_image_geometry(vtk_image)
     return np_image
 
 
-def np_to_vtk_data(np_data):
+def np_to_vtk_data(np_data, deep=False):
+    """
+    Converts a (x, y, z) numpy array to a vtk data array (dtype preserved, bool as unsigned char).
+    Fortran contiguous arrays are shared with vtk (the array is kept alive by the vtk
+    buffer), other arrays or deep=True are copied.
+    :param np_data: numpy array (x, y, z)
+    :param deep: always copy the data
+    :return: vtk data array
+    """
 
-    # convert numpy array to vtk image data object
-    vtk_data = numpy_support.numpy_to_vtk(num_array=np_data.ravel(order='f'),
-                                          deep=True,
-                                          array_type=vtk.VTK_UNSIGNED_CHAR)
+    if np_data.dtype == bool:
+        np_data = np_data.view(np.uint8)
+    flat = np_data.ravel(order='F')
+    # ravel returns a copy for non fortran contiguous arrays, which has to be owned by vtk
+    deep = deep or not np.shares_memory(flat, np_data)
+    vtk_data = numpy_support.numpy_to_vtk(num_array=flat, deep=deep)
 
     return vtk_data
 
 
+def np_to_vtk_image(np_data, origin=(0, 0, 0), spacing=(1, 1, 1), direction=None, deep=False):
+    """
+    Converts a (x, y, z) numpy array to vtk image data with geometry (see np_to_vtk_data).
+    """
+
+    return vtk_data_to_image(np_to_vtk_data(np_data, deep=deep), np_data.shape[:3],
+                             origin=origin, spacing=spacing, direction=direction)
+
+
+def sitk_to_vtk_image(img, deep=False):
+    """
+    Converts a SimpleITK image to vtk image data (dtype, origin, spacing and direction preserved).
+    Without deep copy, the vtk image shares the (read only) sitk buffer and keeps the sitk
+    image alive.
+    :param img: sitk image (3d)
+    :param deep: copy the pixel data
+    :return: vtk image data
+    """
+
+    # (z, y, x[, c]) c order == vtk (x fastest) order
+    np_data = image_array_view(img)
+    n_components = img.GetNumberOfComponentsPerPixel()
+    flat = np_data.reshape(-1, n_components) if n_components > 1 else np_data.ravel()
+    if flat.dtype == bool:
+        flat = flat.view(np.uint8)
+    vtk_data = numpy_support.numpy_to_vtk(num_array=flat, deep=deep)
+    return vtk_data_to_image(vtk_data, img.GetSize(), origin=img.GetOrigin(),
+                             spacing=img.GetSpacing(), direction=img.GetDirection())
+
+
 def np_to_vtk_points(np_points):
     """
 
     :param points: numpy array (Nx3) of coordinates)
-    :return:
+    :return: vtk points (float)
     """
 
-    points_temp = np_points.tolist()
-
     vtk_points = vtk.vtkPoints()
-    vtk_points.SetNumberOfPoints(len(points_temp))
-    for idx, point in enumerate(points_temp):
-        vtk_points.SetPoint(idx, *point)
+    vtk_points.SetData(numpy_support.numpy_to_vtk(
+        np.ascontiguousarray(np_points, dtype=np.float32).reshape(-1, 3), deep=True))
 
     return vtk_points
 
@@ -161,12 +381,9 @@ def vtk_points_to_polyline(vtk_points):
     :return:
     """
 
-    lines = vtk.vtkCellArray()
-    for k in range(vtk_points.GetNumberOfPoints() - 1):
-        line = vtk.vtkLine()
-        line.GetPointIds().SetId(0, k)
-        line.GetPointIds().SetId(1, k + 1)
-        lines.InsertNextCell(line)
+    n_lines = max(vtk_points.GetNumberOfPoints() - 1, 0)
+    segments = np.stack([np.arange(n_lines), np.arange(1, n_lines + 1)], axis=1)
+    lines = np_uniform_cells_to_vtk_cell_array(segments)
 
     polyline = vtk.vtkPolyData()
     polyline.SetLines(lines)
@@ -175,7 +392,7 @@ def vtk_points_to_polyline(vtk_points):
     return polyline
 
 
-def vtk_data_to_image(vtk_data, dims, origin=(0, 0, 0), spacing=(1, 1, 1)):
+def vtk_data_to_image(vtk_data, dims, origin=(0, 0, 0), spacing=(1, 1, 1), direction=None):
 
     # generate vtk image volume from vtk data array
     vtk_image = vtk.vtkImageData()
@@ -183,6 +400,8 @@ def vtk_data_to_image(vtk_data, dims, origin=(0, 0, 0), spacing=(1, 1, 1)):
     vtk_image.SetDimensions(*dims)
     vtk_image.SetExtent(0, dims[0] - 1, 0, dims[1] - 1, 0, dims[2] - 1)
     vtk_image.SetOrigin(*origin)
+    if direction is not None and hasattr(vtk_image, 'SetDirectionMatrix'):
+        vtk_image.SetDirectionMatrix(*direction)
     vtk_image.GetPointData().SetScalars(vtk_data)
 
     return vtk_image
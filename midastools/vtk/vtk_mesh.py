@@ -1,4 +1,7 @@
 import vtk
+import numpy as np
+from vtk.util import numpy_support
+from midastools.vtk import vtk_conversion
 
 
 def clean(vtk_poly):
@@ -102,6 +105,80 @@ def marching_cube(vtk_image, label_values=(1,)):
     return march.GetOutput()
 
 
+def split_labels(vtk_poly, label_values=None, direction=None, origin=(0, 0, 0)):
+    """
+    splits a (discrete marching cubes) surface into one mesh per label,
+    using the cell scalars (labels) of the surface
+
+    :param vtk_poly: triangle surface with label cell scalars
+    :param label_values: labels to extract (default: all labels)
+    :param direction: direction cosines (9 values, row-major as in sitk), rotates the points around origin
+    :param origin: image origin (rotation center)
+    :return: dict label -> vtk poly data
+    """
+
+    labels = numpy_support.vtk_to_numpy(vtk_poly.GetCellData().GetScalars())
+    np_verts, np_triangles = vtk_conversion.vtk_poly_to_np_verts(vtk_poly)
+    if direction is not None:
+        matrix = np.array(direction, dtype=float).reshape(3, 3)
+        np_verts = (np_verts - origin) @ matrix.T + origin
+
+    # group the triangles by label (one sort)
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    if label_values is None:
+        label_values = np.unique(sorted_labels)
+
+    meshes = {}
+    for value in label_values:
+        lo = np.searchsorted(sorted_labels, value, side='left')
+        hi = np.searchsorted(sorted_labels, value, side='right')
+        triangles = np_triangles[order[lo:hi]]
+        point_ids, faces = np.unique(triangles, return_inverse=True)
+        key = int(value) if float(value).is_integer() else value
+        meshes[key] = vtk_conversion.np_triangles_to_vtk_poly(np_verts[point_ids],
+                                                              faces.reshape(-1, 3))
+    return meshes
+
+
+def marching_cube_labels(vtk_image,
+                         label_values=(1,),
+                         direction=None,
+                         smooth_filter=None,
+                         smooth_itr=40,
+                         relaxation=0.2,
+                         target_reduction=None):
+    """
+    multi-label image to surface mesh conversion: a single discrete marching cubes
+    pass over all labels, split into one mesh per label, optionally smoothed and
+    decimated
+
+    :param vtk_image: label image (vtk image data with origin and spacing)
+    :param label_values: labels to extract
+    :param direction: direction cosines (9 values, row-major as in sitk), default: identity
+    :param smooth_filter: 'sinc', 'laplacian' or None (no smoothing)
+    :param smooth_itr: smoothing iterations
+    :param relaxation: laplacian relaxation factor
+    :param target_reduction: decimation (DecimatePro) target reduction or None
+    :return: dict label -> vtk poly data (physical coordinates)
+    """
+
+    vtk_poly = marching_cube(vtk_image, label_values)
+    meshes = split_labels(vtk_poly, label_values,
+                          direction=direction, origin=np.array(vtk_image.GetOrigin()))
+
+    for value, mesh in meshes.items():
+        if mesh.GetNumberOfPolys() == 0:
+            continue
+        if smooth_filter is not None:
+            mesh = smooth(mesh, smooth_filter=smooth_filter, smooth_itr=smooth_itr, relaxation=relaxation)
+        if target_reduction is not None:
+            mesh = reduce_poly(mesh, decimator='pro', target_reduction=target_reduction)
+        meshes[value] = mesh
+
+    return meshes
+
+
 def threshold(vtk_poly, min_val=0, max_val=1):
 
     vtk_thresh = vtk.vtkThreshold()
@@ -0,0 +1,47 @@
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, validate_file_meta
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+PYDICOM_MAJOR = int(pydicom.__version__.split('.')[0])
+
+
+def write_dicom(filepath, pixels, sop_class_uid, **elements):
+    """Writes a single slice dicom file (explicit VR little endian).
+
+    Written with the API shared by the pinned pydicom 1.x and current releases
+    (FileDataset with validated file meta information).
+
+    Args:
+        filepath (str/Path): output file
+        pixels (np.array): (rows, columns) uint16 pixel data
+        sop_class_uid (str): SOP class uid
+        **elements: further data elements (dicom keyword=value)
+
+    Returns:
+        Path: the written file
+    """
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = sop_class_uid
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    validate_file_meta(meta, enforce_standard=True)
+
+    ds = FileDataset(str(filepath), {}, file_meta=meta, preamble=b'\0' * 128)
+    if PYDICOM_MAJOR < 3:
+        # derived from the transfer syntax in pydicom >= 3
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    for keyword, value in elements.items():
+        setattr(ds, keyword, value)
+    pixels = np.asarray(pixels, dtype=np.uint16)
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = pixels.tobytes()
+    ds.save_as(str(filepath))
+    return filepath
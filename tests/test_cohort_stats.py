@@ -0,0 +1,139 @@
+import sys
+import numpy as np
+import nibabel as nib
+import pytest
+from midastools.misc import cohort_stats
+from midastools.misc.cohort_stats import (QuantileSketch, Histogram, IntensityStats, iter_slabs, image_stats,
+                                          merge_stats, cohort_stats as compute_cohort_stats)
+
+
+def sample_values(seed=0):
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.lognormal(3, 1.5, 5000), -rng.lognormal(1, 1, 1000),
+                           np.zeros(200), rng.uniform(0, 1e-3, 100)])
+
+
+def write_nii(nii_file, data):
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(nii_file))
+
+
+@pytest.mark.parametrize('relative_accuracy', [0.01, 0.05])
+def test_sketch_accuracy(relative_accuracy):
+    values = sample_values()
+    sketch = QuantileSketch(relative_accuracy)
+    sketch.add(np.append(values, [np.nan, np.inf]))
+    assert sketch.count == values.size
+    quantiles = np.linspace(0, 1, 41)
+    estimates = sketch.quantile(quantiles)
+    exact = np.sort(values)[np.floor(quantiles*(values.size - 1)).astype(int)]
+    np.testing.assert_array_less(np.abs(estimates - exact), relative_accuracy*np.abs(exact) + sketch.min_value)
+    assert np.isnan(QuantileSketch().quantile(0.5)).all()
+
+
+def test_sketch_merge():
+    values = sample_values()
+    whole, merged = QuantileSketch(0.02), QuantileSketch(0.02)
+    whole.add(values)
+    for part in np.array_split(np.random.default_rng(1).permutation(values), 7):
+        sketch = QuantileSketch(0.02)
+        sketch.add(part)
+        merged.merge(sketch)
+    assert merged.count == whole.count
+    quantiles = np.linspace(0, 1, 101)
+    np.testing.assert_array_equal(merged.quantile(quantiles), whole.quantile(quantiles))
+    with pytest.raises(ValueError):
+        merged.merge(QuantileSketch(0.01))
+
+
+def test_histogram_merge():
+    values = sample_values()
+    whole, merged = Histogram((0, 100), 20), Histogram((0, 100), 20)
+    whole.add(values)
+    for part in np.array_split(values, 3):
+        histogram = Histogram((0, 100), 20)
+        histogram.add(part)
+        merged.merge(histogram)
+    np.testing.assert_array_equal(merged.counts, np.histogram(values, merged.edges)[0])
+    np.testing.assert_array_equal(merged.counts, whole.counts)
+    assert merged.underflow == (values < 0).sum() and merged.overflow == (values > 100).sum()
+    assert merged.counts.sum() + merged.underflow + merged.overflow == values.size
+    with pytest.raises(ValueError):
+        merged.merge(Histogram((0, 50), 20))
+
+
+def test_iter_slabs(tmp_path):
+    data = np.random.default_rng(0).random((5, 6, 37)).astype(np.float32)
+    mask = (data > 0.5).astype(np.uint8)
+    write_nii(tmp_path / 'img.nii.gz', data)
+    write_nii(tmp_path / 'mask.nii.gz', mask)
+    slabs = list(iter_slabs(tmp_path / 'img.nii.gz', tmp_path / 'mask.nii.gz', slab_size=16))
+    assert [slab.shape[2] for slab, _ in slabs] == [16, 16, 5]
+    np.testing.assert_array_equal(np.concatenate([slab for slab, _ in slabs], axis=2), data)
+    np.testing.assert_array_equal(np.concatenate([m for _, m in slabs], axis=2), mask)
+    assert all(m is None for _, m in iter_slabs(tmp_path / 'img.nii.gz', slab_size=37))
+
+    write_nii(tmp_path / 'small.nii.gz', mask[:, :, :10])
+    with pytest.raises(ValueError):
+        list(iter_slabs(tmp_path / 'img.nii.gz', tmp_path / 'small.nii.gz'))
+
+
+def check_summary(stats, values, relative_accuracy):
+    summary = stats.summary((0.1, 0.5, 0.9))
+    assert summary['count'] == values.size
+    assert summary['mean'] == pytest.approx(values.mean())
+    assert summary['std'] == pytest.approx(values.std(), rel=1e-6)
+    assert summary['min'] == values.min() and summary['max'] == values.max()
+    for q in (0.1, 0.5, 0.9):
+        exact = np.sort(values)[int(np.floor(q*(values.size - 1)))]
+        assert summary[f'p{100*q:g}'] == pytest.approx(exact, rel=relative_accuracy)
+
+
+def test_image_stats_per_label(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.normal(100, 20, (8, 9, 20)).astype(np.float32)
+    mask = rng.integers(0, 4, data.shape).astype(np.uint8)
+    write_nii(tmp_path / 'img.nii.gz', data)
+    write_nii(tmp_path / 'mask.nii.gz', mask)
+
+    stats = image_stats(tmp_path / 'img.nii.gz', tmp_path / 'mask.nii.gz', slab_size=7,
+                        relative_accuracy=0.01, value_range=(0, 200), num_bins=10)
+    assert sorted(stats) == [1, 2, 3]
+    for label, s in stats.items():
+        check_summary(s, data[mask == label].astype(np.float64), 0.01)
+        np.testing.assert_array_equal(s.histogram.counts, np.histogram(data[mask == label], s.histogram.edges)[0])
+    assert sorted(image_stats(tmp_path / 'img.nii.gz', tmp_path / 'mask.nii.gz', labels=[0, 2])) == [0, 2]
+    check_summary(image_stats(tmp_path / 'img.nii.gz')['all'], data.ravel().astype(np.float64), 0.01)
+
+
+def test_merge_stats(tmp_path):
+    rng = np.random.default_rng(0)
+    images = [rng.normal(100*(i + 1), 20, (6, 5, 9)).astype(np.float32) for i in range(3)]
+    masks = [rng.integers(0, 3, (6, 5, 9)).astype(np.uint8) for _ in range(3)]
+    jobs = []
+    for i, (data, mask) in enumerate(zip(images, masks)):
+        write_nii(tmp_path / f'img{i}.nii.gz', data)
+        write_nii(tmp_path / f'mask{i}.nii.gz', mask)
+        jobs.append((tmp_path / f'img{i}.nii.gz', tmp_path / f'mask{i}.nii.gz'))
+
+    table, cohort = compute_cohort_stats(jobs, num_cores=1, value_range=(0, 500), num_bins=25)
+    for label in (1, 2):
+        values = np.concatenate([d[m == label] for d, m in zip(images, masks)]).astype(np.float64)
+        check_summary(cohort[label], values, 0.01)
+        np.testing.assert_array_equal(cohort[label].histogram.counts, np.histogram(values, 25, (0, 500))[0])
+        row = table[(table['image'] == 'cohort') & (table['label'] == label)].iloc[0]
+        assert row['count'] == values.size
+    assert len(table) == 3*2 + 2
+
+    # merging does not modify the per-image statistics
+    stats = image_stats(*jobs[0])
+    count = stats[1].count
+    merge_stats([stats, stats])
+    assert stats[1].count == count
+    assert isinstance(merge_stats([stats])[1], IntensityStats)
+
+
+def test_cli_histogram_requires_range(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['cohort_stats', 'jobs.csv', '-o', str(tmp_path / 'out.csv'),
+                                      '--histogram', str(tmp_path / 'hist.npz')])
+    with pytest.raises(SystemExit):
+        cohort_stats.main()
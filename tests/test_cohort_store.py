@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from midastools.misc.cohort_store import export_cohort, CohortStore
+
+
+@pytest.fixture(scope='module')
+def cohort(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp('cohort')
+    rng = np.random.default_rng(0)
+    volumes = {'a': rng.integers(-500, 500, (11, 13, 9)).astype(np.int16),
+               'b': rng.random((7, 5, 17)).astype(np.float32)}
+    nii_files = []
+    for i, (name, volume) in enumerate(volumes.items()):
+        img = sitk.GetImageFromArray(volume)
+        img.SetOrigin((1. + i, -2., 3.))
+        img.SetSpacing((0.5, 1., 2.5))
+        img.SetDirection((0., 1., 0., -1., 0., 0., 0., 0., 1.))
+        nii_files.append(tmp_path / f'{name}.nii.gz')
+        sitk.WriteImage(img, str(nii_files[-1]))
+    stores = {}
+    for level in (0, 1):
+        store_dir = tmp_path / f'store{level}'
+        export_cohort(nii_files, store_dir, chunk_shape=(4, 6, 5), level=level, num_cores=1)
+        stores[level] = CohortStore(store_dir)
+    return volumes, nii_files, stores
+
+
+@pytest.mark.parametrize('level', [0, 1])
+def test_full_volume(cohort, level):
+    volumes, nii_files, stores = cohort
+    store = stores[level]
+    assert store.names == ['a', 'b'] and len(store) == 2 and 'a' in store
+    for (name, volume), nii_file in zip(volumes.items(), nii_files):
+        vol = store[name]
+        assert vol.shape == volume.shape and vol.dtype == volume.dtype
+        np.testing.assert_array_equal(np.asarray(vol), volume)
+        img, ref = vol.to_sitk(), sitk.ReadImage(str(nii_file))
+        assert img.GetOrigin() == ref.GetOrigin()
+        assert img.GetSpacing() == ref.GetSpacing()
+        assert img.GetDirection() == ref.GetDirection()
+
+
+@pytest.mark.parametrize('key', [
+    3, -1, (slice(None), 4), (Ellipsis, 2), (2, slice(1, 12), slice(3, 8)),
+    (slice(1, 10, 3), slice(None, None, -1), slice(8, 0, -2)), (slice(-4, None), -2),
+    (slice(5, 2), Ellipsis), (slice(0, 100), slice(-100, 3)),
+])
+def test_indexing(cohort, key):
+    volumes, _, stores = cohort
+    for store in stores.values():
+        for name, volume in volumes.items():
+            np.testing.assert_array_equal(store[name][key], volume[key])
+
+
+def test_index_error(cohort):
+    _, _, stores = cohort
+    with pytest.raises(IndexError):
+        stores[1]['a'][11]
@@ -0,0 +1,181 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.uid import generate_uid
+from conftest import write_dicom
+from midastools.pet import corr2suv
+from midastools.pet.corr2suv import (calc_suv_param, read_pet_header, read_dynamic_frames,
+                                     calc_frame_suv_factor, convert_suv_dynamic, convert_suv_nii,
+                                     convert_suv_batch, SuvFactorCache, Pet)
+
+HALF_LIFE = 6586.2
+# frame start (s after series start), duration (s)
+FRAMES = [(0, 60), (60, 120), (180, 300)]
+NUM_SLICES = 3
+SERIES_TIME = 10 * 3600
+
+
+def dicom_time(seconds):
+    return f'{seconds // 3600:02d}{seconds // 60 % 60:02d}{seconds % 60:02d}.00'
+
+
+def write_dynamic_series(dcm_dir, decay_correction='START', weight=80):
+    """Writes a small dynamic pet series (frames x slices), frame f has pixel value f + 1."""
+    series_uid, study_uid = generate_uid(), generate_uid()
+    files = []
+    for idx_frame, (start, duration) in enumerate(FRAMES):
+        for idx_slice in range(NUM_SLICES):
+            rp_info = Dataset()
+            rp_info.RadionuclideTotalDose = 300e6
+            rp_info.RadiopharmaceuticalStartTime = '093000.00'
+            rp_info.RadionuclideHalfLife = HALF_LIFE
+            files.append(write_dicom(dcm_dir.joinpath(f'{idx_frame}_{idx_slice}.dcm'),
+                                     np.full((4, 5), idx_frame + 1),
+                                     '1.2.840.10008.5.1.4.1.1.128',
+                                     Modality='PT',
+                                     PatientID='test',
+                                     StudyInstanceUID=study_uid,
+                                     SeriesInstanceUID=series_uid,
+                                     SeriesTime=dicom_time(SERIES_TIME),
+                                     # slices of a frame are acquired a few seconds apart
+                                     AcquisitionTime=dicom_time(SERIES_TIME + start + idx_slice),
+                                     FrameReferenceTime=1000 * (start + duration / 2),
+                                     ActualFrameDuration=1000 * duration,
+                                     DecayCorrection=decay_correction,
+                                     PatientWeight=weight,
+                                     RadiopharmaceuticalInformationSequence=[rp_info],
+                                     ImageOrientationPatient=[1, 0, 0, 0, 1, 0],
+                                     ImagePositionPatient=[0, 0, 2.0 * idx_slice],
+                                     PixelSpacing=[1.5, 1.5],
+                                     SliceThickness=2.0,
+                                     InstanceNumber=idx_frame * NUM_SLICES + idx_slice + 1,
+                                     RescaleSlope=1,
+                                     RescaleIntercept=0))
+    # file order should not matter
+    return files[::-1]
+
+
+def test_frame_start_times(tmp_path):
+    frames = read_dynamic_frames(write_dynamic_series(tmp_path))
+    assert len(frames) == len(FRAMES)
+    for frame, (start, duration) in zip(frames, FRAMES):
+        # earliest slice of the frame, not the last file read
+        assert frame['start_time'] == pytest.approx(SERIES_TIME + start)
+        assert frame['duration'] == pytest.approx(duration)
+        assert len(frame['files']) == NUM_SLICES
+
+
+@pytest.mark.parametrize('decay_correction', ['START', 'NONE', 'ADMIN'])
+def test_frame_suv_factors(tmp_path, decay_correction):
+    files = write_dynamic_series(tmp_path, decay_correction)
+    param = calc_suv_param(read_pet_header(files[0]))
+    frames = read_dynamic_frames(files)
+    factors = np.array([calc_frame_suv_factor(param, frame) for frame in frames])
+
+    decay_const = np.log(2) / HALF_LIFE
+    # injection 30 min before the series start
+    if decay_correction == 'START':
+        # all frames are decay corrected to the series start
+        expected = np.full(len(FRAMES), 1000 * 80 / 300e6 * np.exp(decay_const * 1800.0))
+    elif decay_correction == 'NONE':
+        time_diff = np.array([1800.0 + start for start, _ in FRAMES])
+        decay_frame = decay_const * np.array([duration for _, duration in FRAMES])
+        expected = 1000 * 80 / 300e6 * np.exp(decay_const * time_diff) * decay_frame / (1 - np.exp(-decay_frame))
+        assert np.all(np.diff(factors) > 0)
+    else:
+        expected = np.full(len(FRAMES), 1000 * 80 / 300e6)
+    np.testing.assert_allclose(factors, expected, rtol=1e-9)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float16])
+def test_convert_suv_dynamic(tmp_path, dtype):
+    dcm_dir = tmp_path.joinpath('dcm')
+    dcm_dir.mkdir()
+    write_dynamic_series(dcm_dir)
+    out_file = tmp_path.joinpath('suv.nii')
+    frames = convert_suv_dynamic(dcm_dir, out_file, dtype=dtype)
+
+    img = nib.load(str(out_file))
+    assert img.shape == (5, 4, NUM_SLICES, len(FRAMES))
+    assert img.get_data_dtype() == np.float32
+    data = np.asarray(img.dataobj)
+    for idx_frame, frame in enumerate(frames):
+        np.testing.assert_allclose(data[..., idx_frame], (idx_frame + 1) * frame['suv_factor'],
+                                   rtol=np.finfo(dtype).eps)
+
+
+def test_pet_header_only(tmp_path):
+    write_dynamic_series(tmp_path)
+    # first frame only: a static series
+    for f in tmp_path.glob('*.dcm'):
+        if not f.name.startswith('0_'):
+            f.unlink()
+    pet = Pet(str(tmp_path))
+    pet_header = Pet(str(tmp_path), header_only=True)
+    assert pet_header.image_pet == []
+    assert pet_header.suv_factor == pytest.approx(pet.suv_factor)
+    assert pet_header.geometry.GetSize() == pet.image_pet.GetSize()
+    np.testing.assert_allclose(pet_header.geometry.GetOrigin(), pet.image_pet.GetOrigin())
+    np.testing.assert_allclose(pet_header.geometry.GetSpacing(), pet.image_pet.GetSpacing())
+
+
+def write_nii(nii_file, data):
+    nib.save(nib.Nifti1Image(np.asarray(data, np.float32), np.diag([2., 2., 3., 1.])), str(nii_file))
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float16])
+def test_convert_suv_nii(tmp_path, dtype):
+    # activity concentrations (Bq/ml) beyond the float16 range
+    data = np.array([1000, 70000, 200000, 5e6], np.float32).reshape(2, 2, 1)
+    write_nii(tmp_path / 'pet.nii.gz', data)
+    convert_suv_nii(tmp_path / 'pet.nii.gz', tmp_path / 'suv.nii.gz', 1e-4, dtype)
+    img = nib.load(str(tmp_path / 'suv.nii.gz'))
+    assert img.get_data_dtype() == np.float32
+    np.testing.assert_allclose(img.get_fdata(), data * 1e-4, rtol=np.finfo(dtype).eps)
+    np.testing.assert_allclose(img.affine, np.diag([2., 2., 3., 1.]))
+
+
+def test_suv_factor_cache(tmp_path, monkeypatch):
+    files = write_dynamic_series(tmp_path)
+    header, cache_file = files[0], tmp_path / 'cache.csv'
+    expected = calc_suv_param(read_pet_header(header))['suv_factor']
+
+    cache = SuvFactorCache(cache_file)
+    assert cache.get_param(header)['suv_factor'] == pytest.approx(expected)
+    cache.save()
+
+    # valid entries of the cache file are used without reading the header
+    def read_header(dcm_file, tags=corr2suv.PET_TAGS):
+        raise AssertionError('header read')
+    with monkeypatch.context() as m:
+        m.setattr(corr2suv, 'read_pet_header', read_header)
+        param = SuvFactorCache(cache_file).get_param(header)
+    assert param['suv_factor'] == pytest.approx(expected)
+    assert param['patient_id'] == 'test'
+
+    # a modified header (mtime, size) is read again
+    for f in files:
+        f.unlink()
+    write_dynamic_series(tmp_path, weight=100)
+    param = SuvFactorCache(cache_file).get_param(header)
+    assert param['weight'] == 100
+    assert param['suv_factor'] == pytest.approx(expected * 100 / 80)
+
+
+def test_convert_suv_batch(tmp_path):
+    dcm_dirs = [tmp_path / 'dcm0', tmp_path / 'dcm1']
+    jobs = []
+    for idx, (dcm_dir, weight) in enumerate(zip(dcm_dirs, [80, 60])):
+        dcm_dir.mkdir()
+        header = write_dynamic_series(dcm_dir, weight=weight)[0]
+        write_nii(tmp_path / f'pet{idx}.nii.gz', np.full((3, 2, 2), 1000.0 * (idx + 1)))
+        jobs.append((tmp_path / f'pet{idx}.nii.gz', header, tmp_path / f'suv{idx}.nii.gz'))
+
+    cache_file = tmp_path / 'cache.csv'
+    factors = convert_suv_batch(jobs, cache_file=cache_file, num_cores=2)
+    assert cache_file.exists()
+    for idx, (nii_file, header, out_file) in enumerate(jobs):
+        assert factors[idx] == pytest.approx(calc_suv_param(read_pet_header(header))['suv_factor'])
+        np.testing.assert_allclose(nib.load(str(out_file)).get_fdata(), 1000.0 * (idx + 1) * factors[idx], rtol=1e-6)
+    assert factors[1] == pytest.approx(factors[0] * 60 / 80)
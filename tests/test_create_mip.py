@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from midastools.misc import create_mip
+from midastools.misc.create_mip import MipProjector, get_projector, axis_mips, create_mip_nii
+
+# in-plane 13 x 13 (unit spacing): the rotated grid (width 19) samples the voxel centers at 0 and 90 degree
+SHAPE = (7, 13, 13)
+
+
+def random_volume(seed=0):
+    return np.random.default_rng(seed).integers(0, 1000, SHAPE).astype(np.int16)
+
+
+@pytest.mark.parametrize('order', [0, 1])
+def test_axis_angles(order):
+    volume = random_volume()
+    projector = MipProjector(SHAPE[1:], (1.0, 1.0), [0, 90, 180], order)
+    assert projector.width == 19
+    mips = projector.project(volume)
+    assert mips.shape == (3, SHAPE[0], projector.width)
+    # field of view in the center columns, outside: volume minimum
+    fov = slice(3, 16)
+    mips_axis = axis_mips(volume)
+    np.testing.assert_array_equal(mips[0][:, fov], mips_axis['coronal'])
+    np.testing.assert_array_equal(mips[1][:, fov], mips_axis['sagittal'][:, ::-1])
+    np.testing.assert_array_equal(mips[2][:, fov], mips_axis['coronal'][:, ::-1])
+    np.testing.assert_array_equal(mips[:, :, :3], volume.min())
+    np.testing.assert_array_equal(mips[:, :, 16:], volume.min())
+
+
+def test_chunks():
+    volume = random_volume()
+    projector = MipProjector(SHAPE[1:], (1.0, 0.8), np.arange(8) * 45.0, order=1)
+    # chunks of single slices
+    np.testing.assert_array_equal(projector.project(volume, max_elements=1), projector.project(volume))
+
+
+def test_projector_cache(monkeypatch):
+    monkeypatch.setattr(create_mip, '_projectors', {})
+    angles = (0.0, 90.0)
+    projector = get_projector(SHAPE[1:], (1.0, 1.0), angles)
+    # same in-plane geometry -> shared projector
+    assert get_projector(list(SHAPE[1:]), [1.0, 1.0], list(angles)) is projector
+    assert get_projector(SHAPE[1:], (1.0, 1.0), angles, order=1) is not projector
+    assert get_projector(SHAPE[1:], (1.0, 2.0), angles, max_cached=2) is not projector
+    # oldest projector is evicted
+    assert len(create_mip._projectors) == 2
+    assert get_projector(SHAPE[1:], (1.0, 1.0), angles, max_cached=2) is not projector
+
+
+def test_create_mip_nii(tmp_path):
+    img = sitk.GetImageFromArray(random_volume())
+    img.SetSpacing((1.0, 1.0, 3.0))
+    sitk.WriteImage(img, str(tmp_path / 'img.nii.gz'))
+    create_mip_nii(tmp_path / 'img.nii.gz', tmp_path / 'mip', num_angles=4, axes=True, out_format='both')
+    names = sorted(f.name for f in (tmp_path / 'mip').iterdir())
+    assert names == ['img_mip.gif', 'img_mip_000.0.png', 'img_mip_090.0.png', 'img_mip_180.0.png',
+                     'img_mip_270.0.png', 'img_mip_axial.png', 'img_mip_coronal.png', 'img_mip_sagittal.png']
@@ -0,0 +1,66 @@
+import numpy as np
+import nibabel as nib
+import pydicom
+import pytest
+import SimpleITK as sitk
+import dicom2nifti
+from zipfile import ZipFile
+from pydicom.uid import generate_uid
+from conftest import write_dicom
+from midastools.misc.nako.dcm2nii import dcm_station_to_sitk
+from midastools.misc.nifti import make_affine
+
+ROWS, COLUMNS, NUM_SLICES = 6, 7, 5
+
+
+def write_station(dcm_dir, orientation, seed=0):
+    """Writes a small MR station (slice k has random uint16 pixels)."""
+    rng = np.random.RandomState(seed)
+    series_uid, study_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    row_dir, col_dir = np.array(orientation[:3]), np.array(orientation[3:])
+    normal = np.cross(row_dir, col_dir)
+    files = []
+    for idx_slice in range(NUM_SLICES):
+        files.append(write_dicom(dcm_dir.joinpath(f'{idx_slice}.dcm'),
+                                 rng.randint(0, 1000, (ROWS, COLUMNS)),
+                                 '1.2.840.10008.5.1.4.1.1.4',
+                                 Modality='MR',
+                                 PatientID='test',
+                                 StudyInstanceUID=study_uid,
+                                 SeriesInstanceUID=series_uid,
+                                 FrameOfReferenceUID=frame_uid,
+                                 SeriesNumber=1,
+                                 AcquisitionNumber=1,
+                                 InstanceNumber=idx_slice + 1,
+                                 ImageType=['ORIGINAL', 'PRIMARY', 'M'],
+                                 EchoTime=2.0,
+                                 ImageOrientationPatient=list(orientation),
+                                 ImagePositionPatient=(np.array([-10.0, -20.0, 30.0]) + 3.0 * idx_slice * normal).tolist(),
+                                 PixelSpacing=[1.5, 2.0],
+                                 SliceThickness=3.0))
+    return files
+
+
+@pytest.mark.parametrize('orientation', [(1, 0, 0, 0, 1, 0),     # axial
+                                         (1, 0, 0, 0, 0, -1),    # coronal
+                                         (0, 1, 0, 0, 0, -1)])   # sagittal
+def test_station_matches_dicom2nifti(tmp_path, orientation):
+    dcm_dir = tmp_path.joinpath('dcm')
+    dcm_dir.mkdir()
+    files = write_station(dcm_dir, orientation)
+    zip_file = tmp_path.joinpath('station.zip')
+    with ZipFile(str(zip_file), 'w') as zip_obj:
+        for f in files[::-1]:
+            zip_obj.write(str(f), f.name)
+    dicom2nifti.settings.disable_validate_slice_increment()
+    dicom2nifti.convert_directory(str(dcm_dir), str(tmp_path))
+    expected = nib.load(str(next(tmp_path.glob('*.nii.gz'))))
+
+    with ZipFile(str(zip_file)) as zip_obj:
+        station = [(name, pydicom.dcmread(zip_obj.open(name), stop_before_pixels=True))
+                   for name in zip_obj.namelist()]
+        img = dcm_station_to_sitk(zip_obj, station)
+
+    assert nib.aff2axcodes(make_affine(img)) == ('L', 'A', 'S')
+    np.testing.assert_allclose(make_affine(img), expected.affine, atol=1e-4)
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(img).T, np.asanyarray(expected.dataobj))
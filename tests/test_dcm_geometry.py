@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+import tifffile
+from pydicom.uid import generate_uid
+from conftest import write_dicom
+from midastools.misc.dcm_geometry import DicomSeriesGeometry
+from midastools.misc import tif_to_nii
+
+ROWS, COLUMNS, NUM_SLICES = 6, 7, 5
+
+
+def write_series(dcm_dir, orientation=(1, 0, 0, 0, 1, 0), slice_step=(0, 0, 3.0)):
+    """Writes a small CT series, the slice positions advance by slice_step."""
+    series_uid, study_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    for idx_slice in range(NUM_SLICES):
+        write_dicom(dcm_dir.joinpath(f'{idx_slice}.dcm'),
+                    np.full((ROWS, COLUMNS), idx_slice),
+                    '1.2.840.10008.5.1.4.1.1.2',
+                    Modality='CT',
+                    PatientID='test',
+                    StudyInstanceUID=study_uid,
+                    SeriesInstanceUID=series_uid,
+                    FrameOfReferenceUID=frame_uid,
+                    InstanceNumber=idx_slice + 1,
+                    ImageOrientationPatient=list(orientation),
+                    ImagePositionPatient=(np.array([-10.0, -20.0, 30.0]) + idx_slice * np.array(slice_step)).tolist(),
+                    PixelSpacing=[1.5, 2.0],
+                    SliceThickness=3.0)
+
+
+def assert_same_geometry(img, ref):
+    assert tuple(img.GetSize()) == tuple(ref.GetSize())
+    np.testing.assert_allclose(img.GetOrigin(), ref.GetOrigin(), atol=1e-6)
+    np.testing.assert_allclose(img.GetSpacing(), ref.GetSpacing(), atol=1e-6)
+    np.testing.assert_allclose(img.GetDirection(), ref.GetDirection(), atol=1e-6)
+
+
+def test_tif_to_nii(tmp_path):
+    write_series(tmp_path)
+    labelmask = np.random.RandomState(0).randint(0, 3, (NUM_SLICES, ROWS, COLUMNS)).astype(np.uint8)
+    tif_file = str(tmp_path.joinpath('labelmask.tif'))
+    tifffile.imwrite(tif_file, labelmask)
+    ref = tif_to_nii.load_dcm_data(str(tmp_path))
+    assert isinstance(ref, sitk.Image)
+
+    for out_file, func in [('convert.nii.gz', tif_to_nii.convert), ('main.nii.gz', tif_to_nii.main)]:
+        func(tif_file, str(tmp_path), str(tmp_path.joinpath(out_file)))
+        img = sitk.ReadImage(str(tmp_path.joinpath(out_file)))
+        assert_same_geometry(img, ref)
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(img), labelmask)
+
+
+@pytest.mark.parametrize('orientation, slice_step', [
+    ((1, 0, 0, 0, 1, 0), (0, 0, 3.0)),
+    ((1, 0, 0, 0, 0, -1), (0, 2.5, 0)),
+    ((1, 0, 0, 0, 0.8, -0.6), (0, 1.8, 2.4)),
+    # gantry tilt / shear: slice positions not along the orientation normal
+    ((1, 0, 0, 0, 1, 0), (0, 1.0, 3.0)),
+    ((1, 0, 0, 0, 1, 0), (0.5, -0.5, 2.0)),
+])
+def test_geometry_matches_series_reader(tmp_path, orientation, slice_step):
+    write_series(tmp_path, orientation, slice_step)
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(reader.GetGDCMSeriesFileNames(str(tmp_path)))
+    ref = reader.Execute()
+    geometry = DicomSeriesGeometry(tmp_path)
+    assert_same_geometry(geometry, ref)
+    for index in [(0, 0, 0), (3, 2, NUM_SLICES - 1)]:
+        np.testing.assert_allclose(geometry.TransformIndexToPhysicalPoint(index),
+                                   ref.TransformIndexToPhysicalPoint(index), atol=1e-6)
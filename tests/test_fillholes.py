@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import scipy.ndimage
+from midastools.misc.fillholes import fillholes
+
+
+def random_mask(seed, shape=(30, 40, 50)):
+    rng = np.random.RandomState(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[4:26, 6:34, 8:42] = scipy.ndimage.gaussian_filter(rng.rand(22, 28, 34), 1.0) > 0.48
+    return mask
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fillholes_matches_full_volume(seed):
+    mask = random_mask(seed)
+    expected = scipy.ndimage.binary_fill_holes(mask).astype(np.uint8)
+    assert expected.sum() > mask.sum()
+    np.testing.assert_array_equal(fillholes(mask), expected)
+
+
+def test_fillholes_touching_border():
+    mask = np.ones((10, 10, 10), dtype=np.uint8)
+    mask[0, 4:6, 4:6] = 0
+    mask[4:6, 4:6, 4:6] = 0
+    np.testing.assert_array_equal(fillholes(mask), scipy.ndimage.binary_fill_holes(mask))
+
+
+@pytest.mark.parametrize('axis', [0, 1, 2])
+def test_fillholes_slice_wise(axis):
+    mask = random_mask(1)
+    expected = np.stack([scipy.ndimage.binary_fill_holes(s) for s in np.moveaxis(mask, axis, 0)], axis)
+    np.testing.assert_array_equal(fillholes(mask, axis=axis), expected)
+
+
+def test_fillholes_multi_label():
+    mask = np.zeros((20, 20, 20), dtype=np.uint16)
+    mask[2:9, 2:9, 2:9] = 2
+    mask[4:7, 4:7, 4:7] = 0
+    mask[10:18, 10:18, 10:18] = 400
+    mask[13:15, 13:15, 13:15] = 0
+    result = fillholes(mask, multi_label=True)
+    assert result.dtype == mask.dtype
+    expected = mask.copy()
+    expected[4:7, 4:7, 4:7] = 2
+    expected[13:15, 13:15, 13:15] = 400
+    np.testing.assert_array_equal(result, expected)
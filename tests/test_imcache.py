@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+from midastools.misc.imcache import ImageCache, get_cache
+from midastools.misc.orientation import reorient_nii_file
+from midastools.misc.lcomp import lcomp_nii
+from midastools.misc.fillholes import fillholes_nii
+
+
+def write_image(nii_file, array, spacing=(1., 2., 3.)):
+    img = sitk.GetImageFromArray(array)
+    img.SetSpacing(spacing)
+    img.SetDirection((-1., 0., 0., 0., 0., 1., 0., 1., 0.))
+    sitk.WriteImage(img, str(nii_file))
+    return img
+
+
+def test_image_cache(tmp_path):
+    nii_file = tmp_path / 'img.nii.gz'
+    array = np.arange(4*5*6, dtype=np.int16).reshape(4, 5, 6)
+    write_image(nii_file, array)
+
+    cache = ImageCache(max_bytes=array.nbytes*2)
+    img = cache.load_image(nii_file)
+    np.testing.assert_array_equal(cache.load_array(nii_file), array)
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    # copy-on-write: modifications do not affect the cache
+    img[0, 0, 0] = 100
+    assert cache.load_array(nii_file)[0, 0, 0] == 0
+    assert not cache.load_array(nii_file).flags.writeable
+
+    # modified file is read again
+    write_image(nii_file, array + 1)
+    os.utime(nii_file, ns=(0, 10**9))
+    np.testing.assert_array_equal(cache.load_array(nii_file), array + 1)
+    assert cache.stats()['images'] == 1
+
+    # eviction within the byte budget, larger images are not cached
+    write_image(tmp_path / 'b.nii.gz', array)
+    write_image(tmp_path / 'c.nii.gz', array)
+    cache.load_image(tmp_path / 'b.nii.gz')
+    cache.load_image(tmp_path / 'c.nii.gz')
+    assert cache.stats()['evictions'] == 1 and cache.stats()['bytes'] <= cache.max_bytes
+    write_image(tmp_path / 'big.nii.gz', np.zeros((10, 10, 10), np.int16))
+    cache.load_image(tmp_path / 'big.nii.gz')
+    assert cache.stats()['images'] == 2
+
+
+def test_reorient_nii_file_cache(tmp_path):
+    nii_file = tmp_path / 'img.nii.gz'
+    array = np.arange(4*5*6, dtype=np.float32).reshape(4, 5, 6)
+    write_image(nii_file, array)
+
+    reorient_nii_file(nii_file, tmp_path / 'out.nii.gz', verbose=False)
+    reorient_nii_file(nii_file, tmp_path / 'out_cache.nii.gz', verbose=False, cache=True)
+    expected, result = nib.load(str(tmp_path / 'out.nii.gz')), nib.load(str(tmp_path / 'out_cache.nii.gz'))
+    assert nib.aff2axcodes(result.affine) == ('L', 'A', 'S')
+    np.testing.assert_allclose(result.affine, expected.affine, atol=1e-6)
+    np.testing.assert_array_equal(result.get_fdata(), expected.get_fdata())
+
+
+def test_mask_tools_cache(tmp_path):
+    mask = np.zeros((8, 8, 8), np.uint8)
+    mask[1:6, 1:6, 1:6] = 1
+    mask[3, 3, 3] = 0
+    mask[7, 7, 7] = 1
+    nii_file = tmp_path / 'mask.nii.gz'
+    write_image(nii_file, mask)
+
+    get_cache().clear()
+    for func in (lcomp_nii, fillholes_nii):
+        func(nii_file, tmp_path / 'out.nii.gz')
+        func(nii_file, tmp_path / 'out_cache.nii.gz', cache=True)
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / 'out_cache.nii.gz'))),
+                                      sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / 'out.nii.gz'))))
+    assert get_cache().stats()['hits'] == 1
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import skimage.measure
+from scipy import ndimage
+from midastools.pet.isocont import isocont, isocont_sweep, sweep_mask, lesion_stats, suv_peak_kernel, write_table
+
+
+def isocont_reference(animg, amask, b_class_components, b_use_percentile_threshold,
+                      percentile_threshold, maximum_threshold):
+    """Full-volume implementation (one pass over the whole image per component)."""
+    if b_class_components:
+        amask_comp, num_comp = skimage.measure.label(amask, background=None, return_num=True)
+    else:
+        amask_comp, num_comp = amask, 1
+    amask_th = np.zeros_like(amask)
+    for comp in range(num_comp):
+        sel_comp = (amask_comp == (comp + 1))
+        suv_values = animg[sel_comp]
+        if b_use_percentile_threshold:
+            th = np.percentile(suv_values, percentile_threshold)
+        else:
+            th = np.max(suv_values) * maximum_threshold / 100.0
+        amask_th = amask_th + np.logical_and(np.greater_equal(animg, th), sel_comp)
+    return amask_th
+
+
+@pytest.fixture
+def pet_and_mask():
+    rng = np.random.RandomState(0)
+    animg = ndimage.gaussian_filter(rng.rand(40, 48, 56), 2).astype(np.float32) * 10
+    amask = (ndimage.gaussian_filter(rng.rand(40, 48, 56), 3) > 0.52).astype(np.uint8)
+    return animg, amask
+
+
+@pytest.mark.parametrize('b_class_components', [True, False])
+@pytest.mark.parametrize('b_use_percentile_threshold', [True, False])
+def test_isocont_matches_full_volume(pet_and_mask, b_class_components, b_use_percentile_threshold):
+    animg, amask = pet_and_mask
+    assert skimage.measure.label(amask).max() > 3
+    expected = isocont_reference(animg, amask, b_class_components, b_use_percentile_threshold, 25, 40)
+    result = isocont(animg, amask,
+                     b_class_components=b_class_components,
+                     b_use_percentile_threshold=b_use_percentile_threshold,
+                     percentile_threshold=25,
+                     maximum_threshold=40,
+                     verbose=False)
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_isocont_stats(pet_and_mask):
+    animg, amask = pet_and_mask
+    amask_th, stats = isocont(animg, amask, b_out_stats=True, spacing=(2.0, 1.0, 1.5), verbose=False)
+    labels = skimage.measure.label(amask) * (amask_th > 0)
+    for _, row in stats.iterrows():
+        values = animg[labels == row['label']]
+        assert row['voxels'] == values.size
+        assert row['mtv_ml'] == pytest.approx(values.size * 3.0 / 1000.0)
+        assert row['suv_max'] == pytest.approx(values.max())
+        assert row['suv_mean'] == pytest.approx(values.mean(), rel=1e-6)
+    assert stats['voxels'].sum() == np.count_nonzero(amask_th)
+
+
+@pytest.mark.parametrize('b_use_percentile_threshold', [True, False])
+def test_sweep_matches_isocont(pet_and_mask, b_use_percentile_threshold):
+    animg, amask = pet_and_mask
+    thresholds = [10, 25, 50, 75]
+    curves, amask_stacked = isocont_sweep(animg, amask, thresholds,
+                                          b_use_percentile_threshold=b_use_percentile_threshold,
+                                          b_out_stacked_mask=True)
+    for th in thresholds:
+        expected = isocont(animg, amask,
+                           b_use_percentile_threshold=b_use_percentile_threshold,
+                           percentile_threshold=th,
+                           maximum_threshold=th,
+                           verbose=False)
+        np.testing.assert_array_equal(sweep_mask(amask_stacked, thresholds, th), expected > 0)
+        assert curves[curves['threshold'] == th]['voxels'].sum() == np.count_nonzero(expected)
+
+
+def test_suv_peak_matches_full_volume(pet_and_mask):
+    animg, amask = pet_and_mask
+    spacing = (2.0, 1.0, 1.5)
+    labels, num_comp = skimage.measure.label(amask, return_num=True)
+    stats = lesion_stats(animg, labels, num_comp, spacing)
+    img_mean = ndimage.correlate(animg, suv_peak_kernel(spacing).astype(np.float32), mode='nearest')
+    assert len(stats) == num_comp
+    for _, row in stats.iterrows():
+        assert row['suv_peak'] == pytest.approx(img_mean[labels == row['label']].max(), rel=1e-5)
+
+
+def test_write_table_csv_only(tmp_path, pet_and_mask):
+    animg, amask = pet_and_mask
+    _, stats = isocont(animg, amask, b_out_stats=True, verbose=False)
+    write_table(stats, tmp_path / 'stats.csv')
+    with pytest.raises(ValueError):
+        write_table(stats, tmp_path / 'stats.parquet')
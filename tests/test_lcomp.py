@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from skimage.measure import label
+from midastools.misc.lcomp import lcomp
+
+
+def lcomp_reference(mask):
+    """Full-volume skimage implementation (largest component, first label on ties)."""
+    labels = label(mask)
+    unique, counts = np.unique(labels, return_counts=True)
+    list_seg = list(zip(unique, counts))[1:]
+    largest = max(list_seg, key=lambda x: x[1])[0]
+    return (labels == largest).astype(np.uint8)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_lcomp_matches_full_volume(seed):
+    rng = np.random.RandomState(seed)
+    mask = np.zeros((40, 50, 60), dtype=np.uint8)
+    mask[5:35, 5:45, 10:50] = ndimage.gaussian_filter(rng.rand(30, 40, 40), 1.5) > 0.52
+    result = lcomp(mask)
+    assert result.dtype == np.uint8
+    np.testing.assert_array_equal(result, lcomp_reference(mask))
+
+
+def test_lcomp_ties():
+    mask = np.zeros((10, 10, 10), dtype=np.uint8)
+    mask[6:8, 1:3, 1:3] = 1
+    mask[1:3, 6:8, 6:8] = 1
+    np.testing.assert_array_equal(lcomp(mask), lcomp_reference(mask))
+
+
+def test_lcomp_top_k_multi_label():
+    mask = np.zeros((20, 20, 20), dtype=np.uint16)
+    mask[1:4, 1:4, 1:4] = 300
+    mask[10:15, 10:15, 10:15] = 300
+    mask[16:18, 1:3, 1:3] = 2
+    mask[1:6, 12:18, 1:6] = 2
+    result = lcomp(mask, multi_label=True)
+    assert result.dtype == mask.dtype
+    expected = np.zeros_like(mask)
+    expected[10:15, 10:15, 10:15] = 300
+    expected[1:6, 12:18, 1:6] = 2
+    np.testing.assert_array_equal(result, expected)
+    # component sizes: 27, 125 (label 300), 8, 150 (label 2)
+    without_small = mask.copy()
+    without_small[16:18, 1:3, 1:3] = 0
+    np.testing.assert_array_equal(lcomp(mask, top_k=None, min_size=9, multi_label=True), without_small)
+    np.testing.assert_array_equal(lcomp(mask, top_k=None, min_size=28, multi_label=True), expected)
@@ -0,0 +1,65 @@
+import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+from midastools.misc.nifti import SimpleITKAsNibabel, make_affine, nibabel_to_sitk
+
+
+def oblique_image(dtype=np.int16):
+    rng = np.random.default_rng(0)
+    img = sitk.GetImageFromArray(rng.integers(0, 100, (5, 6, 7)).astype(dtype))
+    img.SetOrigin((10., -20., 30.))
+    img.SetSpacing((0.5, 1.5, 3.))
+    rotation = sitk.VersorTransform((1., 2., 3.), 0.4).GetMatrix()
+    img.SetDirection(rotation)
+    return img
+
+
+def affine_reference(img):
+    """RAS affine from the index -> physical point transform."""
+    origin = np.array(img.TransformContinuousIndexToPhysicalPoint((0., 0., 0.)))
+    affine = np.eye(4)
+    for axis in range(3):
+        index = [0., 0., 0.]
+        index[axis] = 1.
+        affine[:3, axis] = np.array(img.TransformContinuousIndexToPhysicalPoint(index)) - origin
+    affine[:3, 3] = origin
+    return np.diag([-1., -1., 1., 1.]) @ affine
+
+
+def test_make_affine():
+    img = oblique_image()
+    np.testing.assert_allclose(make_affine(img), affine_reference(img), atol=1e-12)
+
+
+def test_simpleitk_as_nibabel(tmp_path):
+    img = oblique_image()
+    nii_file = tmp_path / 'img.nii.gz'
+    sitk.WriteImage(img, str(nii_file))
+
+    nii = SimpleITKAsNibabel(nii_file)
+    assert nii.dataobj.is_proxy
+    assert nii.shape == (7, 6, 5)
+    data = np.asanyarray(nii.dataobj)
+    assert data.dtype == np.int16 and not data.flags.writeable
+    np.testing.assert_array_equal(data, sitk.GetArrayFromImage(img).T)
+    np.testing.assert_array_equal(nii.dataobj[2:4, :, 1], sitk.GetArrayFromImage(img).T[2:4, :, 1])
+    # views stay valid after the wrapper is gone
+    del nii
+    np.testing.assert_array_equal(data, sitk.GetArrayFromImage(img).T)
+
+    # same geometry as nibabel reads it
+    np.testing.assert_allclose(SimpleITKAsNibabel(nii_file).affine, nib.load(str(nii_file)).affine, atol=1e-5)
+
+
+def test_nibabel_to_sitk(tmp_path):
+    img = oblique_image(np.float32)
+    nii = SimpleITKAsNibabel(img)
+    assert nibabel_to_sitk(nii) is img
+
+    nii_file = tmp_path / 'img.nii.gz'
+    sitk.WriteImage(img, str(nii_file))
+    round_trip = nibabel_to_sitk(nib.load(str(nii_file)))
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(round_trip), sitk.GetArrayFromImage(img))
+    np.testing.assert_allclose(round_trip.GetOrigin(), img.GetOrigin(), atol=1e-4)
+    np.testing.assert_allclose(round_trip.GetSpacing(), img.GetSpacing(), atol=1e-5)
+    np.testing.assert_allclose(round_trip.GetDirection(), img.GetDirection(), atol=1e-5)
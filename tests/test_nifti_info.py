@@ -0,0 +1,65 @@
+import gzip
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from midastools.misc.nifti_info import read_nii_header, header_info, check_consistency, scan_nii, GEOMETRY_FIELDS
+
+
+def write_image(nii_file, size=(6, 5, 4), spacing=(0.5, 1.5, 3.0), origin=(10.0, -20.0, 30.0),
+                direction=(0., 0., 1., 1., 0., 0., 0., 1., 0.)):
+    nii_file.parent.mkdir(parents=True, exist_ok=True)
+    img = sitk.Image(list(size), sitk.sitkInt16)
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    img.SetDirection(direction)
+    sitk.WriteImage(img, str(nii_file))
+    return img
+
+
+def test_header_info(tmp_path):
+    for name in ('img.nii', 'img.nii.gz'):
+        img = write_image(tmp_path / name)
+        info = header_info(read_nii_header(tmp_path / name))
+        assert info['dtype'] == 'int16'
+        assert info['shape'] == img.GetSize()
+        np.testing.assert_allclose(info['spacing'], img.GetSpacing())
+        np.testing.assert_allclose(info['origin'], img.GetOrigin(), atol=1e-4)
+        np.testing.assert_allclose(info['direction'], img.GetDirection(), atol=1e-6)
+        assert info['orientation'] == 'PSL'
+
+
+def test_check_consistency():
+    ref = {'error': '', 'shape': (6, 5, 4), 'spacing': (1.0, 1.0, 3.0), 'origin': (0.0, 0.0, 0.0),
+           'direction': (1., 0., 0., 0., 1., 0., 0., 0., 1.), 'orientation': 'LPS'}
+    rows = [dict(ref, subject='a'),
+            dict(ref, subject='a', spacing=(1.0, 1.0, 3.0005)),
+            dict(ref, subject='a', origin=(0.0, 5.0, 0.0), shape=(6, 5, 5)),
+            dict(ref, subject='b', shape=(6, 5, 5)),
+            dict(ref, subject='b', error='broken', shape=()),
+            dict(ref, subject='', shape=(1, 1, 1)),
+            dict(ref, subject='', shape=(2, 2, 2))]
+    table = check_consistency(pd.DataFrame(rows, columns=['subject', 'error'] + GEOMETRY_FIELDS))
+    assert table['inconsistent'].tolist() == ['', '', 'shape,origin', '', '', '', '']
+
+
+def test_scan_nii(tmp_path):
+    write_image(tmp_path / 'root_a.nii.gz')
+    write_image(tmp_path / 'root_b.nii.gz', size=(3, 3, 3))
+    write_image(tmp_path / 's1' / 'img.nii.gz')
+    write_image(tmp_path / 's1' / 'seg' / 'mask.nii.gz')
+    write_image(tmp_path / 's2' / 'img.nii.gz')
+    write_image(tmp_path / 's2' / 'mask.nii.gz', spacing=(0.5, 1.5, 2.0))
+    with gzip.open(str(tmp_path / 's2' / 'broken.nii.gz'), 'wb') as f:
+        f.write(b'no nifti')
+
+    table = scan_nii(tmp_path, num_cores=1).set_index('path')
+    row = {name: table.loc[str(tmp_path / name)] for name in
+           ['root_a.nii.gz', 'root_b.nii.gz', 's1/img.nii.gz', 's1/seg/mask.nii.gz',
+            's2/img.nii.gz', 's2/mask.nii.gz', 's2/broken.nii.gz']}
+    assert len(table) == 7
+    # root level files have no subject and are not compared
+    assert row['root_a.nii.gz']['subject'] == '' and row['root_b.nii.gz']['inconsistent'] == ''
+    assert row['s1/seg/mask.nii.gz']['subject'] == 's1'
+    assert row['s1/seg/mask.nii.gz']['inconsistent'] == ''
+    assert row['s2/mask.nii.gz']['inconsistent'] == 'spacing'
+    assert row['s2/broken.nii.gz']['error'] != '' and row['s2/broken.nii.gz']['inconsistent'] == ''
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from midastools.misc.nako.nyul import standardize, image_landmarks, fit_standard_scale
+
+
+def standardize_reference(volume, landmarks, standard_scale):
+    """Piecewise-linear mapping in float64 (with extrapolation)."""
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    standard_scale = np.asarray(standard_scale, dtype=np.float64)
+    slopes = np.diff(standard_scale)/np.maximum(np.diff(landmarks), 1e-12)
+    segment = np.clip(np.searchsorted(landmarks, volume, side='right') - 1, 0, len(slopes) - 1)
+    return (volume - landmarks[segment])*slopes[segment] + standard_scale[segment]
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32, np.float64])
+@pytest.mark.parametrize('order', ['C', 'F'])
+def test_standardize(dtype, order):
+    rng = np.random.default_rng(0)
+    volume = np.array(rng.normal(500, 200, (17, 19, 23)), dtype=dtype, order=order)
+    mask = np.zeros(volume.shape, np.uint8)
+    mask[3:-3, 3:-3, 3:-3] = 1
+    landmarks = image_landmarks(volume, mask)
+    standard_scale = fit_standard_scale([landmarks, landmarks*1.2 + 10])
+
+    expected = standardize_reference(volume, landmarks, standard_scale)
+    out = standardize(volume, landmarks, standard_scale, block_size=1000)
+    assert out.dtype == np.float32 and out.shape == volume.shape
+    # extrapolated values outside of the first and last landmark
+    assert out.min() < standard_scale[0] and out.max() > standard_scale[-1]
+    np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-3)
+    # non-contiguous input
+    np.testing.assert_allclose(standardize(volume[::2, 1:, ::-1], landmarks, standard_scale, block_size=1000),
+                               expected[::2, 1:, ::-1], rtol=1e-5, atol=1e-3)
+
+
+def test_standardize_degenerate_landmarks():
+    volume = np.arange(10, dtype=np.float32)
+    out = standardize(volume, [2, 2, 7], [1, 50, 100])
+    np.testing.assert_allclose(out, standardize_reference(volume, [2, 2, 7], [1, 50, 100]), rtol=1e-6)
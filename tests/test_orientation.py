@@ -0,0 +1,48 @@
+import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+from nibabel.orientations import ornt_transform, axcodes2ornt, io_orientation, apply_orientation, inv_ornt_aff
+from midastools.misc.orientation import reorient_nii, reorient_raw, reorient_sitk, write_raw_nii
+from midastools.misc.nifti import make_affine
+
+
+def scaled_nii(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.integers(-1000, 1000, (6, 7, 8), dtype=np.int16)
+    affine = np.array([[-2., 0, 0, 10], [0, 0, 3, -5], [0, -1.5, 0, 7], [0, 0, 0, 1]])
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_slope_inter(0.5, -3)
+    nii_file = tmp_path / 'img.nii.gz'
+    nib.save(img, str(nii_file))
+    return nib.load(str(nii_file))
+
+
+def test_reorient_nii_scaled(tmp_path):
+    img = scaled_nii(tmp_path)
+    ornt_trans = ornt_transform(io_orientation(img.affine), axcodes2ornt(('L', 'A', 'S')))
+    expected = apply_orientation(img.get_fdata(), ornt_trans)
+    expected_affine = img.affine @ inv_ornt_aff(ornt_trans, img.shape)
+
+    new_img = reorient_nii(img)
+    assert nib.aff2axcodes(new_img.affine) == ('L', 'A', 'S')
+    np.testing.assert_allclose(new_img.affine, expected_affine)
+    # the unscaled data stays int16, scaling only on access
+    assert new_img.dataobj.get_unscaled().dtype == np.int16
+    assert np.asarray(new_img.dataobj, dtype=np.float32).dtype == np.float32
+    np.testing.assert_array_equal(new_img.get_fdata(), expected)
+    np.testing.assert_array_equal(new_img.dataobj[1:3, :, 2], expected[1:3, :, 2])
+
+    # exact (unscaled) write
+    write_raw_nii(*reorient_raw(img), tmp_path / 'out.nii.gz')
+    out_img = nib.load(str(tmp_path / 'out.nii.gz'))
+    np.testing.assert_array_equal(out_img.get_fdata(), expected)
+    np.testing.assert_allclose(out_img.affine, expected_affine)
+
+
+def test_reorient_sitk_matches_nii(tmp_path):
+    img = scaled_nii(tmp_path)
+    sitk_img = sitk.ReadImage(str(tmp_path / 'img.nii.gz'), sitk.sitkFloat64)
+    new_sitk = reorient_sitk(sitk_img)
+    new_img = reorient_nii(img)
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(new_sitk).T, new_img.get_fdata())
+    np.testing.assert_allclose(make_affine(new_sitk), new_img.affine, atol=1e-6)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from midastools.misc import fillholes, lcomp
+from midastools.misc.postprocess import parse_operation, postprocess, postprocess_nii, postprocess_batch, batch_files
+
+
+def test_parse_operation():
+    assert parse_operation('lcomp') == ('lcomp', {})
+    assert parse_operation('lcomp:top_k=2, min_size=10,multi_label=True') == \
+        ('lcomp', {'top_k': 2, 'min_size': 10, 'multi_label': True})
+    assert parse_operation('smooth:smooth_filter=sinc,relaxation=0.5') == \
+        ('smooth', {'smooth_filter': 'sinc', 'relaxation': 0.5})
+    assert parse_operation('fillholes:axis=None') == ('fillholes', {'axis': None})
+    with pytest.raises(ValueError):
+        parse_operation('dilate:radius=2')
+
+
+def make_mask():
+    mask = np.zeros((12, 14, 16), np.uint8)
+    mask[2:8, 2:9, 2:10] = 1
+    mask[4, 4:6, 4:6] = 0          # hole
+    mask[10:12, 12:14, 13:16] = 1  # small component
+    return mask
+
+
+def test_postprocess_chain():
+    mask = make_mask()
+    operations = [parse_operation('fillholes'), parse_operation('lcomp:top_k=1')]
+    expected = lcomp.lcomp(fillholes.fillholes(mask), top_k=1)
+    result = postprocess(mask, operations)
+    np.testing.assert_array_equal(result, expected)
+    assert result[4, 4, 4] == 1 and result[11, 13, 14] == 0
+    # the order of the chain matters: the hole is not filled after lcomp
+    np.testing.assert_array_equal(postprocess(mask, operations[::-1]), fillholes.fillholes(lcomp.lcomp(mask)))
+
+
+def write_mask(nii_file, mask):
+    nii_file.parent.mkdir(parents=True, exist_ok=True)
+    img = sitk.GetImageFromArray(mask)
+    img.SetSpacing((0.5, 1.0, 2.0))
+    img.SetOrigin((1.0, 2.0, 3.0))
+    sitk.WriteImage(img, str(nii_file))
+    return img
+
+
+def test_postprocess_nii(tmp_path):
+    img = write_mask(tmp_path / 'mask.nii.gz', make_mask())
+    postprocess_nii(tmp_path / 'mask.nii.gz', tmp_path / 'out.nii.gz', [('fillholes', {}), ('lcomp', {})])
+    out = sitk.ReadImage(str(tmp_path / 'out.nii.gz'))
+    assert out.GetSpacing() == img.GetSpacing() and out.GetOrigin() == img.GetOrigin()
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(out), lcomp.lcomp(fillholes.fillholes(make_mask())))
+
+
+def test_postprocess_batch(tmp_path):
+    for subject in ('s1', 's2'):
+        write_mask(tmp_path / 'data' / subject / 'mask.nii.gz', make_mask())
+    pattern = str(tmp_path / 'data' / '*' / 'mask.nii.gz')
+
+    nii_files, out_files = batch_files(pattern)
+    assert out_files == [f.parent / 'pp_mask.nii.gz' for f in nii_files]
+    nii_files, out_files = batch_files(pattern, tmp_path / 'out')
+    assert out_files == [tmp_path / 'out' / s / 'mask.nii.gz' for s in ('s1', 's2')]
+    assert batch_files(pattern, tmp_path / 'out', 'lc_')[1][0] == tmp_path / 'out' / 's1' / 'lc_mask.nii.gz'
+
+    for out_file in out_files:
+        out_file.parent.mkdir(parents=True)
+    postprocess_batch(nii_files, out_files, [('lcomp', {})], num_cores=2)
+    for out_file in out_files:
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(out_file))), lcomp.lcomp(make_mask()))
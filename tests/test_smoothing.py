@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from midastools.misc.smoothing import smooth_img, smooth_volume
+from midastools.vtk import vtk_conversion, vtk_mesh
+
+
+def noisy_ellipsoid(shape=(40, 44, 48), seed=0):
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.arange(n) for n in shape], indexing='ij')
+    dist = sum(((g - n / 2) / (0.35 * n)) ** 2 for g, n in zip(grid, shape))
+    field = ndimage.gaussian_filter(rng.randn(*shape), 1.5)
+    return (dist + 0.3 * field / field.std() < 1.0).astype(np.uint8)
+
+
+def smooth_img_reference(volume):
+    """Mesh round-trip of a binary mask (laplacian smoothing, unit spacing)."""
+    vtk_image = vtk_conversion.vtk_data_to_image(vtk_conversion.np_to_vtk_data(volume),
+                                                 origin=(0, 0, 0), dims=volume.shape, spacing=(1.0, 1.0, 1.0))
+    vtk_poly = vtk_mesh.marching_cube(vtk_image)
+    vtk_poly = vtk_mesh.smooth(vtk_poly, smooth_filter='laplacian')
+    result = vtk_conversion.poly_to_img(vtk_poly, origin=(0, 0, 0), dim=volume.shape, spacing=(1.0, 1.0, 1.0))
+    return vtk_conversion.vtk_to_numpy_image(result)
+
+
+def test_smooth_img_default_filter():
+    volume = noisy_ellipsoid()
+    result = smooth_img(volume)
+    assert result.dtype == np.uint8
+    np.testing.assert_array_equal(result, smooth_img_reference(volume))
+
+
+@pytest.mark.parametrize('method', ['sdf', 'gaussian'])
+def test_smooth_volume(method):
+    volume = noisy_ellipsoid()
+    labels = volume * np.where(np.arange(volume.shape[0]) < volume.shape[0] // 2, 1, 2)[:, None, None]
+    result = smooth_volume(labels.astype(np.uint8), sigma=1.5, spacing=(1.0, 1.0, 2.0), method=method)
+    assert result.dtype == np.uint8
+    assert set(np.unique(result)) == {0, 1, 2}
+    # smoothing removes the noise, the ellipsoid volume is roughly kept
+    assert abs(int((result > 0).sum()) - int(volume.sum())) < 0.1 * volume.sum()
+    assert ndimage.label(result > 0)[1] == 1
+
+
+@pytest.mark.parametrize('label_value, dtype', [(7, np.uint8), (300, np.uint16), (70000, np.int32)])
+def test_smooth_img_multi_label(label_value, dtype):
+    volume = noisy_ellipsoid()
+    left = volume.copy()
+    left[:, :, 22:] = 0
+    right = volume.copy()
+    right[:, :, :26] = 0
+    labels = left.astype(dtype) * 2 + right.astype(dtype) * dtype(label_value)
+    result = smooth_img(labels)
+    assert result.dtype == (np.uint8 if label_value <= 255 else dtype)
+    assert set(np.unique(result)) == {0, 2, label_value}
+    # each label as in a separate binary run
+    np.testing.assert_array_equal(result == 2, smooth_img(left) > 0)
+    np.testing.assert_array_equal(result == label_value, smooth_img(right) > 0)
+
+
+def test_smooth_img_bounding_boxes():
+    """Voxelization inside the label bounding boxes matches the full-volume voxelization."""
+    volume = noisy_ellipsoid()
+    labels = volume * np.where(np.arange(volume.shape[2]) < 20, 1, 3)[None, None, :]
+    labels[2:8, 2:8, 2:8] = 5
+    spacing = (1.0, 1.5, 2.0)
+    vtk_image = vtk_conversion.vtk_data_to_image(vtk_conversion.np_to_vtk_data(labels),
+                                                 origin=(0, 0, 0), dims=labels.shape, spacing=spacing)
+    vtk_polys = vtk_mesh.marching_cube_labels(vtk_image, label_values=[1, 3, 5], smooth_filter='sinc')
+    expected = np.zeros(labels.shape, np.uint8)
+    for label_value, vtk_poly in vtk_polys.items():
+        label_img = vtk_conversion.poly_to_img(vtk_poly, origin=(0, 0, 0), dim=labels.shape, spacing=spacing)
+        expected[(vtk_conversion.vtk_to_numpy_image(label_img) > 0) & (expected == 0)] = label_value
+    result = smooth_img(labels, smooth_filter='sinc', spacing=spacing)
+    assert set(np.unique(result)) == {0, 1, 3, 5}
+    np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,291 @@
+import math
+import numpy as np
+import pytest
+import vtk
+import SimpleITK as sitk
+from vtk.util import numpy_support
+from midastools.vtk.vtk_conversion import (poly_to_img, np_cells_to_vtk_cell_array, vtk_cell_array_to_np,
+                                           np_verts_to_vtk_poly, np_triangles_to_vtk_poly, vtk_poly_to_np_verts,
+                                           np_to_vtk_points, vtk_points_to_polyline, np_to_vtk_data,
+                                           np_to_vtk_image, vtk_to_numpy_image, sitk_to_vtk_image,
+                                           vtk_to_itk_image, vtk_image_geometry)
+
+
+def sphere_poly(center=(3.0, -2.0, 5.0), radius=7.3):
+    source = vtk.vtkSphereSource()
+    source.SetCenter(*center)
+    source.SetRadius(radius)
+    source.SetThetaResolution(32)
+    source.SetPhiResolution(32)
+    source.Update()
+    return source.GetOutput()
+
+
+def poly_to_img_reference(poly, origin=None, dim=None, spacing=(1.0, 1.0, 1.0)):
+    """Stencil of the full image volume (previous implementation)."""
+    bounds = [0 for _ in range(6)]
+    poly.GetBounds(bounds)
+    if dim is None:
+        dim = [int(math.ceil((bounds[i * 2 + 1] - bounds[i * 2]) / spacing[i])) for i in range(3)]
+    if origin is None:
+        origin = [bounds[0], bounds[2], bounds[4]]
+
+    image_ = vtk.vtkImageData()
+    image_.SetSpacing(*spacing)
+    image_.SetDimensions(*dim)
+    image_.SetExtent(0, dim[0]-1, 0, dim[1]-1, 0, dim[2]-1)
+    image_.SetOrigin(*origin)
+    image_.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    image_.GetPointData().GetScalars().Fill(1)
+
+    pol_to_stenc = vtk.vtkPolyDataToImageStencil()
+    pol_to_stenc.SetTolerance(0)
+    pol_to_stenc.SetInputData(poly)
+    pol_to_stenc.SetOutputOrigin(*origin)
+    pol_to_stenc.SetOutputSpacing(*spacing)
+    pol_to_stenc.SetOutputWholeExtent(image_.GetExtent())
+    pol_to_stenc.Update()
+
+    image_stenc = vtk.vtkImageStencil()
+    image_stenc.SetInputData(image_)
+    image_stenc.SetStencilData(pol_to_stenc.GetOutput())
+    image_stenc.ReverseStencilOff()
+    image_stenc.SetBackgroundValue(0)
+    image_stenc.Update()
+    return image_stenc.GetOutput()
+
+
+def image_to_np(vtk_image):
+    data = numpy_support.vtk_to_numpy(vtk_image.GetPointData().GetScalars())
+    return data.reshape(vtk_image.GetDimensions(), order='F')
+
+
+@pytest.mark.parametrize('origin, dim, spacing', [
+    (None, None, (1.0, 1.0, 1.0)),
+    (None, None, (0.7, 1.2, 1.5)),
+    ((-20.0, -25.0, -10.0), (50, 40, 45), (1.0, 1.0, 1.0)),
+    ((-20.0, -25.0, -10.0), (30, 30, 30), (1.5, 1.0, 0.8)),
+    # mesh partially outside of the image
+    ((0.0, 0.0, 0.0), (20, 20, 20), (1.0, 1.0, 1.0)),
+])
+def test_poly_to_img_matches_full_stencil(origin, dim, spacing):
+    poly = sphere_poly()
+    result = poly_to_img(poly, origin=origin, dim=dim, spacing=spacing)
+    expected = poly_to_img_reference(poly, origin=origin, dim=dim, spacing=spacing)
+    assert result.GetDimensions() == expected.GetDimensions()
+    np.testing.assert_allclose(result.GetOrigin(), expected.GetOrigin())
+    np.testing.assert_allclose(result.GetSpacing(), expected.GetSpacing())
+    np_result = image_to_np(result)
+    assert np_result.dtype == np.uint8
+    assert np_result.sum() > 0
+    np.testing.assert_array_equal(np_result, image_to_np(expected))
+
+
+def test_poly_to_img_direction():
+    poly = sphere_poly()
+    origin, dim, spacing = (-20.0, -25.0, -10.0), (50, 40, 45), (1.0, 1.2, 0.9)
+    angle = np.deg2rad(30)
+    matrix = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+    # mesh in the rotated physical frame of the image
+    points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData()).astype(float)
+    rotated = vtk.vtkPolyData()
+    rotated.DeepCopy(poly)
+    rotated.GetPoints().SetData(numpy_support.numpy_to_vtk((points - origin) @ matrix.T + origin, deep=True))
+    result = poly_to_img(rotated, origin=origin, dim=dim, spacing=spacing, direction=matrix.ravel())
+    expected = poly_to_img_reference(poly, origin=origin, dim=dim, spacing=spacing)
+    np.testing.assert_array_equal(image_to_np(result), image_to_np(expected))
+
+
+def cells_to_list(vtk_cells):
+    """Point ids of all cells (cell by cell traversal)."""
+    cells, ids = [], vtk.vtkIdList()
+    vtk_cells.InitTraversal()
+    while vtk_cells.GetNextCell(ids):
+        cells.append([ids.GetId(i) for i in range(ids.GetNumberOfIds())])
+    return cells
+
+
+def np_verts_to_vtk_poly_reference(np_verts, np_triangles=None):
+    """Cell by cell construction (previous implementation)."""
+    vtk_points = vtk.vtkPoints()
+    vtk_vertices = vtk.vtkCellArray()
+    vtk_poly = vtk.vtkPolyData()
+    for vert_ in np_verts.tolist():
+        id = vtk_points.InsertNextPoint(vert_)
+        vtk_vertices.InsertNextCell(1)
+        vtk_vertices.InsertCellPoint(id)
+    vtk_poly.SetVerts(vtk_vertices)
+    vtk_poly.SetPoints(vtk_points)
+    if np_triangles is not None:
+        vtk_triangles = vtk.vtkCellArray()
+        for tri_ in np_triangles.tolist():
+            vtk_tri = vtk.vtkTriangle()
+            for i in range(3):
+                vtk_tri.GetPointIds().SetId(i, tri_[i])
+            vtk_triangles.InsertNextCell(vtk_tri)
+        vtk_poly.SetPolys(vtk_triangles)
+    return vtk_poly
+
+
+def vtk_points_to_polyline_reference(vtk_points):
+    """Line by line construction (previous implementation)."""
+    lines = vtk.vtkCellArray()
+    for k in range(vtk_points.GetNumberOfPoints() - 1):
+        line = vtk.vtkLine()
+        line.GetPointIds().SetId(0, k)
+        line.GetPointIds().SetId(1, k + 1)
+        lines.InsertNextCell(line)
+    polyline = vtk.vtkPolyData()
+    polyline.SetLines(lines)
+    polyline.SetPoints(vtk_points)
+    return polyline
+
+
+def sphere_mesh():
+    poly = sphere_poly()
+    verts = numpy_support.vtk_to_numpy(poly.GetPoints().GetData())
+    triangles = np.array(cells_to_list(poly.GetPolys()))
+    return verts, triangles
+
+
+def test_np_cells_to_vtk_cell_array():
+    cells = [[0, 1, 2], [3, 4, 5, 6], [7], [], [8, 9, 10, 11, 12]]
+    offsets = np.concatenate([[0], np.cumsum([len(c) for c in cells])])
+    connectivity = np.concatenate(cells).astype(int)
+    vtk_cells = np_cells_to_vtk_cell_array(connectivity, offsets)
+    assert cells_to_list(vtk_cells) == cells
+    np_connectivity, np_offsets = vtk_cell_array_to_np(vtk_cells)
+    np.testing.assert_array_equal(np_connectivity, connectivity)
+    np.testing.assert_array_equal(np_offsets, offsets)
+
+    empty = vtk_cell_array_to_np(vtk.vtkCellArray())
+    assert len(empty[0]) == 0 and list(empty[1]) == [0]
+
+
+def test_np_verts_to_vtk_poly():
+    verts, triangles = sphere_mesh()
+    for np_triangles in (None, triangles):
+        result = np_verts_to_vtk_poly(verts, np_triangles)
+        expected = np_verts_to_vtk_poly_reference(verts, np_triangles)
+        np.testing.assert_array_equal(numpy_support.vtk_to_numpy(result.GetPoints().GetData()),
+                                      numpy_support.vtk_to_numpy(expected.GetPoints().GetData()))
+        assert cells_to_list(result.GetVerts()) == cells_to_list(expected.GetVerts())
+        assert cells_to_list(result.GetPolys()) == cells_to_list(expected.GetPolys())
+        assert result.GetNumberOfCells() == expected.GetNumberOfCells()
+
+
+def test_np_triangles_to_vtk_poly():
+    verts, triangles = sphere_mesh()
+    poly = np_triangles_to_vtk_poly(verts, triangles)
+    assert poly.GetNumberOfVerts() == 0
+    assert cells_to_list(poly.GetPolys()) == triangles.tolist()
+    np_verts, np_triangles = vtk_poly_to_np_verts(poly)
+    np.testing.assert_array_equal(np_verts, verts)
+    np.testing.assert_array_equal(np_triangles, triangles)
+
+
+def test_vtk_poly_to_np_verts_mixed_polygons():
+    cells = [[0, 1, 2], [1, 2, 3, 4], [0, 5], [4, 5, 6, 7, 8]]
+    polys = vtk.vtkCellArray()
+    for cell in cells:
+        polys.InsertNextCell(len(cell), cell)
+    poly = vtk.vtkPolyData()
+    poly.SetPoints(np_to_vtk_points(np.random.default_rng(0).random((9, 3))))
+    poly.SetPolys(polys)
+    # fan triangulation, cells with less than 3 points are dropped
+    expected = [[c[0], c[i], c[i + 1]] for c in cells for i in range(1, len(c) - 1)]
+    _, np_triangles = vtk_poly_to_np_verts(poly)
+    assert np_triangles.tolist() == expected
+
+
+@pytest.mark.parametrize('n_points', [0, 1, 2, 50])
+def test_points_to_polyline(n_points):
+    points = np.random.default_rng(0).random((n_points, 3))
+    vtk_points = np_to_vtk_points(points)
+    np.testing.assert_allclose(numpy_support.vtk_to_numpy(vtk_points.GetData()).reshape(-1, 3),
+                               points.astype(np.float32))
+    result = vtk_points_to_polyline(vtk_points)
+    expected = vtk_points_to_polyline_reference(vtk_points)
+    assert cells_to_list(result.GetLines()) == cells_to_list(expected.GetLines())
+    assert result.GetNumberOfPoints() == n_points
+
+
+def oblique_geometry():
+    angle = np.deg2rad(20)
+    direction = (np.cos(angle), 0., np.sin(angle), 0., 1., 0., -np.sin(angle), 0., np.cos(angle))
+    return (1.5, -2., 3.), (0.5, 1.2, 2.), direction
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.uint16, np.int32, np.float32, np.float64, bool])
+def test_numpy_vtk_image_round_trip(dtype):
+    origin, spacing, direction = oblique_geometry()
+    np_data = (np.random.default_rng(0).random((5, 6, 7))*100).astype(dtype)
+    for order in ('C', 'F'):
+        data = np.array(np_data, order=order)
+        vtk_image = np_to_vtk_image(data, origin=origin, spacing=spacing, direction=direction)
+        result, geometry = vtk_to_numpy_image(vtk_image, return_geometry=True)
+        assert result.dtype == (np.uint8 if dtype == bool else dtype)
+        np.testing.assert_array_equal(result, data)
+        np.testing.assert_allclose(geometry['origin'], origin)
+        np.testing.assert_allclose(geometry['spacing'], spacing)
+        np.testing.assert_allclose(geometry['direction'], direction)
+
+
+def test_np_to_vtk_data_sharing():
+    data = np.asfortranarray(np.arange(60, dtype=np.int16).reshape(3, 4, 5))
+    shared = np_to_vtk_data(data)
+    copied = np_to_vtk_data(data, deep=True)
+    c_copy = np_to_vtk_data(np.ascontiguousarray(data))
+    data[0, 0, 0] = 100
+    assert numpy_support.vtk_to_numpy(shared)[0] == 100
+    assert numpy_support.vtk_to_numpy(copied)[0] == 0
+    assert numpy_support.vtk_to_numpy(c_copy)[0] == 0
+    np.testing.assert_array_equal(numpy_support.vtk_to_numpy(c_copy), np.arange(60).reshape(3, 4, 5).ravel('F'))
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.float32, np.float64])
+@pytest.mark.parametrize('deep', [False, True])
+def test_sitk_vtk_image_round_trip(dtype, deep):
+    origin, spacing, direction = oblique_geometry()
+    img = sitk.GetImageFromArray((np.random.default_rng(0).random((7, 6, 5))*100).astype(dtype))
+    img.SetOrigin(origin)
+    img.SetSpacing(spacing)
+    img.SetDirection(direction)
+
+    vtk_image = sitk_to_vtk_image(img, deep=deep)
+    assert vtk_image.GetDimensions() == img.GetSize()
+    np.testing.assert_array_equal(vtk_to_numpy_image(vtk_image), sitk.GetArrayFromImage(img).T)
+    # vtk physical points == sitk physical points
+    index = (4, 2, 5)
+    point = [0., 0., 0.]
+    vtk_image.TransformIndexToPhysicalPoint(index, point)
+    np.testing.assert_allclose(point, img.TransformIndexToPhysicalPoint(index))
+
+    result = vtk_to_itk_image(vtk_image)
+    del img
+    assert sitk.GetArrayViewFromImage(result).dtype == dtype
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(result).T, vtk_to_numpy_image(vtk_image))
+    np.testing.assert_allclose(result.GetOrigin(), origin)
+    np.testing.assert_allclose(result.GetSpacing(), spacing)
+    np.testing.assert_allclose(result.GetDirection(), direction)
+
+
+def test_vector_image_round_trip():
+    img = sitk.GetImageFromArray(np.random.default_rng(0).random((4, 5, 6, 3)).astype(np.float32), isVector=True)
+    vtk_image = sitk_to_vtk_image(img)
+    np_image = vtk_to_numpy_image(vtk_image)
+    assert np_image.shape == (6, 5, 4, 3)
+    np.testing.assert_array_equal(np_image, np.moveaxis(sitk.GetArrayFromImage(img), [0, 1, 2], [2, 1, 0]))
+    result = vtk_to_itk_image(vtk_image)
+    assert result.GetNumberOfComponentsPerPixel() == 3
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(img))
+
+
+def test_vtk_image_geometry_extent():
+    origin, spacing, direction = oblique_geometry()
+    vtk_image = np_to_vtk_image(np.zeros((5, 6, 7), np.uint8), origin=origin, spacing=spacing, direction=direction)
+    vtk_image.SetExtent(2, 6, 1, 6, 3, 9)
+    geometry = vtk_image_geometry(vtk_image)
+    point = [0., 0., 0.]
+    vtk_image.TransformIndexToPhysicalPoint((2, 1, 3), point)
+    np.testing.assert_allclose(geometry['origin'], point)
@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from midastools.misc.zcompose import (sort_imgs, compose_imgs, compose_layout, fill_composed, compose_subject,
+                                      validate_headers, sort_headers, find_subjects, StationHeader)
+
+XY_SIZE = (4, 5)
+SPACING = (1.5, 1.5, 2.0)
+
+
+def reference_compose(imgs):
+    """Previous composition: crop the overlaps half and half, transpose and concatenate."""
+    imgs = list(imgs)
+    for i in range(1, len(imgs)):
+        idx_last_slice = imgs[i-1].GetSize()[2] - 1
+        z_last_slice = imgs[i-1].TransformIndexToPhysicalPoint([0, 0, idx_last_slice])
+        delta_slices = imgs[i].TransformPhysicalPointToIndex(z_last_slice)[2] + 1
+        crop_a = int(delta_slices/2)
+        crop_b = delta_slices - crop_a
+        imgs[i] = imgs[i][:, :, crop_a:]
+        imgs[i-1] = imgs[i-1][:, :, :(idx_last_slice + 1 - crop_b)]
+    img_array = np.concatenate([sitk.GetArrayFromImage(im).transpose([2, 1, 0]) for im in imgs], axis=2)
+    return img_array.transpose([2, 1, 0])
+
+
+def make_stations(num_slices=(6, 7, 5), overlaps=(2, 3), descending=(1,), seed=0, dtype=np.int16):
+    """Stations along z with the given slice overlaps, listed in random order."""
+    rng = np.random.default_rng(seed)
+    imgs, z = [], 0
+    for i, size in enumerate(num_slices):
+        img = sitk.GetImageFromArray(rng.integers(0, 1000, (size, XY_SIZE[1], XY_SIZE[0])).astype(dtype))
+        img.SetSpacing(SPACING)
+        img.SetOrigin((-3.0, 7.0, z * SPACING[2]))
+        if i in descending:
+            # same physical content, stored top to bottom
+            img = sitk.Flip(img, (False, False, True))
+        imgs.append(img)
+        if i < len(overlaps):
+            z += size - overlaps[i]
+    return [imgs[i] for i in rng.permutation(len(imgs))]
+
+
+def write_stations(subj_dir, sequence, imgs):
+    subj_dir.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i, img in enumerate(imgs):
+        files.append(subj_dir / f'{sequence}_s{i}.nii.gz')
+        sitk.WriteImage(img, str(files[-1]))
+    return files
+
+
+def test_compose_layout():
+    imgs = sort_imgs(make_stations())
+    layout = compose_layout(imgs)
+    assert layout['overlaps'] == [2, 3]
+    assert layout['starts'] == [0, 1, 1] and layout['stops'] == [5, 5, 5]
+    assert layout['positions'] == [0, 5, 9]
+    assert layout['shape'] == (13, XY_SIZE[1], XY_SIZE[0])
+    blended = compose_layout(imgs, blend=True)
+    assert blended['positions'] == [0, 4, 8] and blended['shape'][0] == 6 + 7 + 5 - 2 - 3
+
+
+def test_compose_matches_reference():
+    imgs = sort_imgs(make_stations())
+    img_composed = compose_imgs(imgs)
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(img_composed), reference_compose(imgs))
+    assert img_composed.GetOrigin() == imgs[0].GetOrigin()
+    assert img_composed.GetSpacing() == imgs[0].GetSpacing()
+
+
+def test_compose_subject_matches_reference(tmp_path):
+    station_files, out_files, expected = {}, {}, {}
+    for seed, seq in enumerate(['fat', 'water']):
+        imgs = make_stations(seed=seed)
+        station_files[seq] = write_stations(tmp_path, seq, imgs)
+        out_files[seq] = tmp_path / f'{seq}_composed.nii'
+        expected[seq] = reference_compose(sort_imgs(imgs))
+
+    result = compose_subject(station_files, out_files)
+    ref_img = sort_imgs(make_stations())[0]
+    for seq in station_files:
+        img = sitk.ReadImage(str(out_files[seq]))
+        assert result[seq] == img.GetSize() == expected[seq].shape[::-1]
+        assert img.GetPixelID() == sitk.sitkInt16
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(img), expected[seq])
+        np.testing.assert_allclose(img.GetOrigin(), ref_img.GetOrigin(), atol=1e-4)
+        np.testing.assert_allclose(img.GetSpacing(), SPACING, atol=1e-6)
+        np.testing.assert_allclose(img.GetDirection(), np.eye(3).ravel(), atol=1e-6)
+
+    # existing outputs are skipped (resume)
+    assert compose_subject(station_files, out_files) == {'fat': None, 'water': None}
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.int16])
+def test_blend_weights(dtype):
+    imgs = make_stations(num_slices=(6, 6), overlaps=(3,), descending=(), dtype=dtype)
+    imgs = sort_imgs(imgs)
+    values = [0, 100]
+    for img, value in zip(imgs, values):
+        img[:, :, :] = sitk.Image(img.GetSize(), img.GetPixelID()) + value
+    layout = compose_layout(imgs, blend=True)
+    img_array = np.empty(layout['shape'], dtype)
+    fill_composed(img_array, (sitk.GetArrayViewFromImage(im) for im in imgs), layout)
+
+    assert img_array.shape[0] == 9
+    np.testing.assert_array_equal(img_array[:3], 0)
+    # linear transition in the overlap region (previous -> current station)
+    np.testing.assert_array_equal(img_array[3:6, 0, 0], [25, 50, 75])
+    np.testing.assert_array_equal(img_array[6:], 100)
+
+
+def test_validate_headers(tmp_path):
+    imgs = make_stations(descending=())
+    headers = sort_headers([StationHeader(f) for f in write_stations(tmp_path / 'a', 'fat', imgs)])
+    validate_headers(headers)
+
+    # stations with different slice counts in another sequence
+    other = sort_headers([StationHeader(f) for f in
+                          write_stations(tmp_path / 'b', 'fat', make_stations(num_slices=(6, 7, 6)))])
+    with pytest.raises(ValueError):
+        validate_headers(other, headers)
+
+    imgs[0].SetSpacing((1.0, 1.5, 2.0))
+    with pytest.raises(ValueError):
+        validate_headers([StationHeader(f) for f in write_stations(tmp_path / 'c', 'fat', imgs)])
+
+
+def test_sort_headers(tmp_path):
+    imgs = make_stations()
+    headers = sort_headers([StationHeader(f) for f in write_stations(tmp_path, 'fat', imgs)])
+    for header, img in zip(headers, sort_imgs(imgs)):
+        np.testing.assert_allclose(header.GetOrigin(), img.GetOrigin(), atol=1e-4)
+        np.testing.assert_allclose(header.GetDirection(), img.GetDirection(), atol=1e-6)
+        np.testing.assert_array_equal(header.load_array(), sitk.GetArrayFromImage(img))
+
+
+def test_find_subjects(tmp_path):
+    imgs = make_stations()
+    for subj in ['s1', 's2']:
+        write_stations(tmp_path / subj / 'Dixon_BH', 'fat', imgs)
+    write_stations(tmp_path / 's1' / 'Dixon_BH', 'water', imgs)
+    # outputs and incomplete outputs are no stations
+    sitk.WriteImage(imgs[0], str(tmp_path / 's1' / 'Dixon_BH' / 'fat_s_composed.nii'))
+    sitk.WriteImage(imgs[0], str(tmp_path / 's1' / 'Dixon_BH' / '.tmp_fat_s9.nii'))
+    (tmp_path / 's3' / 'Dixon_BH').mkdir(parents=True)
+
+    jobs = find_subjects(tmp_path, '**/Dixon_BH*', '{sequence}_s*nii*', ['fat', 'water'], '{sequence}_s_composed.nii')
+    assert len(jobs) == 2
+    station_files, out_files = jobs[0]
+    assert sorted(station_files) == ['fat', 'water']
+    assert [f.name for f in station_files['fat']] == ['fat_s0.nii.gz', 'fat_s1.nii.gz', 'fat_s2.nii.gz']
+    assert out_files['fat'] == tmp_path / 's1' / 'Dixon_BH' / 'fat_s_composed.nii'
+    assert list(jobs[1][0]) == ['fat']